@@ -52,6 +52,10 @@ setup(
                   "data/solar/*", "data/sql_template/*"]
     },
     install_requires=INSTALL_REQUIRES,
+    extras_require={
+        'async': ['aiohttp'],
+        'export': ['pyarrow'],
+    },
     include_package_data=True,
     zip_safe=False,
     python_requires='>=3.6',
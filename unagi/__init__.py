@@ -7,8 +7,19 @@ from . import mask
 from . import task
 from . import query
 from . import config
-
-__all__ = ["query", "hsc", "task", "config", "sky", "mask"]
+from . import cache
+from . import scheduler
+from . import bulk
+from . import footprint
+from . import skymap
+from . import store
+from . import poller
+from . import journal
+from . import export
+from . import catstore
+
+__all__ = ["query", "hsc", "task", "config", "sky", "mask", "cache", "scheduler", "bulk",
+           "footprint", "skymap", "store", "poller", "journal", "export", "catstore"]
 
 __version__ = "0.1.1"
 __name__ = 'unagi'
@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Asyncio client for the HSC archive"""
+
+import io
+import os
+import json
+import asyncio
+import tempfile
+import warnings
+from functools import partial
+
+from astropy.io import fits
+
+from .hsc import Hsc, QueryError
+
+__all__ = ['AsyncHsc']
+
+
+def _import_aiohttp():
+    """Import the optional aiohttp package."""
+    try:
+        import aiohttp
+    except ImportError:
+        raise ImportError(
+            "# Need to install aiohttp package to use, e.g. `pip install unagi[async]`.")
+    return aiohttp
+
+
+class AsyncHsc():
+    """
+    Asyncio counterpart of the HSC Server Class.
+
+    Requires `aiohttp`. The URLs and the SQL job payloads are generated by a
+    regular `Hsc` object, while all the network traffic goes through a single
+    `aiohttp.ClientSession`. The number of requests in flight is bounded by a
+    semaphore, so it is safe to `asyncio.gather` thousands of requests.
+
+    Creating the underlying `Hsc` object logs in to the archive with blocking
+    HTTP requests, and can even run a SQL job to get the list of tables. Inside
+    a coroutine, use `await AsyncHsc.create(...)`, which does that in a thread
+    of the executor of the event loop, or pass an existing `Hsc` as `archive`.
+
+    Examples
+    --------
+
+        >>> archive = await AsyncHsc.create(dr='pdr2', rerun='pdr2_wide')
+        >>> async with archive:
+        ...     cutouts = await asyncio.gather(
+        ...         *[archive.get_cutout_image(c, filt='HSC-I') for c in coords])
+    """
+    def __init__(self, dr='pdr2', rerun='pdr2_wide', verbose=True, config_file=None,
+                 archive=None, max_concurrency=100, limit_per_host=0, timeout=None):
+        """
+        Initialize an asyncio HSC rerun object.
+
+        Parameters
+        ----------
+        dr : str
+            HSC database name. Default: 'pdr2'
+        rerun : str
+            HSC rerun dataset name. Default: 'pdr2_wide'
+        config_file: str
+            Name of the configuration file. Default: None
+        archive: unagi.hsc.Hsc
+            An existing `Hsc` object to borrow the configuration from. Default: None,
+            create one, which blocks, see `AsyncHsc.create`
+        max_concurrency: int
+            Maximum number of HTTP requests in flight. Default: 100
+        limit_per_host: int
+            Maximum number of connections to a single host, 0 means no limit. Default: 0
+        timeout: float
+            Total timeout of a single request in seconds; the download of a SQL
+            result only times out when no data is received for that long.
+            Default: None, which means archive.timeout
+        """
+        # Fail early rather than at the first request
+        _import_aiohttp()
+        if archive is None:
+            archive = Hsc(dr=dr, rerun=rerun, verbose=verbose, config_file=config_file)
+        self.hsc = archive
+        self.dr = archive.dr
+        self.rerun = archive.rerun
+        self.archive = archive.archive
+
+        self.max_concurrency = max_concurrency
+        self.limit_per_host = limit_per_host
+        if timeout is None:
+            timeout = self.archive.timeout
+        self.timeout = timeout
+
+        # Created lazily, they have to be bound to the running event loop
+        self.session = None
+        self._semaphore = None
+
+    @classmethod
+    async def create(cls, dr='pdr2', rerun='pdr2_wide', verbose=True, config_file=None,
+                     **kwargs):
+        """
+        Create an asyncio HSC rerun object without blocking the event loop.
+
+        The login to the archive runs in the default executor of the event loop.
+        The other `kwargs` are passed to `AsyncHsc`.
+        """
+        _import_aiohttp()
+        loop = asyncio.get_running_loop()
+        archive = await loop.run_in_executor(None, partial(
+            Hsc, dr=dr, rerun=rerun, verbose=verbose, config_file=config_file))
+        return cls(archive=archive, **kwargs)
+
+    async def __aenter__(self):
+        await self._get_session()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def _get_session(self):
+        """
+        Create the shared `aiohttp.ClientSession` if necessary.
+        """
+        aiohttp = _import_aiohttp()
+
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.max_concurrency, limit_per_host=self.limit_per_host)
+            self.session = aiohttp.ClientSession(
+                auth=aiohttp.BasicAuth(self.archive._username, self.archive._password),
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                raise_for_status=True)
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        return self.session
+
+    async def close(self):
+        """
+        Close the HTTP session.
+        """
+        if self.session is not None:
+            await self.session.close()
+        self.session = None
+        self._semaphore = None
+
+    async def _http_get(self, url):
+        """
+        Get the content of an URL.
+        """
+        session = await self._get_session()
+        async with self._semaphore:
+            async with session.get(url) as res:
+                return await res.read()
+
+    def _stream_timeout(self):
+        """
+        Timeout of a large download: the socket limits apply, not the total time.
+        """
+        aiohttp = _import_aiohttp()
+        return aiohttp.ClientTimeout(total=None, sock_connect=30., sock_read=self.timeout)
+
+    async def _http_post_json(self, url, data, decode=True, stream=False):
+        """
+        Send SQL request.
+        """
+        session = await self._get_session()
+        data['clientVersion'] = self.hsc.sql_version
+        kwargs = {'timeout': self._stream_timeout()} if stream else {}
+        async with self._semaphore:
+            async with session.post(url, data=json.dumps(data),
+                                    headers={'Content-type': 'application/json'},
+                                    **kwargs) as res:
+                content = await res.read()
+
+        if decode:
+            return json.loads(content) if content else None
+        return content
+
+    async def get_cutout_image(self, coord, coord_2=None, w_half=None, h_half=None,
+                               filt='HSC-I', img_type='coadd', image=True, variance=False,
+                               mask=False, verbose=False):
+        """
+        Get HSC cutout image.
+
+        See `unagi.hsc.Hsc.get_cutout_image`.
+        """
+        cutout_url = self.hsc.form_cutout_url(
+            coord, coord_2=coord_2, w_half=w_half, h_half=h_half, filt=filt,
+            img_type=img_type, image=image, variance=variance, mask=mask)
+
+        if img_type == 'warp':
+            if verbose:
+                warnings.warn("# Not a coadd cutout, will return the url")
+            return cutout_url
+
+        if verbose:
+            print("# Downloading FITS image from {}".format(cutout_url))
+
+        return fits.open(io.BytesIO(await self._http_get(cutout_url)))
+
+    async def get_psf_model(self, coord, filt='HSC-I', img_type='coadd', centered=True,
+                            verbose=False):
+        """
+        Get the PSF model at a given sky position.
+
+        See `unagi.hsc.Hsc.get_psf_model`.
+        """
+        psf_url = self.hsc.form_psf_url(
+            coord, filt=filt, img_type=img_type, centered=centered)
+
+        if img_type == 'warp':
+            if verbose:
+                warnings.warn("# Not a coadd PSF model, will return the url")
+            return psf_url
+
+        if verbose:
+            print("# Downloading FITS image from {}".format(psf_url))
+
+        return fits.open(io.BytesIO(await self._http_get(psf_url)))
+
+    async def submit_query(self, sql, nomail=True, skip_syntax=True):
+        """
+        Submit SQL job to HSC archive.
+        """
+        url = os.path.join(self.archive.cat_url, 'submit')
+
+        catalog_job = {
+            'sql'                     : sql,
+            'out_format'              : 'fits',
+            'include_metainfo_to_body': True,
+            'release_version'         : self.dr,
+            }
+
+        post_data = {
+            'credential': self.hsc._credential(),
+            'catalog_job': catalog_job,
+            'nomail': nomail,
+            'skip_syntax_check': skip_syntax
+            }
+
+        return await self._http_post_json(url, post_data)
+
+    async def check_query(self, job_id):
+        """
+        Check the status of a SQL query job.
+        """
+        url = os.path.join(self.archive.cat_url, 'status')
+        post_data = {'credential': self.hsc._credential(), 'id': job_id}
+
+        return await self._http_post_json(url, post_data)
+
+    async def cancel_query(self, job_id):
+        """
+        Cancel a SQL query job.
+        """
+        url = os.path.join(self.archive.cat_url, 'cancel')
+        post_data = {'credential': self.hsc._credential(), 'id': job_id}
+
+        _ = await self._http_post_json(url, post_data, decode=False)
+
+    async def delete_query(self, job_id):
+        """
+        Delete a SQL query job.
+        """
+        url = os.path.join(self.archive.cat_url, 'delete')
+        post_data = {'credential': self.hsc._credential(), 'id': job_id}
+
+        _ = await self._http_post_json(url, post_data, decode=False)
+
+    async def get_query_result(self, job_id, file_path=None, chunk_size=1048576):
+        """
+        Download SQL query result.
+
+        Return the content of the FITS file, or stream it to `file_path` in
+        chunks of `chunk_size` bytes and return the name of the file.
+        """
+        url = os.path.join(self.archive.cat_url, 'download')
+        post_data = {'credential': self.hsc._credential(), 'id': job_id}
+
+        if file_path is None:
+            return await self._http_post_json(url, post_data, decode=False, stream=True)
+
+        session = await self._get_session()
+        post_data['clientVersion'] = self.hsc.sql_version
+        async with self._semaphore:
+            async with session.post(url, data=json.dumps(post_data),
+                                    headers={'Content-type': 'application/json'},
+                                    timeout=self._stream_timeout()) as res:
+                with open(file_path, 'wb') as f:
+                    async for chunk in res.content.iter_chunked(chunk_size):
+                        f.write(chunk)
+
+        return file_path
+
+    async def _block_until_query_finishes(self, job_id):
+        """
+        Wait until the query is done without blocking the event loop.
+
+        The status is checked with the same jittered interval as the shared
+        poller of the archive, capped by its `max_interval`.
+        """
+        poller = self.hsc.poller
+        interval = poller.min_interval
+
+        while True:
+            await asyncio.sleep(poller.delay(interval))
+            status = await self.check_query(job_id)
+
+            if status['status'] == 'error':
+                raise QueryError('query error: {}'.format(status['error']))
+            if status['status'] == 'done':
+                break
+            if status['status'] in poller.TERMINAL:
+                raise QueryError('query is {}'.format(status['status']))
+
+            interval = min(interval * poller.factor, poller.max_interval)
+
+    async def sql_query(self, sql, out_file=None, nomail=True, skip_syntax=True,
+                        delete_after=True, verbose=False, from_file=False, tmp_dir=None):
+        """
+        SQL search in HSC archive.
+
+        See `unagi.hsc.Hsc.sql_query`.
+        """
+        if from_file:
+            sql_str = open(sql, 'r').read()
+        else:
+            sql_str = sql
+
+        job = await self.submit_query(sql_str, nomail=nomail, skip_syntax=skip_syntax)
+
+        fd, result_file = tempfile.mkstemp(suffix='.fits', dir=tmp_dir)
+        os.close(fd)
+        try:
+            await self._block_until_query_finishes(job['id'])
+            _ = await self.get_query_result(job['id'], file_path=result_file)
+            # Convert the output into astropy.table
+            result = self.hsc._read_query_result(result_file, memmap=True)
+        except QueryError:
+            try:
+                await self.delete_query(job['id'])
+            except Exception:
+                pass
+            raise
+        except asyncio.CancelledError:
+            await self.cancel_query(job['id'])
+            raise
+        finally:
+            # The memory map stays valid after the file is removed on POSIX systems
+            try:
+                os.remove(result_file)
+            except OSError:
+                pass
+
+        if not result and verbose:
+            warnings.warn('Query returned no results, so the table will be empty!')
+
+        # Save a copy of the result to file
+        if out_file:
+            if verbose:
+                print('# Save result to {}'.format(out_file))
+            result.write(out_file, overwrite=True)
+
+        # Delete the SQL search result from the archive
+        if delete_after:
+            await self.delete_query(job['id'])
+
+        return result
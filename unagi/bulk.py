@@ -0,0 +1,722 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Helpers for downloading cutouts in bulk"""
+
+import os
+import hashlib
+import time
+import sqlite3
+import tarfile
+
+import h5py
+import numpy as np
+
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+
+from astropy.io import fits
+from astropy.wcs import WCS
+
+__all__ = ['AdaptiveController', 'CutoutManifest', 'StackedCutoutWriter', 'cutout_stamps',
+           'file_checksum', 'iter_tar_members', 'plan_cutout_groups', 'write_fits_hdf']
+
+# Header keywords that describe the layout of the FITS file, not the data
+FITS_LAYOUT_KEYWORDS = {'XTENSION', 'BITPIX', 'SIMPLE', 'PCOUNT', 'GCOUNT',
+                        'GROUPS', 'EXTEND', 'TFIELDS', 'EXTNAME'}
+FITS_TABLE_KEYWORDS = {'TDISP', 'TUNIT', 'TTYPE', 'TFORM', 'TBCOL', 'TNULL',
+                       'TSCAL', 'TZERO', 'NAXIS'}
+
+
+def file_checksum(file_name, chunk_size=1048576):
+    """SHA1 checksum of a file."""
+    sha1 = hashlib.sha1()
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+class AdaptiveController():
+    """
+    AIMD control of the batch size and of the number of concurrent requests.
+
+    Every finished request is reported with `success`, `throttled` (HTTP 429
+    or 503) or `failure`. Successful requests are grouped in rounds of `concurrency`
+    requests: as long as the throughput (objects per second) of a round does
+    not drop, the batch size and the concurrency are increased additively;
+    once more parallel requests stop paying off, the concurrency goes back
+    down by one. A throttled or failed request divides both by two and pauses
+    new requests for a short, growing delay (or the `Retry-After` delay of
+    the server).
+
+    Parameters
+    ----------
+    batch_size: int
+        Initial number of objects in a request. Default: 200
+    min_batch_size: int
+        Smallest number of objects in a request. Default: 10
+    max_batch_size: int
+        Largest number of objects in a request, the archive accepts at most
+        1000. Default: 1000
+    batch_step: int
+        Additive increase of the batch size. Default: 100
+    concurrency: int
+        Initial number of concurrent requests. Default: 1
+    max_concurrency: int
+        Largest number of concurrent requests. Default: 4
+    decrease: float
+        Multiplicative decrease after an error. Default: 0.5
+    tolerance: float
+        Relative drop of the throughput that is still considered as stable.
+        Default: 0.1
+    backoff: float
+        First pause after an error in seconds, doubled at each consecutive
+        error. Default: 1
+    max_backoff: float
+        Longest pause after an error in seconds. Default: 60
+    clock: callable
+        Current time in seconds. Default: None, use `time.time`
+    """
+    def __init__(self, batch_size=200, min_batch_size=10, max_batch_size=1000,
+                 batch_step=100, concurrency=1, max_concurrency=4, decrease=0.5,
+                 tolerance=0.1, backoff=1., max_backoff=60., clock=None):
+        self.clock = time.time if clock is None else clock
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.batch_size = min(max(batch_size, min_batch_size), max_batch_size)
+        self.batch_step = batch_step
+        self.max_concurrency = max_concurrency
+        self.concurrency = min(max(concurrency, 1), max_concurrency)
+        self.decrease = decrease
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.n_success = 0
+        self.n_throttled = 0
+        self.n_failure = 0
+        self.n_objects = 0
+
+        self._resume_at = 0.
+        self._n_errors = 0
+        self._throughput = None
+        self._new_round()
+
+    def _new_round(self):
+        self._round_start = self.clock()
+        self._round_objects = 0
+        self._round_requests = 0
+
+    @property
+    def wait_time(self):
+        """
+        How long to wait before sending the next request, in seconds.
+        """
+        return max(0., self._resume_at - self.clock())
+
+    def success(self, n_objects, elapsed=None):
+        """
+        Report a successful request for `n_objects` objects.
+        """
+        self.n_success += 1
+        self.n_objects += n_objects
+        self._n_errors = 0
+        self._round_objects += n_objects
+        self._round_requests += 1
+        if self._round_requests < self.concurrency:
+            return
+
+        throughput = self._round_objects / max(self.clock() - self._round_start, 1e-3)
+        if self._throughput is None or throughput >= self._throughput * (1. - self.tolerance):
+            # Additive increase
+            self.batch_size = min(self.batch_size + self.batch_step, self.max_batch_size)
+            self.concurrency = min(self.concurrency + 1, self.max_concurrency)
+        else:
+            # More parallel requests only slow down the archive
+            self.concurrency = max(self.concurrency - 1, 1)
+        self._throughput = throughput
+        self._new_round()
+
+    def throttled(self, retry_after=None):
+        """
+        Report a request rejected by the archive because of the rate limit.
+        """
+        self.n_throttled += 1
+        self._back_off(retry_after)
+
+    def failure(self):
+        """
+        Report a failed request, e.g. a server error or a timeout.
+        """
+        self.n_failure += 1
+        self._back_off()
+
+    def _back_off(self, delay=None):
+        """
+        Multiplicative decrease, then pause for a while.
+        """
+        self.batch_size = max(int(self.batch_size * self.decrease), self.min_batch_size)
+        self.concurrency = max(int(self.concurrency * self.decrease), 1)
+
+        self._n_errors += 1
+        if delay is None:
+            delay = min(self.backoff * 2 ** (self._n_errors - 1), self.max_backoff)
+        self._resume_at = max(self._resume_at, self.clock() + delay)
+        self._throughput = None
+        self._new_round()
+
+    def summary(self):
+        """
+        Statistics of the requests.
+        """
+        return {'success': self.n_success, 'throttled': self.n_throttled,
+                'failure': self.n_failure, 'objects': self.n_objects,
+                'batch_size': self.batch_size, 'concurrency': self.concurrency}
+
+
+def plan_cutout_groups(ra, dec, w_half, h_half, max_size=2116., margin=2.):
+    """
+    Group nearby targets so that they can share one larger cutout.
+
+    Targets whose cutouts overlap are linked together (friends-of-friends).
+    Each linked group is then split along its longest side until its cutout
+    fits in `max_size` and covers fewer pixels than the individual cutouts of
+    its members. RA is measured from the circular mean of the targets and
+    wrapped into [-180, 180) deg around it, so targets on both sides of RA=0
+    are grouped like any others.
+
+    Parameters
+    ----------
+    ra, dec: array
+        Coordinates of the targets in degree.
+    w_half, h_half: float
+        Half width and half height of the cutout of a single target in arcsec.
+    max_size: float
+        Maximum full width or height of a cutout in arcsec. Default: 2116
+    margin: float
+        Extra margin around a group cutout in arcsec. Default: 2
+
+    Return
+    ------
+    groups: list
+        List of (ra, dec, w_half, h_half, members) of the cutouts, where
+        members are the indices of the targets in the cutout. Targets that
+        stay alone get their own cutout, with their own coordinates and size.
+    """
+    ra, dec = np.atleast_1d(ra).astype(float), np.atleast_1d(dec).astype(float)
+
+    # Local coordinates in arcsec, the unit is the size of a cutout
+    # Circular mean of RA, so that targets around RA=0 stay close to each other
+    ra_rad = np.deg2rad(ra)
+    ra_ref = np.rad2deg(np.arctan2(np.sin(ra_rad).mean(), np.cos(ra_rad).mean())) % 360.
+    d_ra = (ra - ra_ref + 180.) % 360. - 180.
+    x = d_ra * np.cos(np.deg2rad(dec)) * 3600.
+    y = dec * 3600.
+
+    # Cutouts overlap when their Chebyshev distance is below 1
+    tree = cKDTree(np.column_stack([x / (2. * w_half), y / (2. * h_half)]))
+    pairs = tree.query_pairs(1., p=np.inf, output_type='ndarray')
+    graph = coo_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])),
+                       shape=(len(ra), len(ra)))
+    _, labels = connected_components(graph, directed=False)
+
+    single_area = 4. * w_half * h_half
+    groups = []
+
+    def _split(members):
+        if len(members) == 1:
+            ii = members[0]
+            groups.append((ra[ii], dec[ii], w_half, h_half, members))
+            return
+
+        width = x[members].max() - x[members].min() + 2. * (w_half + margin)
+        height = y[members].max() - y[members].min() + 2. * (h_half + margin)
+        if max(width, height) <= max_size and width * height < len(members) * single_area:
+            ra_c = ra_ref + (d_ra[members].max() + d_ra[members].min()) / 2.
+            dec_c = (dec[members].max() + dec[members].min()) / 2.
+            w_group = np.max(
+                np.abs(d_ra[members] - (ra_c - ra_ref)) * np.cos(np.deg2rad(dec_c)) * 3600.)
+            h_group = np.max(np.abs(dec[members] - dec_c)) * 3600.
+            groups.append((ra_c % 360., dec_c, w_group + w_half + margin,
+                           h_group + h_half + margin, members))
+            return
+
+        # Split in two halves along the longest side
+        coord = x[members] if width >= height else y[members]
+        order = members[np.argsort(coord, kind='stable')]
+        _split(order[:len(order) // 2])
+        _split(order[len(order) // 2:])
+
+    order = np.argsort(labels, kind='stable')
+    bounds = np.flatnonzero(np.diff(labels[order])) + 1
+    for members in np.split(order, bounds):
+        _split(members)
+
+    return groups
+
+
+def cutout_stamps(hdu_list, ra, dec, w_half, h_half, pixel_scale=0.168):
+    """
+    Slice the cutouts of several targets out of a larger cutout.
+
+    All the image planes of `hdu_list` share the WCS of the first 2-D image.
+    The stamps have the size the archive would give to the cutout of a single
+    target, parts that are outside of `hdu_list` are filled with NaN (or 0
+    for integer planes). The WCS and the `LTV` keywords of the headers are
+    shifted accordingly.
+
+    Parameters
+    ----------
+    hdu_list: astropy.io.fits.HDUList
+        The large cutout.
+    ra, dec: array
+        Coordinates of the targets in degree.
+    w_half, h_half: float
+        Half width and half height of the stamps in arcsec.
+    pixel_scale: float
+        Pixel scale in arcsec. Default: 0.168
+
+    Return
+    ------
+    stamps: list of astropy.io.fits.HDUList
+    """
+    images = [hdu for hdu in hdu_list if hdu.data is not None and hdu.data.ndim == 2]
+    wcs = WCS(images[0].header)
+    x, y = wcs.all_world2pix(np.atleast_1d(ra), np.atleast_1d(dec), 0)
+
+    nx = 2 * int(round(w_half / pixel_scale)) + 1
+    ny = 2 * int(round(h_half / pixel_scale)) + 1
+
+    stamps = []
+    for xx, yy in zip(x, y):
+        x0 = int(round(xx)) - nx // 2
+        y0 = int(round(yy)) - ny // 2
+
+        hdus = []
+        for hdu in hdu_list:
+            if hdu.data is None or hdu.data.ndim != 2:
+                hdus.append(hdu.copy())
+                continue
+
+            fill = 0 if np.issubdtype(hdu.data.dtype, np.integer) else np.nan
+            data = np.full((ny, nx), fill, dtype=hdu.data.dtype)
+            ys, xs = hdu.data.shape
+            x1, x2 = max(x0, 0), min(x0 + nx, xs)
+            y1, y2 = max(y0, 0), min(y0 + ny, ys)
+            if x2 > x1 and y2 > y1:
+                data[y1 - y0:y2 - y0, x1 - x0:x2 - x0] = hdu.data[y1:y2, x1:x2]
+
+            header = hdu.header.copy()
+            for key, shift in [('CRPIX1', x0), ('CRPIX2', y0), ('CRPIX1A', x0),
+                               ('CRPIX2A', y0), ('LTV1', x0), ('LTV2', y0)]:
+                if key in header:
+                    header[key] = header[key] - shift
+            if hdus:
+                hdus.append(fits.ImageHDU(data=data, header=header, name=hdu.name))
+            else:
+                hdus.append(fits.PrimaryHDU(data=data, header=header))
+
+        stamps.append(fits.HDUList(hdus))
+
+    return stamps
+
+
+def iter_tar_members(fileobj, bufsize=1048576):
+    """
+    Iterate over the (name, content) of the files in a tar stream.
+
+    The tar file is read sequentially (`tarfile` stream mode), so `fileobj` can
+    be a non-seekable stream such as the raw body of a HTTP response, and
+    neither the tarball nor its members ever land on disk.
+
+    Parameters
+    ----------
+    fileobj: file-like object
+        The tar stream.
+    bufsize: int
+        Size of the read buffer in bytes. Default: 1 MB
+    """
+    with tarfile.open(fileobj=fileobj, mode='r|*', bufsize=bufsize) as tar:
+        for member in tar:
+            if member.isfile():
+                yield member.name, tar.extractfile(member).read()
+
+
+def _write_header(group, header):
+    """
+    Save the cards of a FITS header as attributes of a HDF5 group.
+    """
+    comment, history = [], []
+    for card in header.cards:
+        key = card.keyword.strip()
+        if key in ('', 'CONTINUE') or key in FITS_LAYOUT_KEYWORDS or key[:5] in FITS_TABLE_KEYWORDS:
+            continue
+        if key == 'COMMENT':
+            comment.append(str(card.value))
+        elif key == 'HISTORY':
+            history.append(str(card.value))
+        elif key not in ('CLASS', 'SUBCLASS', 'POSITION') and \
+                not isinstance(card.value, fits.card.Undefined):
+            group.attrs[key] = card.value
+            group.attrs[key + '_COMMENT'] = card.comment
+
+    string_dt = h5py.special_dtype(vlen=str)
+    if comment:
+        group.create_dataset('COMMENT', data=np.array(comment, dtype=object), dtype=string_dt)
+    if history:
+        group.create_dataset('HISTORY', data=np.array(history, dtype=object), dtype=string_dt)
+
+
+def write_fits_hdf(group, fits_file, **kwargs):
+    """
+    Write a FITS file into a HDF5 group in a single pass.
+
+    The layout is the same as the one of `fits2hdf` (HDFITS): one sub-group per
+    HDU, named after the extension, with the pixels in a `DATA` dataset and the
+    header cards as attributes. The FITS file is memory-mapped, so the pixels
+    go straight from the page cache to the HDF5 file.
+
+    Parameters
+    ----------
+    group: h5py.Group
+        The HDF5 group to write in, e.g. `output['object_id/HSC-I']`.
+    fits_file: str or file-like object
+        The FITS file.
+    **kwargs:
+        Passed to `h5py.Group.create_dataset`, e.g. compression.
+    """
+    group.attrs['CLASS'] = np.bytes_(['HDFITS'])
+
+    with fits.open(fits_file, memmap=True) as hdu_list:
+        for ii, hdu in enumerate(hdu_list):
+            name = hdu.name if hdu.name.strip() else 'HDU%d' % ii
+            hdu_group = group.create_group(name)
+            hdu_group.attrs['CLASS'] = np.bytes_(['HDU'])
+            hdu_group.attrs['POSITION'] = np.array([ii + 1])
+
+            if hdu.data is not None and not isinstance(hdu, fits.BinTableHDU):
+                dset = hdu_group.create_dataset('DATA', data=hdu.data, **kwargs)
+                dset.attrs['CLASS'] = np.bytes_(['IMAGE'])
+                dset.attrs['IMAGE_VERSION'] = np.bytes_(['1.2'])
+                if hdu.data.ndim == 2:
+                    dset.attrs['IMAGE_SUBCLASS'] = np.bytes_(['IMAGE_GRAYSCALE'])
+                    dset.attrs['IMAGE_MINMAXRANGE'] = np.array(
+                        [np.min(hdu.data), np.max(hdu.data)])
+            elif hdu.data is not None:
+                # Column-store table, one dataset per column
+                data_group = hdu_group.create_group('DATA')
+                data_group.attrs['CLASS'] = np.bytes_(['DATA_GROUP'])
+                for jj, col in enumerate(hdu.columns):
+                    dset = data_group.create_dataset(col.name, data=hdu.data[col.name], **kwargs)
+                    dset.attrs['CLASS'] = np.bytes_(['COLUMN'])
+                    dset.attrs['COLUMN_ID'] = np.array([jj])
+                    if col.unit:
+                        dset.attrs['UNITS'] = np.bytes_([col.unit])
+
+            _write_header(hdu_group, hdu.header)
+
+    return group
+
+
+class StackedCutoutWriter():
+    """
+    Write the cutouts of a bulk job as dense, stacked arrays.
+
+    Instead of one HDF5 group per object and filter, all the cutouts are
+    stored in a few chunked datasets, so that a mini-batch of objects can be
+    read with a single contiguous read:
+
+        - `object_id`: (N,) the object ids, in the order of the input table.
+        - `cutouts`: (N, n_filters, n_planes, H, W) float32 image and variance
+          planes, listed in the `planes` attribute.
+        - `mask`: (N, n_filters, H, W) int32 mask planes, if requested.
+        - `header`: (N, n_filters) FITS headers of the cutouts as strings, use
+          `astropy.io.fits.Header.fromstring` to read them.
+        - `shape`: (N, n_filters, 2) actual size of each cutout; cutouts smaller
+          than (H, W), e.g. at the edge of the survey, are padded with NaN.
+
+    Missing cutouts have an empty header and a shape of (0, 0). The `filters`
+    attribute of the file lists the filters in order. Cutouts are written one
+    at a time, so the output file should be opened with a chunk cache
+    (`rdcc_nbytes`) that can hold a few chunks.
+
+    Parameters
+    ----------
+    output: h5py.File
+        The output file, opened in write or append mode.
+    object_ids: array
+        Object ids of all the cutouts of the job.
+    filters: list
+        List of filters.
+    planes: list
+        List of the image planes, among 'IMAGE', 'MASK' and 'VARIANCE'.
+    chunks: int or tuple
+        Number of objects in one chunk, or the full shape of a chunk of the
+        `cutouts` dataset. Default: 1 object per chunk
+    compression: str
+        Compression filter of the datasets, e.g. 'gzip' or 'lzf'. Default: None
+    compression_opts:
+        Options of the compression filter. Default: None
+    """
+    FLOAT_PLANES = ('IMAGE', 'VARIANCE')
+
+    def __init__(self, output, object_ids, filters, planes=('IMAGE',), chunks=None,
+                 compression=None, compression_opts=None):
+        self.output = output
+        self.filters = list(filters)
+        self.planes = [p for p in self.FLOAT_PLANES if p in planes]
+        self.use_mask = 'MASK' in planes
+        self.n_objects = len(object_ids)
+
+        if chunks is None:
+            chunks = 1
+        self.chunks = chunks
+        # Keep the datasets open, closing one drops its chunk cache
+        self._datasets = {}
+        self.compression = compression
+        self.compression_opts = compression_opts
+
+        if 'object_id' in output:
+            # Resume writing into an existing file
+            if len(output['object_id']) != self.n_objects or \
+                    not np.all(output['object_id'][:] == np.asarray(object_ids)):
+                raise ValueError("# The object ids do not match the existing output!")
+            if [str(f) for f in output.attrs['filters']] != self.filters:
+                raise ValueError("# The filters do not match the existing output!")
+        else:
+            output.attrs['filters'] = np.array(self.filters, dtype=object)
+            output.create_dataset('object_id', data=np.asarray(object_ids, dtype='int64'))
+            output.create_dataset(
+                'header', shape=(self.n_objects, len(self.filters)),
+                dtype=h5py.special_dtype(vlen=str))
+            output.create_dataset(
+                'shape', shape=(self.n_objects, len(self.filters), 2), dtype='int32')
+
+    def _chunks(self, shape):
+        """
+        Chunk shape of a dataset.
+        """
+        if isinstance(self.chunks, tuple):
+            # The shape of the chunk is given for the `cutouts` dataset
+            if len(shape) == len(self.chunks):
+                return tuple(min(c, s) for c, s in zip(self.chunks, shape))
+            return tuple(min(c, s) for c, s in zip(self.chunks[:2] + self.chunks[3:], shape))
+        return (min(self.chunks, self.n_objects),) + shape[1:]
+
+    def _dataset(self, name, plane_shape, dtype, fillvalue):
+        """
+        Get a stacked dataset, create it or make it larger if necessary.
+        """
+        n_planes = (len(self.planes),) if name == 'cutouts' else ()
+        shape = (self.n_objects, len(self.filters)) + n_planes
+
+        if name in self._datasets:
+            dset = self._datasets[name]
+        elif name in self.output:
+            dset = self._datasets[name] = self.output[name]
+        else:
+            dset = self.output.create_dataset(
+                name, shape=shape + plane_shape, dtype=dtype,
+                maxshape=shape + (None, None), chunks=self._chunks(shape + plane_shape),
+                fillvalue=fillvalue, compression=self.compression,
+                compression_opts=self.compression_opts)
+            if name == 'cutouts':
+                dset.attrs['planes'] = np.array(self.planes, dtype=object)
+            self._datasets[name] = dset
+            return dset
+
+        if dset.shape[-2] < plane_shape[0] or dset.shape[-1] < plane_shape[1]:
+            dset.resize(shape + (max(dset.shape[-2], plane_shape[0]),
+                                 max(dset.shape[-1], plane_shape[1])))
+        return dset
+
+    def write(self, index, filt, fits_file):
+        """
+        Write the cutout of one object in one filter.
+
+        Parameters
+        ----------
+        index: int
+            Index of the object in `object_ids`.
+        filt: str
+            Filter of the cutout.
+        fits_file: str or file-like object
+            The FITS file of the cutout.
+        """
+        jj = self.filters.index(filt)
+
+        with fits.open(fits_file, memmap=True) as hdu_list:
+            hdus = {hdu.name: hdu for hdu in hdu_list if hdu.data is not None}
+            first = hdus[self.planes[0]] if self.planes else hdus['MASK']
+            ny, nx = first.data.shape
+
+            if self.planes:
+                cube = np.full((len(self.planes), ny, nx), np.nan, dtype='float32')
+                for kk, plane in enumerate(self.planes):
+                    cube[kk] = hdus[plane].data
+                dset = self._dataset('cutouts', (ny, nx), 'float32', np.nan)
+                # Pad cutouts that are smaller than the others
+                if dset.shape[-2:] != (ny, nx):
+                    padded = np.full((len(self.planes),) + dset.shape[-2:], np.nan, dtype='float32')
+                    padded[:, :ny, :nx] = cube
+                    cube = padded
+                dset[index, jj] = cube
+
+            if self.use_mask:
+                dset = self._dataset('mask', (ny, nx), 'int32', 0)
+                mask = np.zeros(dset.shape[-2:], dtype='int32')
+                mask[:ny, :nx] = hdus['MASK'].data
+                dset[index, jj] = mask
+
+            self.output['header'][index, jj] = first.header.tostring()
+            self.output['shape'][index, jj] = (ny, nx)
+
+    def clear(self, index):
+        """
+        Forget about the cutouts of one object, e.g. when they are corrupted.
+        """
+        self.output['header'][index] = [''] * len(self.filters)
+        self.output['shape'][index] = 0
+
+
+class CutoutManifest():
+    """
+    Persistent record of the progress of a bulk cutout job.
+
+    The manifest is a SQLite database that records, for every object and
+    filter, where the downloaded cutout is stored, its checksum, and whether it
+    has been merged into the final output. It can be shared by several
+    processes, so a job that is interrupted can resume where it stopped.
+
+    Parameters
+    ----------
+    manifest_file: str
+        Location of the SQLite database.
+    timeout: float
+        How long to wait for a lock held by another process. Default: 60 sec
+    """
+    # Status of a cutout
+    DONE = 'done'
+    MERGED = 'merged'
+
+    def __init__(self, manifest_file, timeout=60.):
+        self.manifest_file = manifest_file
+        self.timeout = timeout
+
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cutouts ("
+                "object_id INTEGER NOT NULL, filter TEXT NOT NULL, batch INTEGER, "
+                "path TEXT, checksum TEXT, status TEXT NOT NULL, "
+                "PRIMARY KEY (object_id, filter))")
+
+    def _connect(self):
+        """
+        Open a new connection, so the manifest can be used by different processes.
+        """
+        return sqlite3.connect(self.manifest_file, timeout=self.timeout)
+
+    def _query(self, sql, ids, *args):
+        """
+        Run a query with a `IN (ids)` clause over a potentially long list of ids.
+        """
+        ids = [int(i) for i in ids]
+        rows = []
+        with self._connect() as conn:
+            # SQLite has a limit on the number of variables in a query
+            for start in range(0, len(ids), 900):
+                chunk = ids[start:start + 900]
+                rows += conn.execute(
+                    sql.format(','.join('?' * len(chunk))), list(args) + chunk).fetchall()
+        return rows
+
+    def missing(self, ids, filt):
+        """
+        List of object ids that do not have a usable cutout in one filter yet.
+        """
+        found = self._query(
+            "SELECT object_id, path, status FROM cutouts WHERE filter = ? AND object_id IN ({})",
+            ids, filt)
+        available = set(
+            object_id for object_id, path, status in found
+            if status == self.MERGED or (path is not None and os.path.isfile(path)))
+        return [i for i in ids if int(i) not in available]
+
+    def add(self, records):
+        """
+        Record downloaded cutouts.
+
+        Parameters
+        ----------
+        records: list
+            List of (object_id, filter, batch, path, checksum).
+        """
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO cutouts VALUES (?, ?, ?, ?, ?, ?)",
+                [(int(object_id), filt, int(batch), path, checksum, self.DONE)
+                 for object_id, filt, batch, path, checksum in records])
+
+    def get(self, object_id, filt):
+        """
+        Return (path, checksum, status) of a cutout, or None.
+        """
+        with self._connect() as conn:
+            return conn.execute(
+                "SELECT path, checksum, status FROM cutouts WHERE object_id = ? AND filter = ?",
+                (int(object_id), filt)).fetchone()
+
+    def remove(self, object_id, filt):
+        """
+        Forget a cutout, e.g. when it turns out to be corrupted.
+        """
+        with self._connect() as conn:
+            conn.execute("DELETE FROM cutouts WHERE object_id = ? AND filter = ?",
+                         (int(object_id), filt))
+
+    def merged_cutouts(self, ids):
+        """
+        Set of the (object_id, filter) of the cutouts already merged into the output.
+        """
+        rows = self._query(
+            "SELECT object_id, filter FROM cutouts WHERE status = ? AND object_id IN ({})",
+            ids, self.MERGED)
+        return set((object_id, filt) for object_id, filt in rows)
+
+    def merged(self, ids, filters):
+        """
+        Set of the object ids whose cutouts in all the filters are merged into the output.
+        """
+        done = self.merged_cutouts(ids)
+        return set(int(i) for i in ids if all((int(i), f) in done for f in filters))
+
+    def mark_merged(self, cutouts):
+        """
+        Record that cutouts are in the final output.
+
+        Parameters
+        ----------
+        cutouts: list
+            List of (object_id, filter).
+        """
+        with self._connect() as conn:
+            conn.executemany(
+                "UPDATE cutouts SET status = ? WHERE object_id = ? AND filter = ?",
+                [(self.MERGED, int(object_id), filt) for object_id, filt in cutouts])
+
+    def reset_merged(self):
+        """
+        Forget about the final output, e.g. when it is going to be overwritten.
+        """
+        with self._connect() as conn:
+            conn.execute("UPDATE cutouts SET status = ? WHERE status = ?",
+                         (self.DONE, self.MERGED))
+
+    def summary(self):
+        """
+        Number of cutouts in each status.
+        """
+        with self._connect() as conn:
+            return dict(conn.execute(
+                "SELECT status, COUNT(*) FROM cutouts GROUP BY status").fetchall())
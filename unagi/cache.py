@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Local caches for data downloaded from the HSC archive"""
+
+import os
+import json
+import shutil
+import time
+import hashlib
+import tempfile
+import threading
+
+import h5py
+
+from astropy.table import Table
+
+from .query import normalize_sql
+
+__all__ = ['DiskCache', 'CutoutCache', 'QueryCache']
+
+
+class DiskCache():
+    """
+    Size-capped, content-addressed on-disk cache with LRU eviction.
+
+    Each entry is stored in its own file named after the SHA1 hash of the
+    request it belongs to. The modification time of a file is refreshed on
+    every hit, so the least recently used entries are removed first once the
+    total size goes over `max_size`, until it is below `low_water * max_size`.
+    The margin means that a full cache is only scanned again after a good
+    fraction of it has been replaced, not at every new entry. Files are written to a temporary name
+    and then renamed, so a crash never leaves a truncated entry behind.
+
+    Parameters
+    ----------
+    cache_dir: str
+        Directory of the cache.
+    max_size: int
+        Maximum total size of the cache in bytes. Default: 2 GB
+    suffix: str
+        Suffix of the cached files. Default: ''
+    low_water: float
+        Fraction of `max_size` the eviction goes down to. Default: 0.9
+    """
+    def __init__(self, cache_dir, max_size=2 * 1024 ** 3, suffix='', low_water=0.9):
+        self.cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+        self.max_size = max_size
+        self.suffix = suffix
+        self.low_water = low_water
+
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._size = sum(os.path.getsize(f) for f, _ in self._entries())
+
+    @staticmethod
+    def make_key(*request):
+        """
+        Generate the key of a request from JSON-serializable components.
+        """
+        return hashlib.sha1(
+            json.dumps(request, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        """
+        Location of the file for a key.
+        """
+        return os.path.join(self.cache_dir, key[:2], key + self.suffix)
+
+    def _entries(self):
+        """
+        List of (file, modification time) of all entries in the cache.
+        """
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith(self.suffix) and not name.startswith('.'):
+                    path = os.path.join(root, name)
+                    try:
+                        entries.append((path, os.path.getmtime(path)))
+                    except OSError:
+                        pass
+        return entries
+
+    @property
+    def size(self):
+        """
+        Total size of the cache in bytes.
+        """
+        return self._size
+
+    def info(self):
+        """
+        Summary of the status of the cache.
+        """
+        return {'cache_dir': self.cache_dir, 'size': self._size,
+                'max_size': self.max_size, 'hits': self.hits, 'misses': self.misses}
+
+    def __contains__(self, key):
+        return os.path.isfile(self._path(key))
+
+    def get(self, key):
+        """
+        Return the cached content of a key, or None if it is not in the cache.
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                content = f.read()
+            # Mark this entry as the most recently used
+            os.utime(path, None)
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        return content
+
+    def get_file(self, key, file_path):
+        """
+        Copy the cached file of a key to `file_path` without reading it into memory.
+
+        Return False if the key is not in the cache.
+        """
+        path = self._path(key)
+        try:
+            shutil.copyfile(path, file_path)
+            os.utime(path, None)
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return False
+
+        with self._lock:
+            self.hits += 1
+        return True
+
+    def put_file(self, key, file_path):
+        """
+        Save a copy of a file into the cache.
+        """
+        return self._atomic_write(key, lambda tmp_path: shutil.copyfile(file_path, tmp_path))
+
+    def put(self, key, content):
+        """
+        Save the content (bytes) of a key into the cache.
+        """
+        def _write(tmp_path):
+            with open(tmp_path, 'wb') as f:
+                f.write(content)
+
+        return self._atomic_write(key, _write)
+
+    def _atomic_write(self, key, write_func):
+        """
+        Call write_func(tmp_path) to create the file, then move it into place.
+        """
+        path = self._path(key)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Atomic write: write to a temporary file first, then rename it
+        fd, tmp_path = tempfile.mkstemp(
+            prefix='.', suffix=self.suffix, dir=os.path.dirname(path))
+        os.close(fd)
+        try:
+            write_func(tmp_path)
+            new_size = os.path.getsize(tmp_path)
+            old_size = os.path.getsize(path) if os.path.isfile(path) else 0
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        with self._lock:
+            self._size += new_size - old_size
+            if self._size > self.max_size:
+                self._evict()
+
+        return path
+
+    def _evict(self):
+        """
+        Remove the least recently used entries until the cache is below the low-water mark.
+        """
+        entries = sorted(self._entries(), key=lambda entry: entry[1])
+        sizes = [os.path.getsize(f) for f, _ in entries]
+        # The cache can be shared with other processes, start from the actual size
+        self._size = sum(sizes)
+        if self._size <= self.max_size:
+            return
+
+        for (path, _), size in zip(entries, sizes):
+            if self._size <= self.low_water * self.max_size:
+                break
+            try:
+                os.remove(path)
+                self._size -= size
+            except OSError:
+                pass
+
+    def remove(self, key):
+        """
+        Remove an entry from the cache.
+        """
+        path = self._path(key)
+        if os.path.isfile(path):
+            with self._lock:
+                self._size -= os.path.getsize(path)
+                os.remove(path)
+
+    def clear(self):
+        """
+        Remove all the entries in the cache.
+        """
+        with self._lock:
+            for path, _ in self._entries():
+                os.remove(path)
+            self._size = 0
+
+
+class CutoutCache(DiskCache):
+    """
+    On-disk cache for FITS cutout images and PSF models.
+
+    The key of an entry is made of the data release and the query string of
+    the cutout or PSF request, which already contains the canonical form of the
+    rerun, filter, image type, coordinates (rounded to 1e-4 deg), image size and
+    image planes.
+
+    Parameters
+    ----------
+    cache_dir: str
+        Directory of the cache.
+    max_size: int
+        Maximum total size of the cache in bytes. Default: 2 GB
+    """
+    def __init__(self, cache_dir, max_size=2 * 1024 ** 3):
+        super(CutoutCache, self).__init__(cache_dir, max_size=max_size, suffix='.fits')
+
+    def url_key(self, dr, url):
+        """
+        Generate the key of a cutout or PSF request.
+        """
+        service, _, params = url.partition('?')
+        return self.make_key(dr, os.path.basename(service), sorted(params.split('&')))
+
+
+class QueryCache(DiskCache):
+    """
+    On-disk cache for the results of SQL queries.
+
+    The key of an entry is made of the data release, the rerun and the
+    normalized SQL string (see `unagi.query.normalize_sql`), so queries that
+    only differ in whitespace, comments or the case of keywords share the same
+    entry. Results are saved as HDF5 tables, which are much faster to read
+    than the FITS files returned by the archive.
+
+    Parameters
+    ----------
+    cache_dir: str
+        Directory of the cache.
+    max_size: int
+        Maximum total size of the cache in bytes. Default: 10 GB
+    ttl: float
+        Time-to-live of an entry in seconds, None means forever. Default: 30 days
+    """
+    TIME_ATTR = 'unagi_cached_at'
+
+    def __init__(self, cache_dir, max_size=10 * 1024 ** 3, ttl=30 * 86400.):
+        super(QueryCache, self).__init__(cache_dir, max_size=max_size, suffix='.hdf5')
+        self.ttl = ttl
+
+    def sql_key(self, dr, rerun, sql):
+        """
+        Generate the key of a SQL query.
+        """
+        return self.make_key(dr, rerun, normalize_sql(sql))
+
+    def get_table(self, key):
+        """
+        Return the cached table of a key, or None if it is missing or expired.
+        """
+        path = self._path(key)
+        try:
+            with h5py.File(path, 'r') as f:
+                cached_at = f.attrs[self.TIME_ATTR]
+            if self.ttl is not None and time.time() - cached_at > self.ttl:
+                self.remove(key)
+                raise OSError("Expired cache entry: {}".format(path))
+            table = Table.read(path, path='data')
+            # Mark this entry as the most recently used
+            os.utime(path, None)
+        except (OSError, KeyError):
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        return table
+
+    def put_table(self, key, table):
+        """
+        Save a table into the cache.
+        """
+        def _write(tmp_path):
+            table.write(tmp_path, path='data', format='hdf5',
+                        serialize_meta=True, overwrite=True)
+            with h5py.File(tmp_path, 'a') as f:
+                f.attrs[self.TIME_ATTR] = time.time()
+
+        return self._atomic_write(key, _write)
@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Local store of HSC catalogs, kept in sync with the archive tract by tract"""
+
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import tempfile
+
+import numpy as np
+
+from astropy.table import Table, MaskedColumn, vstack
+
+from . import query
+from .skymap import RingsSkyMap
+
+__all__ = ['CatalogStore']
+
+
+class CatalogStore():
+    """
+    Local copy of the catalog of a rerun, partitioned by tract.
+
+    Every tract is kept in its own HDF5 file, `<root>/<rerun>/<selection>/tract_<tract>.h5`,
+    where the selection is 'primary' or 'all', followed by '_clean' for clean
+    objects and by a hash of the extra WHERE conditions. A SQLite database,
+    `<root>/<rerun>/catalog.db`, records which box regions of which tracts have
+    been fetched, and with which columns.
+
+    `box_search` only submits SQL searches for the tracts that are missing from
+    the store, or for the columns that have not been fetched yet, then merges
+    the new objects and columns into the tract files. Repeated searches of the
+    same region do not contact the archive at all.
+
+    Examples
+    --------
+
+        >>> catalog = CatalogStore('hsc_catalog', rerun='pdr2_wide')
+        >>> objects = catalog.box_search(archive, 149.9, 150.3, 2.0, 2.4, cmodel=True)
+        >>> # Only the new aperture photometry columns are queried
+        >>> objects = catalog.box_search(archive, 149.9, 150.3, 2.0, 2.4, aper=True)
+
+    Parameters
+    ----------
+    root: str
+        Root directory of the store.
+    rerun: str
+        Name of the rerun. Default: 'pdr2_wide'
+    skymap: unagi.skymap.RingsSkyMap
+        Skymap model of the rerun. Default: the HSC `RingsSkyMap`.
+    timeout: float
+        How long to wait for a lock of the database held by another process. Default: 60 sec
+    """
+    def __init__(self, root, rerun='pdr2_wide', skymap=None, timeout=60.):
+        self.root = root
+        self.rerun = rerun
+        self.skymap = RingsSkyMap() if skymap is None else skymap
+        self.timeout = timeout
+
+        if not os.path.isdir(os.path.join(root, rerun)):
+            os.makedirs(os.path.join(root, rerun), exist_ok=True)
+        self.db_file = os.path.join(root, rerun, 'catalog.db')
+
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS regions ("
+                "tract INTEGER NOT NULL, selection TEXT NOT NULL, ra1 REAL NOT NULL, "
+                "ra2 REAL NOT NULL, dec1 REAL NOT NULL, dec2 REAL NOT NULL, "
+                "columns TEXT NOT NULL, fetched REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS regions_tract ON regions (tract, selection)")
+
+    def _connect(self):
+        """
+        Open a new connection, so the store can be used by different processes.
+        """
+        return sqlite3.connect(self.db_file, timeout=self.timeout)
+
+    @staticmethod
+    def selection(primary=True, clean=False, where_list=None):
+        """
+        Name of the selection of objects, e.g. 'primary_clean'.
+        """
+        name = 'primary' if primary else 'all'
+        if clean:
+            name += '_clean'
+        if where_list:
+            where_str = query.normalize_sql(' AND '.join(where_list))
+            name += '_' + hashlib.sha1(where_str.encode('utf-8')).hexdigest()[:8]
+        return name
+
+    def path(self, tract, selection='primary'):
+        """
+        Location of the catalog of a tract.
+        """
+        return os.path.join(
+            self.root, self.rerun, selection, 'tract_{}.h5'.format(int(tract)))
+
+    def read(self, tract, selection='primary'):
+        """
+        Read the catalog of a tract, return None if it is not in the store.
+        """
+        file_name = self.path(tract, selection)
+        if not os.path.isfile(file_name):
+            return None
+        return Table.read(file_name, path='catalog')
+
+    def _write(self, tract, selection, objects):
+        """
+        Atomic write of the catalog of a tract.
+        """
+        file_name = self.path(tract, selection)
+        if not os.path.isdir(os.path.dirname(file_name)):
+            os.makedirs(os.path.dirname(file_name), exist_ok=True)
+
+        fd, tmp_file = tempfile.mkstemp(prefix='.', suffix='.h5', dir=os.path.dirname(file_name))
+        os.close(fd)
+        try:
+            objects.write(tmp_file, path='catalog', format='hdf5', serialize_meta=True,
+                          overwrite=True)
+            os.replace(tmp_file, file_name)
+        finally:
+            if os.path.isfile(tmp_file):
+                os.remove(tmp_file)
+
+    def regions(self, tract=None, selection=None):
+        """
+        Table of the fetched regions of the tracts.
+        """
+        where, args = [], []
+        if tract is not None:
+            where.append("tract = ?")
+            args.append(int(tract))
+        if selection is not None:
+            where.append("selection = ?")
+            args.append(selection)
+
+        sql = "SELECT tract, selection, ra1, ra2, dec1, dec2, columns, fetched FROM regions"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        with self._connect() as conn:
+            rows = conn.execute(sql + " ORDER BY tract, fetched", args).fetchall()
+
+        return Table(rows=rows if rows else None,
+                     names=['tract', 'selection', 'ra1', 'ra2', 'dec1', 'dec2', 'columns',
+                            'fetched'],
+                     dtype=['int64', 'U64', 'float64', 'float64', 'float64', 'float64',
+                            'U4096', 'float64'])
+
+    def fetched_columns(self, tract, box, selection='primary'):
+        """
+        Columns available for all the objects of a tract in a box region.
+
+        Return None if no fetched region of the tract contains the box.
+        """
+        best = None
+        for region in self.regions(tract=tract, selection=selection):
+            if not query.box_contains(
+                    (region['ra1'], region['ra2'], region['dec1'], region['dec2']), box):
+                continue
+            # Every region that contains the box has all its columns for these objects
+            best = (best or set()) | set(json.loads(region['columns']))
+        return best
+
+    def _add_region(self, tract, box, selection, columns):
+        """
+        Record a fetched region of a tract.
+        """
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO regions VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (int(tract), selection, float(box[0]), float(box[1]), float(box[2]),
+                 float(box[3]), json.dumps(sorted(columns)), time.time()))
+
+    def merge(self, tract, objects, selection='primary', update_only=False):
+        """
+        Merge objects into the catalog of a tract.
+
+        The columns of the objects already in the store are updated, new
+        columns are added (masked for the objects that do not have them), and
+        new objects are appended unless `update_only` is True.
+        """
+        catalog = self.read(tract, selection)
+        if catalog is None:
+            if update_only:
+                return None
+            self._write(tract, selection, objects)
+            return objects
+
+        ids = np.asarray(catalog['object_id'])
+        new_ids = np.asarray(objects['object_id'])
+        sorter = np.argsort(ids)
+        index = np.clip(np.searchsorted(ids, new_ids, sorter=sorter), 0, max(len(ids) - 1, 0))
+        found = (ids[sorter[index]] == new_ids) if len(ids) else np.zeros(len(new_ids), bool)
+        rows = sorter[index[found]]
+
+        for name in objects.colnames:
+            if name == 'object_id':
+                continue
+            if name not in catalog.colnames:
+                column = objects[name]
+                catalog[name] = MaskedColumn(
+                    np.zeros((len(catalog), ) + column.shape[1:], dtype=column.dtype),
+                    mask=True, unit=column.unit, description=column.description)
+            # Assigning to a masked column unmasks the updated objects
+            catalog[name][rows] = objects[name][found]
+
+        if not update_only and not found.all():
+            catalog = vstack([catalog, objects[~found]], join_type='outer',
+                             metadata_conflicts='silent')
+
+        self._write(tract, selection, catalog)
+        return catalog
+
+    def box_search(self, archive, ra1, ra2, dec1, dec2, primary=True, clean=False,
+                   where_list=None, verbose=True, **kwargs):
+        """
+        Search for objects within a box area, only querying the archive for what is missing.
+
+        The tracts that overlap the box are found with the local skymap model.
+        Tracts that need the same columns are searched together, with a
+        `tract IN (...)` condition, and the results are merged into the store.
+
+        Parameters
+        ----------
+        archive: unagi.hsc.Hsc
+            The HSC archive object.
+        ra1, ra2, dec1, dec2: float
+            Boundaries of the box in degree, following boxSearch().
+        primary, clean, where_list:
+            Selection of the objects, see `unagi.query.box_search`.
+        kwargs:
+            Columns to search for, e.g. `cmodel`, `aper` or `meas`, see
+            `unagi.query.search_columns`.
+
+        Return
+        ------
+            `astropy.table.Table` of the objects in the box.
+        """
+        if archive.rerun != self.rerun:
+            raise ValueError("# The store is for rerun {}, not {}".format(
+                self.rerun, archive.rerun))
+
+        # Wrap the box into [0, 360] deg, ra1 > ra2 when it crosses RA=360 deg
+        box = query.wrap_ra_range(ra1, ra2) + (dec1, dec2)
+        selection = self.selection(primary=primary, clean=clean, where_list=where_list)
+        columns = list(query.search_columns(archive.rerun, **kwargs))
+        tracts = [int(t) for t in self.skymap.box_tracts(*box)]
+
+        # Group the tracts by the columns they miss
+        groups = {}
+        for tract in tracts:
+            fetched = self.fetched_columns(tract, box, selection=selection)
+            missing = [name for name in columns if fetched is None or name not in fetched]
+            if missing:
+                key = (tuple(missing), fetched is None)
+                groups.setdefault(key, []).append(tract)
+
+        for (missing, new_region), group in groups.items():
+            if verbose:
+                print("# Search for {} columns in tract(s) {}".format(
+                    len(missing), ', '.join(map(str, group))))
+            sql = query.box_search(
+                *box, primary=primary, clean=clean, archive=archive, where_list=where_list,
+                tracts=group, columns=None if new_region else list(missing), **kwargs)
+            objects = archive.sql_query(sql, verbose=verbose)
+            if objects is None:
+                raise IOError("# The SQL search of tract(s) {} failed".format(group))
+
+            for tract in group:
+                fetched = self.fetched_columns(tract, box, selection=selection)
+                # New columns are only joined onto the objects already in the store
+                self.merge(tract, objects[objects['tract'] == tract], selection=selection,
+                           update_only=not new_region)
+                self._add_region(tract, box, selection,
+                                 set(columns) | (fetched or set()))
+        if not groups and verbose:
+            print("# All {} tract(s) are already in the store".format(len(tracts)))
+
+        # Gather the objects in the box from the store
+        results = []
+        for tract in tracts:
+            catalog = self.read(tract, selection)
+            if catalog is None or len(catalog) == 0:
+                continue
+            catalog = catalog[query.in_tile(catalog['ra'], catalog['dec'], box, box)]
+            results.append(catalog[columns])
+
+        if not results:
+            return Table(names=columns)
+        return vstack(results, metadata_conflicts='silent')
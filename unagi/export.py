@@ -0,0 +1,408 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Compact and export the catalogs returned by the HSC archive"""
+
+import os
+import json
+import fnmatch
+from collections import OrderedDict
+
+import numpy as np
+
+import h5py
+
+from astropy.io import fits
+from astropy.table import Table, Column, MaskedColumn
+
+__all__ = ['CompactPlan', 'compact_table', 'export_fits_table', 'export_format', 'pack_flags',
+           'unpack_flags', 'FORMATS', 'ERROR_COLUMNS', 'COORD_COLUMNS', 'FLAG_COLUMNS']
+
+# Output formats from the extension of the file
+FORMATS = {'.parquet': 'parquet', '.pq': 'parquet', '.arrow': 'arrow', '.feather': 'arrow',
+           '.ipc': 'arrow', '.h5': 'hdf5', '.hdf5': 'hdf5'}
+
+# Uncertainties, safe to store in single precision
+ERROR_COLUMNS = ['*err', '*err_*', '*err[0-9]*', '*sigma', '*sigma_*']
+
+# Coordinates, always kept in double precision
+COORD_COLUMNS = ['ra', 'dec', '*_ra', '*_dec', 'coord*']
+
+# Boolean flags of the measurements and of the pixel mask
+FLAG_COLUMNS = ['*_flag', '*_flag_*', '*_pixelflags', '*_pixelflags_*']
+
+# Suffix of the columns that flag the NULL values of another column
+NULL_SUFFIX = '_isnull'
+
+# Metadata key of the list of packed flags
+FLAG_KEY = 'unagi_flags'
+
+
+def _match(name, patterns):
+    """Whether a column name matches any of the patterns."""
+    return any(fnmatch.fnmatchcase(name, pattern) for pattern in patterns)
+
+
+def pack_flags(arrays, names):
+    """
+    Pack up to 64 boolean arrays into the bits of one `uint64` array.
+
+    Bit `i` of the result is `arrays[names[i]]`.
+    """
+    packed = np.zeros(len(arrays[names[0]]), dtype=np.uint64)
+    for bit, name in enumerate(names):
+        packed |= np.asarray(arrays[name]).astype(np.uint64) << np.uint64(bit)
+    return packed
+
+
+def unpack_flags(packed, names):
+    """
+    Unpack a bitfield column made by `pack_flags`, return a dict of boolean arrays.
+
+    Parameters
+    ----------
+    packed: array
+        The packed column.
+    names: list
+        Names of the flags, in the order of the bits, e.g. from the `unagi_flags`
+        metadata of the exported file.
+    """
+    packed = np.asarray(packed, dtype=np.uint64)
+    return OrderedDict(
+        (name, (packed >> np.uint64(bit)) & np.uint64(1) == 1) for bit, name in enumerate(names))
+
+
+def export_format(output_file, format=None):
+    """
+    Format of an output file, from its extension if `format` is None.
+    """
+    if format is None:
+        format = FORMATS.get(os.path.splitext(output_file)[1].lower())
+    if format not in ('parquet', 'arrow', 'hdf5'):
+        raise ValueError("# Unknown output format: {}, use one of parquet, arrow or hdf5".format(
+            format))
+    return format
+
+
+class CompactPlan():
+    """
+    How to project and compact the columns of a catalog.
+
+    The same plan is applied to every chunk of a large catalog, so that all the
+    chunks end up with the same columns and dtypes.
+
+    Parameters
+    ----------
+    names: list
+        Names of the columns of the catalog.
+    dtypes: list
+        Dtypes of the columns of the catalog.
+    columns: list
+        Columns to keep, can use wildcards such as `i_cmodel_*`. The `_isnull`
+        companions of the selected columns are used as masks. Default: None, keep all.
+    downcast: bool, str or list
+        Which float64 columns to store as float32: 'errors' for the uncertainties
+        (see `ERROR_COLUMNS`), True or 'all' for everything except the coordinates
+        (see `COORD_COLUMNS`), or a list of patterns. Default: None
+    pack_flags: bool, str or list
+        Pack boolean columns into `uint64` bitfield columns named `flags`,
+        `flags_1`, ...: True for the flags (see `FLAG_COLUMNS`), 'all' for all
+        the boolean columns, or a list of patterns. The names of the flags in
+        each bitfield are kept in `self.flags`. Default: False
+    """
+    def __init__(self, names, dtypes, columns=None, downcast=None, pack_flags=False):
+        # Compare the dtypes in native byte order, FITS data is big-endian
+        dtypes = OrderedDict(
+            (name, np.dtype(dtype).newbyteorder('=')) for name, dtype in zip(names, dtypes))
+        values = [name for name in names if not name.endswith(NULL_SUFFIX)]
+
+        # Column projection
+        if columns is None:
+            selected = values
+        else:
+            columns = [columns] if isinstance(columns, str) else list(columns)
+            selected = []
+            for pattern in columns:
+                found = [name for name in values if fnmatch.fnmatchcase(name, pattern)]
+                if not found:
+                    raise KeyError("# Unknown column: {}".format(pattern))
+                selected += [name for name in found if name not in selected]
+
+        # NULL masks from the _isnull companions
+        self.masks = OrderedDict(
+            (name, name + NULL_SUFFIX) for name in selected if name + NULL_SUFFIX in dtypes)
+
+        # Float64 columns to downcast
+        if downcast is None or downcast is False:
+            patterns = None
+        elif downcast == 'errors':
+            patterns = ERROR_COLUMNS
+        elif downcast is True or downcast == 'all':
+            patterns = ['*']
+        else:
+            patterns = [downcast] if isinstance(downcast, str) else list(downcast)
+        self.downcast = set(
+            name for name in selected
+            if patterns is not None and dtypes[name] == np.float64 and
+            _match(name, patterns) and not _match(name, COORD_COLUMNS))
+
+        # Boolean flags to pack, 64 per column
+        self.flags = OrderedDict()
+        if pack_flags:
+            if pack_flags is True:
+                patterns = FLAG_COLUMNS
+            elif pack_flags == 'all':
+                patterns = ['*']
+            else:
+                patterns = [pack_flags] if isinstance(pack_flags, str) else list(pack_flags)
+            flags = [name for name in selected
+                     if dtypes[name] == np.bool_ and _match(name, patterns)]
+            for ii, start in enumerate(range(0, len(flags), 64)):
+                self.flags['flags' if ii == 0 else 'flags_{}'.format(ii)] = flags[start:start + 64]
+
+        packed = set(name for group in self.flags.values() for name in group)
+        self.columns = [name for name in selected if name not in packed] + list(self.flags)
+        # Columns to read from the catalog
+        self.read = selected + list(self.masks.values())
+
+    @property
+    def metadata(self):
+        """
+        Metadata to keep with the compacted catalog.
+        """
+        return {FLAG_KEY: json.dumps(self.flags)} if self.flags else {}
+
+    def apply(self, arrays):
+        """
+        Compact one chunk of the catalog.
+
+        Parameters
+        ----------
+        arrays: dict
+            Arrays of (at least) the columns in `self.read`.
+
+        Return
+        ------
+        columns: OrderedDict
+            Arrays of the compacted columns, in the order of `self.columns`.
+        masks: dict
+            Boolean NULL masks of the columns that have one.
+        """
+        columns = OrderedDict()
+        for name in self.columns:
+            if name in self.flags:
+                columns[name] = pack_flags(arrays, self.flags[name])
+                continue
+
+            data = np.asarray(arrays[name])
+            # FITS data is big-endian
+            if data.dtype.byteorder not in ('=', '|'):
+                data = data.astype(data.dtype.newbyteorder('='))
+            if name in self.downcast:
+                data = data.astype(np.float32)
+            columns[name] = data
+
+        masks = {name: np.asarray(arrays[null], dtype=bool) for name, null in self.masks.items()}
+        return columns, masks
+
+
+def compact_table(table, columns=None, downcast=None, pack_flags=False, mask_null=False):
+    """
+    Project and compact a catalog, e.g. the result of a SQL query.
+
+    Only the compacted columns are copied, so the result is much smaller than a
+    table with all the columns of the archive at their original dtypes.
+
+    Parameters
+    ----------
+    table: astropy.table.Table
+        The catalog, with the `_isnull` columns of the archive.
+    columns, downcast, pack_flags:
+        See `CompactPlan`.
+    mask_null: bool
+        Turn the `_isnull` companions into the masks of their columns; otherwise
+        they are dropped. Default: False
+
+    Return
+    ------
+        `astropy.table.Table`, with the names of the packed flags in the
+        `unagi_flags` metadata (see `unpack_flags`).
+    """
+    plan = CompactPlan(table.colnames, [table[name].dtype for name in table.colnames],
+                       columns=columns, downcast=downcast, pack_flags=pack_flags)
+    arrays, masks = plan.apply(table)
+
+    result = Table(meta=table.meta.copy())
+    for name, data in arrays.items():
+        if mask_null and name in masks:
+            column = MaskedColumn(data, name=name, mask=masks[name])
+        else:
+            column = Column(data, name=name)
+        if name in table.colnames:
+            column.unit = table[name].unit
+            column.description = table[name].description
+        result.add_column(column)
+    result.meta.update(plan.metadata)
+
+    return result
+
+
+class _ArrowWriter():
+    """Write chunks as the row groups of a Parquet file, or the batches of an Arrow IPC file."""
+    def __init__(self, output_file, plan, format='parquet', compression=None):
+        try:
+            import pyarrow
+        except ImportError:
+            raise ImportError(
+                "# Need to install pyarrow package to use, e.g. `pip install unagi[export]`.")
+        self.pa = pyarrow
+        self.output_file = output_file
+        self.plan = plan
+        self.format = format
+        self.compression = compression
+        self.writer = None
+
+    def _array(self, data, mask):
+        """Convert one column to Arrow."""
+        if data.dtype.kind == 'S':
+            data = np.char.decode(data, 'ascii')
+        if data.ndim > 1:
+            size = int(np.prod(data.shape[1:]))
+            flat = self.pa.array(data.reshape(len(data), size).ravel())
+            return self.pa.FixedSizeListArray.from_arrays(flat, size)
+        return self.pa.array(data, mask=mask)
+
+    def write(self, columns, masks):
+        table = self.pa.Table.from_arrays(
+            [self._array(data, masks.get(name)) for name, data in columns.items()],
+            names=list(columns))
+
+        if self.writer is None:
+            schema = table.schema.with_metadata(self.plan.metadata)
+            if self.format == 'parquet':
+                import pyarrow.parquet
+                self.writer = pyarrow.parquet.ParquetWriter(
+                    self.output_file, schema, compression=self.compression or 'snappy')
+            else:
+                options = self.pa.ipc.IpcWriteOptions(compression=self.compression)
+                self.writer = self.pa.ipc.new_file(self.output_file, schema, options=options)
+
+        self.writer.write_table(table.replace_schema_metadata(self.plan.metadata))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+class _Hdf5Writer():
+    """Append chunks to a resizable, chunked compound dataset."""
+    def __init__(self, output_file, plan, path='catalog', compression=None):
+        self.output = h5py.File(output_file, 'w')
+        self.plan = plan
+        self.path = path
+        self.compression = compression
+        self.dataset = None
+
+    def write(self, columns, masks):
+        n_rows = len(next(iter(columns.values()))) if columns else 0
+        # HDF5 does not support unicode, strings are stored as ASCII bytes
+        fields = [
+            (name, data.dtype.str.replace('U', 'S') if data.dtype.kind == 'U' else data.dtype,
+             data.shape[1:]) for name, data in columns.items()]
+        # Only the float columns have NaN, the others keep their _isnull companion
+        nulls = [name for name, data in columns.items()
+                 if name in masks and data.dtype.kind != 'f']
+        dtype = np.dtype(fields + [(name + NULL_SUFFIX, np.bool_) for name in nulls])
+
+        if self.dataset is None:
+            chunk_rows = max(1, min(65536, (4 * 1024 ** 2) // max(dtype.itemsize, 1)))
+            self.dataset = self.output.create_dataset(
+                self.path, shape=(0, ), maxshape=(None, ), dtype=dtype,
+                chunks=(chunk_rows, ), compression=self.compression)
+            for key, value in self.plan.metadata.items():
+                self.dataset.attrs[key] = value
+
+        chunk = np.empty(n_rows, dtype=self.dataset.dtype)
+        for name, data in columns.items():
+            if data.dtype.kind == 'U':
+                data = np.char.encode(data, 'ascii')
+            # NULL values of the float columns become NaN
+            if name in masks and data.dtype.kind == 'f':
+                data = np.where(masks[name], np.nan, data)
+            chunk[name] = data
+        for name in nulls:
+            chunk[name + NULL_SUFFIX] = masks[name]
+
+        start = self.dataset.shape[0]
+        self.dataset.resize((start + n_rows, ))
+        self.dataset[start:] = chunk
+
+    def close(self):
+        self.output.close()
+
+
+def export_fits_table(fits_file, output_file, format=None, columns=None, downcast=None,
+                      pack_flags=False, chunk_rows=500000, compression=None, overwrite=False,
+                      hdu=1):
+    """
+    Convert a FITS table, e.g. the result of a SQL query, into a columnar file.
+
+    The FITS table is memory-mapped and converted `chunk_rows` rows at a time,
+    so the memory usage does not depend on the size of the catalog. Every chunk
+    becomes a row group of a Parquet file, a record batch of an Arrow IPC file,
+    or is appended to a chunked HDF5 compound dataset (`catalog`, readable with
+    `Table.read(output_file, path='catalog')`).
+
+    NULL values (from the `_isnull` columns) are kept as Arrow NULLs; in HDF5,
+    they become NaN in the float columns, and the other columns keep their
+    boolean `_isnull` companion.
+
+    Parameters
+    ----------
+    fits_file: str
+        The FITS table.
+    output_file: str
+        The output file.
+    format: str
+        'parquet', 'arrow' or 'hdf5'. Default: None, use the extension of `output_file`.
+    columns, downcast, pack_flags:
+        See `CompactPlan`.
+    chunk_rows: int
+        Number of rows converted at a time. Default: 500000
+    compression: str
+        Compression of the output file, e.g. 'zstd' for Parquet and Arrow, or 'gzip'
+        for HDF5. Default: None
+
+    Return
+    ------
+        Number of rows.
+    """
+    format = export_format(output_file, format)
+    if os.path.exists(output_file) and not overwrite:
+        raise IOError("# File {} exists!".format(output_file))
+
+    with fits.open(fits_file, memmap=True) as hdu_list:
+        data = hdu_list[hdu].data
+        if data is None:
+            raise ValueError("# No table in HDU {} of {}".format(hdu, fits_file))
+
+        # Dtypes after the conversions of astropy (logical to bool, scaled integers...)
+        names = data.columns.names
+        dtypes = [data[0:0].field(name).dtype for name in names]
+        plan = CompactPlan(names, dtypes, columns=columns, downcast=downcast,
+                           pack_flags=pack_flags)
+
+        if format == 'hdf5':
+            writer = _Hdf5Writer(output_file, plan, compression=compression)
+        else:
+            writer = _ArrowWriter(output_file, plan, format=format, compression=compression)
+
+        n_rows = len(data)
+        try:
+            # An empty table still gets its schema written
+            for start in range(0, max(n_rows, 1), chunk_rows):
+                chunk = data[start:start + chunk_rows]
+                writer.write(*plan.apply({name: chunk.field(name) for name in plan.read}))
+        finally:
+            writer.close()
+
+    return n_rows
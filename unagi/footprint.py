@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Offline footprint of the HSC tracts and patches"""
+
+import os
+
+import numpy as np
+
+from astropy.table import Table
+
+__all__ = ['FootprintIndex', 'footprint_file']
+
+# Corners of a patch in the mosaic table, in order around the patch
+CORNERS = [('llcra', 'llcdec'), ('lrcra', 'lrcdec'), ('urcra', 'urcdec'), ('ulcra', 'ulcdec')]
+
+
+def footprint_file(rerun, data_dir=None):
+    """
+    Location of the footprint file of a rerun.
+
+    Default is `unagi/data/<rerun>/<rerun>_footprint.fits`.
+    """
+    if data_dir is None:
+        data_dir = os.path.join(os.path.dirname(__file__), 'data', rerun)
+    return os.path.join(data_dir, '{0}_footprint.fits'.format(rerun))
+
+
+class FootprintIndex():
+    """
+    Spatial index of the coadded patch images of a rerun.
+
+    The index is built from the corners of all the patch images in the
+    `mosaic` table (see `unagi.hsc.Hsc.footprint`), one row per tract, patch
+    and filter. The patches are hashed on a grid of `cell_size` degree, so
+    looking up millions of coordinates only takes a few seconds and does not
+    need a connection to the archive.
+
+    Examples
+    --------
+
+        >>> index = FootprintIndex.load('pdr2_wide')
+        >>> tract, patch, covered = index.lookup(ra, dec)
+        >>> in_gri = covered[:, [index.filters.index(f) for f in ['HSC-G', 'HSC-R', 'HSC-I']]].all(1)
+
+    Parameters
+    ----------
+    patches: astropy.table.Table
+        Table with the tract, patch, filter01 and corner columns of the mosaic table.
+    cell_size: float
+        Size of the cells of the grid in degree. Default: 0.25
+    """
+    def __init__(self, patches, cell_size=0.25):
+        self.patches = patches
+        self.cell_size = cell_size
+
+        self.tract = np.asarray(patches['tract'])
+        self.patch = np.asarray(patches['patch'])
+        self.filter = np.asarray([str(f).strip() for f in patches['filter01']])
+        self.filters = sorted(set(self.filter.tolist()))
+        self._filter_index = np.searchsorted(self.filters, self.filter)
+
+        # (n_patches, 4) corners, with RA unwrapped around the first corner
+        self._ra = np.column_stack([np.asarray(patches[ra], dtype='float64') for ra, _ in CORNERS])
+        self._dec = np.column_stack([np.asarray(patches[dec], dtype='float64') for _, dec in CORNERS])
+        self._ra = self._ra[:, :1] + (self._ra - self._ra[:, :1] + 180.) % 360. - 180.
+        self._cos_dec = np.cos(np.deg2rad(self._dec.mean(1)))
+
+        self._build_grid()
+
+    @classmethod
+    def load(cls, rerun, data_dir=None, **kwargs):
+        """
+        Read the footprint of a rerun saved by `unagi.hsc.Hsc.footprint`.
+        """
+        file_name = footprint_file(rerun, data_dir=data_dir)
+        if not os.path.isfile(file_name):
+            raise IOError(
+                "# Cannot find {}, build it with Hsc(rerun='{}').footprint()".format(
+                    file_name, rerun))
+        return cls(Table.read(file_name), **kwargs)
+
+    def _cells(self, ra, dec):
+        """
+        Index of the cells of the grid.
+        """
+        n_ra = int(round(360. / self.cell_size))
+        i_ra = np.floor((ra % 360.) / self.cell_size).astype('int64') % n_ra
+        i_dec = np.floor((dec + 90.) / self.cell_size).astype('int64')
+        return i_dec * n_ra + i_ra
+
+    def _build_grid(self):
+        """
+        List the patches that overlap each cell of the grid.
+        """
+        n_ra = int(round(360. / self.cell_size))
+
+        # Cover the bounding box of each patch with cells
+        ra_0 = np.floor(self._ra.min(1) / self.cell_size).astype('int64')
+        dec_0 = np.floor((self._dec.min(1) + 90.) / self.cell_size).astype('int64')
+        n_ra_cells = np.floor(self._ra.max(1) / self.cell_size).astype('int64') - ra_0 + 1
+        n_dec_cells = np.floor((self._dec.max(1) + 90.) / self.cell_size).astype('int64') - dec_0 + 1
+        n_cells = n_ra_cells * n_dec_cells
+
+        owners = np.repeat(np.arange(len(n_cells)), n_cells)
+        offsets = np.arange(n_cells.sum()) - np.repeat(np.cumsum(n_cells) - n_cells, n_cells)
+        cells = ((dec_0[owners] + offsets // n_ra_cells[owners]) * n_ra +
+                 (ra_0[owners] + offsets % n_ra_cells[owners]) % n_ra)
+
+        # Compressed lists: the patches of cell c are owners[start:end]
+        order = np.argsort(cells, kind='stable')
+        self._grid_cells, self._grid_start = np.unique(cells[order], return_index=True)
+        self._grid_end = np.append(self._grid_start[1:], len(order))
+        self._grid_owners = owners[order]
+
+    def _candidates(self, ra, dec):
+        """
+        All the (point, patch) pairs that share a cell of the grid.
+        """
+        cells = self._cells(ra, dec)
+        pos = np.searchsorted(self._grid_cells, cells)
+        pos = np.clip(pos, 0, max(len(self._grid_cells) - 1, 0))
+        found = (len(self._grid_cells) > 0) & (self._grid_cells[pos] == cells)
+
+        start = np.where(found, self._grid_start[pos], 0)
+        count = np.where(found, self._grid_end[pos] - self._grid_start[pos], 0)
+
+        points = np.repeat(np.arange(len(ra)), count)
+        offsets = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+        patches = self._grid_owners[np.repeat(start, count) + offsets]
+        return points, patches
+
+    def _inside(self, ra, dec, patches):
+        """
+        Whether the points are inside the (convex) patches.
+        """
+        x = ((ra - self._ra[patches, 0] + 180.) % 360. - 180.) * self._cos_dec[patches]
+        y = dec - self._dec[patches, 0]
+        x_c = (self._ra[patches] - self._ra[patches, :1]) * self._cos_dec[patches, None]
+        y_c = self._dec[patches] - self._dec[patches, :1]
+
+        sign = []
+        for jj in range(4):
+            x1, y1 = x_c[:, jj], y_c[:, jj]
+            x2, y2 = x_c[:, (jj + 1) % 4], y_c[:, (jj + 1) % 4]
+            sign.append((x2 - x1) * (y - y1) - (y2 - y1) * (x - x1))
+        sign = np.column_stack(sign)
+
+        return np.all(sign >= 0, axis=1) | np.all(sign <= 0, axis=1)
+
+    def lookup(self, ra, dec, chunk_size=1000000):
+        """
+        Find the tract, patch and filters that cover each coordinate.
+
+        Parameters
+        ----------
+        ra, dec: array
+            Coordinates in degree.
+        chunk_size: int
+            Number of coordinates processed at once. Default: 1000000
+
+        Return
+        ------
+        tract: array
+            Tract of each coordinate, -1 if it is not covered.
+        patch: array
+            Patch of each coordinate in the same tract. Coordinates in the
+            overlap between patches get the first one in the index.
+        covered: array
+            (N, n_filters) boolean array, whether each filter in `self.filters`
+            covers each coordinate.
+        """
+        ra = np.atleast_1d(np.asarray(ra, dtype='float64'))
+        dec = np.atleast_1d(np.asarray(dec, dtype='float64'))
+
+        index = np.full(len(ra), -1, dtype='int64')
+        covered = np.zeros((len(ra), len(self.filters)), dtype=bool)
+
+        for start in range(0, len(ra), chunk_size):
+            sl = slice(start, start + chunk_size)
+            points, patches = self._candidates(ra[sl], dec[sl])
+            inside = self._inside(ra[sl][points], dec[sl][points], patches)
+            points, patches = points[inside] + start, patches[inside]
+
+            covered[points, self._filter_index[patches]] = True
+            # Keep the first patch of each point
+            first, first_index = np.unique(points, return_index=True)
+            index[first] = patches[first_index]
+
+        tract = np.where(index >= 0, self.tract[index], -1)
+        patch = np.where(index >= 0, self.patch[index], self.patch[:1].dtype.type())
+        return tract, patch, covered
+
+    def contains(self, ra, dec, filters=None):
+        """
+        Whether the coordinates are covered by all the filters in `filters`,
+        or by any filter if `filters` is None.
+        """
+        _, _, covered = self.lookup(ra, dec)
+        if filters is None:
+            return covered.any(1)
+        filters = [filters] if isinstance(filters, str) else list(filters)
+        missing = [f for f in filters if f not in self.filters]
+        if missing:
+            return np.zeros(len(covered), dtype=bool)
+        return covered[:, [self.filters.index(f) for f in filters]].all(1)
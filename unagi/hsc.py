@@ -6,21 +6,29 @@ import io
 import os
 import json
 import time
-import urllib
-import shutil
+import tempfile
 import warnings
+from concurrent.futures import CancelledError as FutureCancelledError
+from concurrent.futures import TimeoutError as FutureTimeoutError
 
 import numpy as np
 
+import requests
+from requests.adapters import HTTPAdapter
+
 import astropy.units as u
 from astropy.io import fits
 from astropy.table import Table
 from astropy.utils.console import Spinner
-from astropy.utils.data import download_file
 
 import unagi
 from . import config
 from . import query
+from .cache import CutoutCache, QueryCache
+from .footprint import FootprintIndex, footprint_file
+from .poller import QueryPoller
+from .journal import JobJournal
+from .export import export_fits_table, compact_table
 
 __all__ = ['Hsc', 'DEFAULT_CUTOUT_CENTER', 'DEFAULT_CUTOUT_CORNER',
            'IMG_HDU', 'MSK_HDU', 'VAR_HDU']
@@ -69,7 +77,10 @@ class Hsc():
                    'NB0387', 'NB0816', 'NB0921']
     FILTER_SHORT = ['g', 'r', 'i', 'z', 'y', 'nb0387', 'nb816', 'nb921']
 
-    def __init__(self, dr='pdr2', rerun='pdr2_wide', verbose=True, config_file=None):
+    def __init__(self, dr='pdr2', rerun='pdr2_wide', verbose=True, config_file=None,
+                 pool_connections=10, pool_maxsize=10, pool_block=False, timeout=None,
+                 max_retries=0, cache=None, query_cache=None, max_poll_interval=30.,
+                 journal=None):
         """
         Initialize a HSC rerun object.
 
@@ -83,6 +94,31 @@ class Hsc():
             Using public data release. Default: False
         config_file: str
             Name of the configuration file. Default: None
+        pool_connections: int
+            Number of per-host connection pools kept by the HTTP session. Default: 10
+        pool_maxsize: int
+            Maximum number of keep-alive connections to a single host. Default: 10
+        pool_block: bool
+            Block when all connections to a host are busy instead of opening
+            extra, non-reusable ones. Default: False
+        timeout: float or tuple
+            (connect, read) timeout in seconds for every HTTP request.
+            Default: None, which means (30, archive.timeout)
+        max_retries: int
+            Number of retries for failed connections. Default: 0
+        cache: str or unagi.cache.CutoutCache
+            On-disk cache for cutout images and PSF models, or the directory
+            to create one in. Default: None
+        query_cache: str or unagi.cache.QueryCache
+            On-disk cache for SQL query results, or the directory to create one in.
+            Default: None
+        max_poll_interval: float
+            Maximum interval between two status checks of a SQL job in seconds.
+            Default: 30
+        journal: str or unagi.journal.JobJournal
+            Persistent journal of the submitted SQL jobs, or the SQLite file to keep
+            it in. Jobs in the journal are re-attached to instead of submitted again.
+            Default: None
         """
         # Initiate the Rerun object
         assert dr in self.DATABASE
@@ -102,11 +138,38 @@ class Hsc():
         # TODO: figure out how to get this from HSC archive
         self.sql_version = 20181012.1
 
+        # Settings of the pooled, keep-alive HTTP session
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.pool_block = pool_block
+        self.max_retries = max_retries
+        if timeout is None:
+            timeout = (30, self.archive.timeout)
+        self.timeout = timeout
+
+        # Local cache of cutout images and PSF models
+        if isinstance(cache, str):
+            cache = CutoutCache(cache)
+        self.cache = cache
+
+        # Local cache of SQL query results
+        if isinstance(query_cache, str):
+            query_cache = QueryCache(query_cache)
+        self.query_cache = query_cache
+
+        # Journal of the submitted SQL jobs
+        if isinstance(journal, str):
+            journal = JobJournal(journal)
+        self.journal = journal
+
+        # Shared poller of the status of all the SQL jobs
+        self.poller = QueryPoller(self.check_query, max_interval=max_poll_interval)
+
         # Whether login to the server
         self.is_login = False
-        self.opener = None
+        self.session = None
         # Try to login to the HSC archive
-        if not self.is_login or self.opener is None:
+        if not self.is_login or self.session is None:
             self.login()
 
         # List of available tables
@@ -137,24 +200,16 @@ class Hsc():
         if password is None:
             password = self.archive._password
 
-        # Create a password manager
-        password_mgr = urllib.request.HTTPPasswordMgrWithDefaultRealm()
-
-        # Add the username and password.
-        password_mgr.add_password(None, self.archive.base_url, username, password)
-        handler = urllib.request.HTTPBasicAuthHandler(password_mgr)
-
-        # Create "opener" (OpenerDirector instance)
-        self.opener = urllib.request.build_opener(handler)
+        # Create the session that is shared by all the requests to the archive
+        self.session = self._build_session(username, password)
 
         try:
-            # Install the opener.
-            self.opener.open(self.archive.base_url)
-            urllib.request.install_opener(self.opener)
+            self._http_get(self.archive.base_url)
             self.is_login = True
-        except urllib.error.HTTPError as e:
+        except requests.exceptions.HTTPError as e:
             print("! Can not login to HSC archive: %s" % str(e))
-            self.opener = None
+            self.session.close()
+            self.session = None
 
     def logout(self):
         """
@@ -166,9 +221,54 @@ class Hsc():
             print("# Has not login to HSC archive yet!")
         else:
             print("# Log out of HSC archive now!")
-            self.opener = None
+            self.session.close()
+            self.session = None
             self.is_login = False
 
+    def _build_session(self, username, password):
+        """
+        Create a pooled, keep-alive HTTP session with basic authentication.
+
+        Parameters
+        ----------
+        username : str
+        password : str
+        """
+        session = requests.Session()
+        session.auth = (username, password)
+
+        # Connections to the same host are kept alive and reused
+        adapter = HTTPAdapter(
+            pool_connections=self.pool_connections, pool_maxsize=self.pool_maxsize,
+            pool_block=self.pool_block, max_retries=self.max_retries)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+
+        return session
+
+    def mount_pool(self, url, pool_maxsize):
+        """
+        Use a dedicated pool of keep-alive connections for the requests to a URL.
+
+        Threads that share the session beyond the `pool_maxsize` of the default
+        pool open extra connections that are closed after every request, so
+        concurrent downloads should have at least one connection per thread.
+
+        Parameters
+        ----------
+        url : str
+            Prefix of the URLs that use the pool, e.g. `self.archive.img_url`.
+        pool_maxsize : int
+            Maximum number of keep-alive connections.
+        """
+        if self.session is None:
+            return None
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=max(pool_maxsize, self.pool_maxsize),
+            pool_block=self.pool_block, max_retries=self.max_retries)
+        self.session.mount(url, adapter)
+        return adapter
+
     def download_cutout(self, coord, output_file, coord_2=None, w_half=None, h_half=None,
                         filt='HSC-I', img_type='coadd', image=True, variance=False, mask=False,
                         overwrite=True):
@@ -183,17 +283,17 @@ class Hsc():
                          'variance': variance, 'mask': mask}
 
         if img_type == 'coadd':
-            # Download FITS file for coadd image.
-            cutout = self.get_cutout_image(coord, **cutout_kwargs)
-            _ = cutout.writeto(output_file, overwrite=overwrite)
-            return cutout
+            # Stream the FITS file for coadd image to disk.
+            if os.path.isfile(output_file) and not overwrite:
+                raise HscException("# File {} exists!".format(output_file))
+            return self.get_cutout_image(coord, output_file=output_file, **cutout_kwargs)
         elif img_type == 'warp':
             # Download the tarball for warpped images.
             cutout_url = self.get_cutout_image(coord, **cutout_kwargs)
             if os.path.isfile(output_file) and not overwrite:
                 raise HscException("# File {} exists!".format(output_file))
             else:
-                _ = shutil.move(download_file(cutout_url, show_progress=False), output_file)
+                _ = self._download_file(cutout_url, output_file)
             return cutout_url
         else:
             raise HscException("# Wrong image type: coadd or warp !")
@@ -214,8 +314,8 @@ class Hsc():
         try:
             if verbose:
                 print("# Downloading FITS image from {}".format(patch_url))
-            cutout = fits.open(patch_url)
-        except urllib.error.HTTPError as e:
+            cutout = fits.open(io.BytesIO(self._http_get(patch_url).content))
+        except requests.exceptions.HTTPError as e:
             print("# Error message: {}".format(e))
             raise Exception("# Can not download cutout: {}".format(patch_url))
 
@@ -225,12 +325,19 @@ class Hsc():
         return cutout
 
     def get_cutout_image(self, coord, coord_2=None, w_half=None, h_half=None, filt='HSC-I',
-                         img_type='coadd', image=True, variance=False, mask=False, verbose=False):
+                         img_type='coadd', image=True, variance=False, mask=False, verbose=False,
+                         use_cache=True, output_file=None):
         """
         Get HSC cutout image.
 
         Parameters:
         -----------
+        use_cache: bool
+            Read from and save to the local cache if there is one. Default: True
+        output_file: str
+            Stream the cutout to this file instead of keeping it in memory, and return
+            it opened with `memmap=True`, so the arrays of large cutouts are only read
+            when they are sliced. Default: None
         """
         cutout_kwargs = {'filt': filt, 'img_type': img_type, 'image': image,
                          'variance': variance, 'mask': mask}
@@ -246,19 +353,43 @@ class Hsc():
         try:
             if verbose:
                 print("# Downloading FITS image from {}".format(cutout_url))
-            cutout = fits.open(cutout_url)
-        except urllib.error.HTTPError as e:
+            cutout = self._get_fits(cutout_url, use_cache=use_cache, output_file=output_file)
+        except requests.exceptions.HTTPError as e:
             print("# Error message: {}".format(e))
             raise Exception("# Can not download cutout: {}".format(cutout_url))
 
         return cutout
 
-    def get_psf_model(self, coord, filt='HSC-I', img_type='coadd', centered=True, verbose=False):
+    def get_psf_model(self, coord, filt='HSC-I', img_type='coadd', centered=True, verbose=False,
+                      use_cache=True):
         """
         Get the PSF model at a given sky position.
 
         Parameters:
         -----------
+        use_cache: bool
+            Read from and save to the local cache if there is one. Default: True
+        """
+        psf_url = self.form_psf_url(coord, filt=filt, img_type=img_type, centered=centered)
+
+        if img_type == 'warp':
+            if verbose:
+                warnings.warn("# Not a coadd PSF model, will return the url")
+            return psf_url
+
+        try:
+            if verbose:
+                print("# Downloading FITS image from {}".format(psf_url))
+            psf_model = self._get_fits(psf_url, use_cache=use_cache)
+        except requests.exceptions.HTTPError as e:
+            print("# Error message: {}".format(e))
+            raise Exception("# Can not download cutout: {}".format(psf_url))
+
+        return psf_model
+
+    def form_psf_url(self, coord, filt='HSC-I', img_type='coadd', centered=True):
+        """
+        Form the URL to download the HSC PSF model at a given sky position.
         """
         # Check the filter
         filt = self._check_filter(filt)
@@ -278,24 +409,9 @@ class Hsc():
         psf_dict['ra'] = ra_str
         psf_dict['dec'] = dec_str
 
-        psf_url = self.archive.psf_url + '&'.join(
+        return self.archive.psf_url + '&'.join(
             key + '=' + value for key, value in psf_dict.items())
 
-        if img_type == 'warp':
-            if verbose:
-                warnings.warn("# Not a coadd PSF model, will return the url")
-            return psf_url
-
-        try:
-            if verbose:
-                print("# Downloading FITS image from {}".format(psf_url))
-            psf_model = fits.open(psf_url)
-        except urllib.error.HTTPError as e:
-            print("# Error message: {}".format(e))
-            raise Exception("# Can not download cutout: {}".format(psf_url))
-
-        return psf_model
-
     def form_cutout_url(self, coord, coord_2=None, w_half=None, h_half=None, **kwargs):
         """
         Form the URL to download HSC cutout images.
@@ -372,11 +488,37 @@ class Hsc():
 
         return filt
 
-    def _download_file(self, url, file_path=None):
+    def _download_file(self, url, file_path=None, chunk_size=1048576):
         """
         Function to download file from server.
+
+        Parameters:
+        -----------
+        url: str
+            URL of the file.
+        file_path: str
+            Name of the output file. Default: use the name of the file on the server.
+        chunk_size: int
+            Size of the chunk written to disk in bytes. Default: 1 MB
         """
-        pass
+        if file_path is None:
+            file_path = os.path.basename(url.split('?')[0])
+
+        with self._http_get(url, stream=True) as response:
+            self._save_response(response, file_path, chunk_size=chunk_size)
+
+        return file_path
+
+    @staticmethod
+    def _save_response(response, file_path, chunk_size=1048576):
+        """
+        Write the body of a streamed HTTP response to a file chunk by chunk.
+        """
+        with open(file_path, 'wb') as f:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                f.write(chunk)
+
+        return file_path
 
     def _parse_coordinate(self, coord, frame='icrs'):
         """
@@ -441,8 +583,8 @@ class Hsc():
         h_half: float
             Half of the image height.
         """
-        # Load the default dictionary
-        cutout_dict = DEFAULT_CUTOUT_CENTER
+        # Load a copy of the default dictionary, so concurrent calls do not share it
+        cutout_dict = dict(DEFAULT_CUTOUT_CENTER)
 
         # Parse the coordinate
         ra_str, dec_str = self._parse_coordinate(coord)
@@ -486,8 +628,8 @@ class Hsc():
         h_half: float
             Half of the image height.
         """
-        # Load the default dictionary
-        cutout_dict = DEFAULT_CUTOUT_CORNER
+        # Load a copy of the default dictionary, so concurrent calls do not share it
+        cutout_dict = dict(DEFAULT_CUTOUT_CORNER)
 
         # Check the size of the cutout image
         if ((np.abs(coord2.ra - coord1.ra) >= self.MAX_CUTOUT) or (
@@ -520,17 +662,73 @@ class Hsc():
 
         return cutout_dict
 
-    def _http_post(self, url, data, headers):
+    def _get_fits(self, url, use_cache=True, output_file=None):
+        """
+        Download a FITS file, go through the local cache when there is one.
+
+        If `output_file` is given, the file is streamed to disk and opened with
+        memory mapping instead.
+        """
+        if output_file is not None:
+            return self._get_fits_file(url, output_file, use_cache=use_cache)
+
+        if self.cache is None or not use_cache:
+            return fits.open(io.BytesIO(self._http_get(url).content))
+
+        key = self.cache.url_key(self.dr, url)
+        content = self.cache.get(key)
+        if content is None:
+            content = self._http_get(url).content
+            self.cache.put(key, content)
+
+        return fits.open(io.BytesIO(content))
+
+    def _get_fits_file(self, url, output_file, use_cache=True, chunk_size=1048576):
+        """
+        Stream a FITS file to disk, and open it with memory mapping.
+
+        The file is written to a temporary name first, so an interrupted download
+        never leaves a truncated file behind.
+        """
+        key = None
+        if self.cache is not None and use_cache:
+            key = self.cache.url_key(self.dr, url)
+
+        tmp_file = output_file + '.part'
+        try:
+            if key is None or not self.cache.get_file(key, tmp_file):
+                with self._http_get(url, stream=True) as response:
+                    self._save_response(response, tmp_file, chunk_size=chunk_size)
+                if key is not None:
+                    self.cache.put_file(key, tmp_file)
+            os.replace(tmp_file, output_file)
+        finally:
+            if os.path.isfile(tmp_file):
+                os.remove(tmp_file)
+
+        return fits.open(output_file, memmap=True)
+
+    def _http_get(self, url, stream=False):
+        """
+        Get data through the shared HTTP session.
+        """
+        res = self.session.get(url, stream=stream, timeout=self.timeout)
+        res.raise_for_status()
+        return res
+
+    def _http_post(self, url, data, headers, stream=False):
         """
         Request data.
 
         Based on: https://hsc-gitlab.mtk.nao.ac.jp/snippets/31
         """
-        req = urllib.request.Request(url, data.encode('utf-8'), headers)
-        res = urllib.request.urlopen(req)
+        res = self.session.post(
+            url, data=data.encode('utf-8'), headers=headers, stream=stream,
+            timeout=self.timeout)
+        res.raise_for_status()
         return res
 
-    def _http_post_json(self, url, data):
+    def _http_post_json(self, url, data, stream=False):
         """
         Send SQL request.
 
@@ -538,7 +736,8 @@ class Hsc():
         """
         data['clientVersion'] = self.sql_version
         post_data = json.dumps(data)
-        return self._http_post(url, post_data, {'Content-type': 'application/json'})
+        return self._http_post(
+            url, post_data, {'Content-type': 'application/json'}, stream=stream)
 
     def _credential(self):
         """
@@ -570,9 +769,42 @@ class Hsc():
             }
 
         res = self._http_post_json(url, post_data)
-        job = json.load(res)
+        job = res.json()
+
+        if self.journal is not None:
+            self.journal.add(job['id'], self.dr, self.rerun, sql)
         return job
 
+    def find_job(self, sql, verbose=False):
+        """
+        Find a SQL job of the same query in the journal that is still on the archive.
+
+        Return the job dict, or None if there is no journal or no such job.
+        """
+        if self.journal is None:
+            return None
+
+        record = self.journal.find(self.dr, self.rerun, sql)
+        if record is None:
+            return None
+
+        try:
+            status = self.check_query(record['job_id'])
+        except requests.exceptions.HTTPError:
+            status = {'status': JobJournal.LOST}
+
+        if status['status'] == 'error':
+            self.journal.update(record['job_id'], JobJournal.ERROR, error=status.get('error'))
+            return None
+        if status['status'] in (JobJournal.LOST, 'deleted', 'cancelled', 'canceled'):
+            self.journal.update(record['job_id'], JobJournal.LOST)
+            return None
+
+        if verbose:
+            print("# Re-attach to SQL job {} submitted on {}".format(
+                record['job_id'], time.ctime(record['submitted'])))
+        return {'id': record['job_id'], 'status': status['status']}
+
     def check_query(self, job_id):
         """
         Check the status of a SQL query job.
@@ -585,7 +817,7 @@ class Hsc():
             'credential': self._credential(), 'id': job_id}
 
         res = self._http_post_json(url, post_data)
-        job = json.load(res)
+        job = res.json()
         return job
 
     def cancel_query(self, job_id):
@@ -600,6 +832,10 @@ class Hsc():
             'credential': self._credential(), 'id': job_id}
 
         _ = self._http_post_json(url, post_data)
+        self.poller.unwatch(job_id)
+
+        if self.journal is not None:
+            self.journal.update(job_id, JobJournal.CANCELLED)
 
     def delete_query(self, job_id):
         """
@@ -613,44 +849,39 @@ class Hsc():
             'credential': self._credential(), 'id': job_id}
 
         _ = self._http_post_json(url, post_data)
+        self.poller.unwatch(job_id)
+
+        if self.journal is not None:
+            self.journal.update(job_id, JobJournal.DELETED)
 
     def _block_until_query_finishes(self, job_id, verbose=True):
         """
         Block untial the query is done.
 
-        Based on: https://hsc-gitlab.mtk.nao.ac.jp/snippets/31
+        The status of the job is checked by the shared poller of the archive,
+        with a jittered interval that is capped by its `max_interval`.
         """
-        interval = 1   # sec.
-
-        if verbose:
-            with Spinner('Waiting for query to finish...', 'lightred') as spin:
-                while True:
-                    time.sleep(interval)
-                    status = self.check_query(job_id)
+        job = self.poller.watch(job_id)
 
-                    if status['status'] == 'error':
-                        raise QueryError('query error: {}'.format(status['error']))
-                    if status['status'] == 'done':
-                        break
-
-                    interval *= 2
-                    if interval > self.archive.timeout:
-                        interval = self.archive.timeout
-
-                    next(spin)
-        else:
-            while True:
-                time.sleep(interval)
-                status = self.check_query(job_id)
-
-                if status['status'] == 'error':
-                    raise QueryError('query error: {}'.format(status['error']))
-                if status['status'] == 'done':
-                    break
+        try:
+            if verbose:
+                with Spinner('Waiting for query to finish...', 'lightred') as spin:
+                    while True:
+                        try:
+                            status = job.result(timeout=0.5)
+                            break
+                        except FutureTimeoutError:
+                            next(spin)
+            else:
+                status = job.result()
+        except FutureCancelledError:
+            # The job was cancelled or deleted by another thread
+            raise QueryError('query is cancelled')
 
-                interval *= 2
-                if interval > self.archive.timeout:
-                    interval = self.archive.timeout
+        if status['status'] == 'error':
+            raise QueryError('query error: {}'.format(status['error']))
+        if status['status'] != 'done':
+            raise QueryError('query is {}'.format(status['status']))
 
     def get_query_result(self, job_id):
         """
@@ -663,7 +894,8 @@ class Hsc():
             'credential': self._credential(),
             'id': job_id}
 
-        response = self._http_post_json(url, post_data)
+        # The body is streamed, see parse_query_result()
+        response = self._http_post_json(url, post_data, stream=True)
 
         return response
 
@@ -684,7 +916,7 @@ class Hsc():
             }
 
         res = self._http_post_json(url, post_data)
-        result = json.load(res)
+        result = res.json()
 
         print(result['result']['fields'])
         for row in result['result']['rows']:
@@ -695,17 +927,65 @@ class Hsc():
 
         return result
 
-    def parse_query_result(self, response, verbose=False):
+    @staticmethod
+    def _read_query_result(fileobj, memmap=False, columns=None, downcast=None,
+                           pack_flags=False, mask_null=False):
+        """
+        Read the FITS table returned by the SQL server and remove the _isnull columns.
+
+        With any of the compaction options, the table is projected and compacted
+        by `unagi.export.compact_table` instead.
+        """
+        result = Table.read(fileobj, format='fits', memmap=memmap)
+        if columns is not None or downcast or pack_flags or mask_null:
+            return compact_table(result, columns=columns, downcast=downcast,
+                                 pack_flags=pack_flags, mask_null=mask_null)
+
+        # Drop the columns in place, so the remaining ones are not copied
+        result.remove_columns(
+            [col for col in result.colnames if col.endswith('_isnull')])
+        return result
+
+    def parse_query_result(self, response, verbose=False, tmp_dir=None,
+                           chunk_size=1048576, columns=None, downcast=None,
+                           pack_flags=False, mask_null=False):
         """
         Parse the SQL result to something readable.
+
+        The FITS file is streamed to a temporary file in `tmp_dir` in chunks of
+        `chunk_size` bytes and read back with memory mapping, so large results
+        never have to fit in memory more than once.
+
+        Parameters
+        ----------
+        columns: list
+            Only keep these columns, can use wildcards such as `i_cmodel_*`.
+            Default: None
+        downcast: bool, str or list
+            Float64 columns to store as float32: 'errors' for the uncertainties,
+            True for all but the coordinates, or a list of patterns. Default: None
+        pack_flags: bool, str or list
+            Pack the boolean flags (`*_flag`, `*_pixelflags_*`...) into `uint64`
+            bitfield columns, see `unagi.export.unpack_flags`. Default: False
+        mask_null: bool
+            Use the `_isnull` columns as masks instead of dropping them. Default: False
         """
+        result = None
         try:
-            # Convert the output into Astropy.table
-            result = Table.read(
-                io.BytesIO(response.read(response.length)))
-            # Remove _isnull columns
-            columns = [col for col in result.colnames if not col.endswith('_isnull')]
-            result = result[columns]
+            fd, result_file = tempfile.mkstemp(suffix='.fits', dir=tmp_dir)
+            os.close(fd)
+            try:
+                self._save_response(response, result_file, chunk_size=chunk_size)
+                # Convert the output into Astropy.table
+                result = self._read_query_result(
+                    result_file, memmap=True, columns=columns, downcast=downcast,
+                    pack_flags=pack_flags, mask_null=mask_null)
+            finally:
+                # The memory map stays valid after the file is removed on POSIX systems
+                try:
+                    os.remove(result_file)
+                except OSError:
+                    pass
         except Exception as e:
             print(e)
             print("\n# Cannot convert search result into Astropy table.")
@@ -717,15 +997,38 @@ class Hsc():
 
     def sql_query(
             self, sql, out_file=None, preview=False, nomail=True,
-            skip_syntax=True, delete_after=True, verbose=True, from_file=False):
+            skip_syntax=True, delete_after=True, verbose=True, from_file=False,
+            use_cache=True, tmp_dir=None, columns=None, downcast=None,
+            pack_flags=False, mask_null=False):
         """
         SQL search in HSC archive.
+
+        The result is streamed to a temporary file in `tmp_dir` and memory-mapped,
+        see `parse_query_result`. `columns`, `downcast`, `pack_flags` and `mask_null`
+        project and compact the result, see `parse_query_result`.
+
+        When the `Hsc` object has a `query_cache` and `use_cache=True`, results
+        of previous identical queries are returned without contacting the archive.
         """
         if from_file:
             sql_str = open(sql, 'r').read()
         else:
             sql_str = sql
 
+        compact = {'columns': columns, 'downcast': downcast, 'pack_flags': pack_flags,
+                   'mask_null': mask_null}
+
+        cache_key = None
+        if self.query_cache is not None and use_cache and not preview:
+            cache_key = self._query_cache_key(sql_str, compact)
+            result = self.query_cache.get_table(cache_key)
+            if result is not None:
+                if verbose:
+                    print("# Read the SQL search result from the cache")
+                if out_file:
+                    result.write(out_file, overwrite=True)
+                return result
+
         job = {'id': -9999}
         try:
             if preview:
@@ -735,37 +1038,29 @@ class Hsc():
                 result = self.preview_query(sql_str)
                 return result
             else:
-                # Submit SQL job
-                job = self.submit_query(
-                    sql_str, nomail=nomail, skip_syntax=skip_syntax)
-                # Wait...
-                self._block_until_query_finishes(job['id'], verbose=verbose)
-
-                # If SQL search is done, get the result
-                response = self.get_query_result(job['id'])
-
-                # Convert the output into astropy.table
-                result = self.parse_query_result(response, verbose=verbose)
-
-                # Save a copy of the result to file
-                if out_file:
-                    if verbose:
-                        print('# Save result to {}'.format(out_file))
-                    result.write(out_file, overwrite=True)
-
-                # Delete the SQL search result from the archive
-                if delete_after:
-                    self.delete_query(job['id'])
-                return result
-        except urllib.error.HTTPError as e:
-            if e.code == 401:
+                # Re-attach to the same job if it is in the journal, or submit it,
+                # `job` keeps the placeholder id until there is a job on the archive
+                found = self.find_job(sql_str, verbose=verbose)
+                if found is None:
+                    found = self.submit_query(
+                        sql_str, nomail=nomail, skip_syntax=skip_syntax)
+                job = found
+
+                return self._fetch_query_result(
+                    job['id'], cache_key=cache_key, out_file=out_file,
+                    delete_after=delete_after, verbose=verbose, tmp_dir=tmp_dir,
+                    compact=compact)
+        except requests.exceptions.HTTPError as e:
+            if e.response.status_code == 401:
                 print('invalid id or password!')
-            if e.code == 406:
-                print(e.read())
+            if e.response.status_code == 406:
+                print(e.response.text)
             else:
                 print(e)
         except QueryError as e:
             print(e)
+            if self.journal is not None and job['id'] != -9999:
+                self.journal.update(job['id'], JobJournal.ERROR, error=str(e))
             try:
                 self.delete_query(job['id'])
             except Exception:
@@ -777,6 +1072,194 @@ class Hsc():
         else:
             raise QueryError("Something is wrong with the SQL search!")
 
+    def sql_export(self, sql, out_file, format=None, columns=None, downcast=None,
+                   pack_flags=False, chunk_rows=500000, compression=None, overwrite=True,
+                   nomail=True, skip_syntax=True, delete_after=True, verbose=True,
+                   from_file=False, tmp_dir=None):
+        """
+        SQL search in HSC archive, with the result streamed into a Parquet, Arrow or HDF5 file.
+
+        Unlike `sql_query`, the result is never turned into an `astropy.table.Table`:
+        the FITS file returned by the archive is streamed to `tmp_dir`, then converted
+        in bounded-memory chunks of `chunk_rows` rows by `unagi.export.export_fits_table`,
+        which also selects the columns, downcasts the uncertainties and packs the flags.
+
+        Parameters
+        ----------
+        out_file: str
+            Output file, the format is taken from its extension (.parquet, .arrow, .h5).
+        columns, downcast, pack_flags:
+            See `unagi.export.CompactPlan`.
+
+        Return
+        ------
+            Number of rows in the result.
+        """
+        if from_file:
+            sql_str = open(sql, 'r').read()
+        else:
+            sql_str = sql
+
+        # Re-attach to the same job if it is in the journal, or submit it
+        job = self.find_job(sql_str, verbose=verbose)
+        if job is None:
+            job = self.submit_query(sql_str, nomail=nomail, skip_syntax=skip_syntax)
+
+        try:
+            self._block_until_query_finishes(job['id'], verbose=verbose)
+        except QueryError as e:
+            if self.journal is not None:
+                self.journal.update(job['id'], JobJournal.ERROR, error=str(e))
+            raise
+        except KeyboardInterrupt:
+            self.cancel_query(job['id'])
+            raise
+        if self.journal is not None:
+            self.journal.update(job['id'], JobJournal.DONE)
+
+        fd, result_file = tempfile.mkstemp(suffix='.fits', dir=tmp_dir)
+        os.close(fd)
+        try:
+            self._save_response(self.get_query_result(job['id']), result_file)
+            if verbose:
+                print('# Save result to {}'.format(out_file))
+            n_rows = export_fits_table(
+                result_file, out_file, format=format, columns=columns, downcast=downcast,
+                pack_flags=pack_flags, chunk_rows=chunk_rows, compression=compression,
+                overwrite=overwrite)
+        finally:
+            os.remove(result_file)
+
+        if self.journal is not None:
+            self.journal.update(job['id'], JobJournal.FETCHED)
+
+        # Delete the SQL search result from the archive
+        if delete_after:
+            self.delete_query(job['id'])
+        return n_rows
+
+    def _query_cache_key(self, sql, compact=None):
+        """
+        Cache key of a SQL query, compacted results are cached separately.
+        """
+        if compact is None or not any(compact.values()):
+            return self.query_cache.sql_key(self.dr, self.rerun, sql)
+        return self.query_cache.make_key(
+            self.dr, self.rerun, query.normalize_sql(sql), compact)
+
+    def _fetch_query_result(self, job_id, cache_key=None, out_file=None, delete_after=True,
+                            verbose=True, tmp_dir=None, compact=None):
+        """
+        Wait for a SQL job to finish, then download and parse its result.
+
+        `compact` is a dict of the compaction options of `parse_query_result`.
+        """
+        # Wait...
+        self._block_until_query_finishes(job_id, verbose=verbose)
+        if self.journal is not None:
+            self.journal.update(job_id, JobJournal.DONE)
+
+        # If SQL search is done, get the result
+        response = self.get_query_result(job_id)
+
+        # Convert the output into astropy.table
+        result = self.parse_query_result(
+            response, verbose=verbose, tmp_dir=tmp_dir, **(compact or {}))
+        if self.journal is not None:
+            self.journal.update(job_id, JobJournal.FETCHED)
+
+        # Keep a copy in the local cache, unless the result cannot be read
+        if cache_key is not None and result is not None:
+            self.query_cache.put_table(cache_key, result)
+
+        # Save a copy of the result to file
+        if out_file and result is not None:
+            if verbose:
+                print('# Save result to {}'.format(out_file))
+            result.write(out_file, overwrite=True)
+
+        # Delete the SQL search result from the archive
+        if delete_after:
+            self.delete_query(job_id)
+        return result
+
+    def reattach_query(self, job_id=None, sql=None, out_file=None, delete_after=True,
+                       verbose=True, tmp_dir=None, columns=None, downcast=None,
+                       pack_flags=False, mask_null=False):
+        """
+        Get the result of a SQL job that was submitted earlier, e.g. by a process that died.
+
+        Parameters
+        ----------
+        job_id: int
+            Id of the job. Default: None
+        sql: str
+            SQL string of the job, used to find the job in the journal when `job_id`
+            is not given. Default: None
+        columns, downcast, pack_flags, mask_null:
+            Compaction of the result, see `parse_query_result`.
+        """
+        sql_str = sql
+        if job_id is None:
+            if sql is None:
+                raise ValueError("# Need either the job id or the SQL string!")
+            job = self.find_job(sql, verbose=verbose)
+            if job is None:
+                raise QueryError("# Can not find an active job of this query in the journal")
+            job_id = job['id']
+        elif self.journal is not None and self.journal.get(job_id) is not None:
+            sql_str = self.journal.get(job_id)['sql']
+
+        compact = {'columns': columns, 'downcast': downcast, 'pack_flags': pack_flags,
+                   'mask_null': mask_null}
+
+        cache_key = None
+        if self.query_cache is not None and sql_str is not None:
+            cache_key = self._query_cache_key(sql_str, compact)
+
+        try:
+            return self._fetch_query_result(
+                job_id, cache_key=cache_key, out_file=out_file, delete_after=delete_after,
+                verbose=verbose, tmp_dir=tmp_dir, compact=compact)
+        except QueryError as e:
+            if self.journal is not None:
+                self.journal.update(job_id, JobJournal.ERROR, error=str(e))
+            raise
+
+    def gc_queries(self, max_age=None, verbose=True):
+        """
+        Delete the SQL jobs in the journal that are no longer needed from the archive.
+
+        The jobs whose result has been downloaded, failed, or were cancelled are
+        deleted. With `max_age` in seconds, the jobs submitted earlier than that
+        are deleted too, even if their result was never downloaded.
+
+        Return
+        ------
+            List of the ids of the deleted jobs.
+        """
+        if self.journal is None:
+            raise HscException("# There is no journal of SQL jobs!")
+
+        jobs = self.journal.jobs(
+            status=[JobJournal.FETCHED, JobJournal.ERROR, JobJournal.CANCELLED], dr=self.dr)
+        if max_age is not None:
+            jobs += self.journal.jobs(
+                status=JobJournal.ACTIVE + (JobJournal.LOST, ), dr=self.dr, older_than=max_age)
+
+        deleted = []
+        for job in jobs:
+            try:
+                self.delete_query(job['job_id'])
+            except requests.exceptions.HTTPError:
+                # Already gone from the archive
+                self.journal.update(job['job_id'], JobJournal.DELETED)
+            deleted.append(job['job_id'])
+
+        if verbose:
+            print("# Deleted {} SQL jobs from the archive".format(len(deleted)))
+        return deleted
+
     def tables(self, return_table=False, save=False):
         """
         List all the tables available for the rerun.
@@ -807,6 +1290,31 @@ class Hsc():
         # Otherwise, just return a list of table names
         return list(tables['object'])
 
+    def footprint(self, save=True, **kwargs):
+        """
+        Footprint index of all the coadded patch images of the rerun.
+
+        The corners of the patches are queried only once and saved under
+        `unagi/data/<rerun>/`; after that the index works offline, see
+        `unagi.footprint.FootprintIndex.load`.
+        """
+        output_fits = footprint_file(self.rerun)
+        schema_dir = os.path.dirname(output_fits)
+
+        if os.path.isfile(output_fits):
+            print("# Read from saved file {}".format(output_fits))
+            patches = Table.read(output_fits)
+        else:
+            patches = self.sql_query(query.PATCH_CORNERS.format(self.rerun), verbose=False)
+
+            # Save a fits version of the patch corners
+            if save:
+                if not os.path.isdir(schema_dir):
+                    os.mkdir(schema_dir)
+                patches.write(output_fits, overwrite=True)
+
+        return FootprintIndex(patches, **kwargs)
+
     def _check_table(self, table):
         """
         Check whether a table is available in the rerun.
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Persistent journal of the SQL jobs submitted to the HSC archive"""
+
+import time
+import hashlib
+import sqlite3
+
+from .query import normalize_sql
+
+__all__ = ['JobJournal']
+
+
+class JobJournal():
+    """
+    Persistent record of the SQL jobs submitted to the HSC archive.
+
+    The journal is a SQLite database that records the SQL string, the job id,
+    the data release, the rerun and the status of every job. If the process
+    that submitted a long query dies, the job can be found again in the journal
+    and its result downloaded without running the query a second time (see
+    `unagi.hsc.Hsc.reattach_query`). Jobs are matched on the normalized SQL
+    string (see `unagi.query.normalize_sql`).
+
+    Parameters
+    ----------
+    journal_file: str
+        Location of the SQLite database.
+    timeout: float
+        How long to wait for a lock held by another process. Default: 60 sec
+    """
+    # Status of a job
+    SUBMITTED = 'submitted'
+    DONE = 'done'
+    FETCHED = 'fetched'
+    ERROR = 'error'
+    CANCELLED = 'cancelled'
+    LOST = 'lost'
+    DELETED = 'deleted'
+
+    # Jobs that can still be re-attached to
+    ACTIVE = (SUBMITTED, DONE)
+
+    COLUMNS = ['job_id', 'dr', 'rerun', 'sql_key', 'sql', 'status', 'error',
+               'submitted', 'updated']
+
+    def __init__(self, journal_file, timeout=60.):
+        self.journal_file = journal_file
+        self.timeout = timeout
+
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "job_id INTEGER PRIMARY KEY, dr TEXT NOT NULL, rerun TEXT NOT NULL, "
+                "sql_key TEXT NOT NULL, sql TEXT NOT NULL, status TEXT NOT NULL, "
+                "error TEXT, submitted REAL NOT NULL, updated REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_sql ON jobs (dr, rerun, sql_key)")
+
+    def _connect(self):
+        """
+        Open a new connection, so the journal can be used by different processes.
+        """
+        return sqlite3.connect(self.journal_file, timeout=self.timeout)
+
+    @staticmethod
+    def sql_key(sql):
+        """
+        Key of a SQL string, the same for queries that only differ in formatting.
+        """
+        return hashlib.sha1(normalize_sql(sql).encode('utf-8')).hexdigest()
+
+    def add(self, job_id, dr, rerun, sql):
+        """
+        Record a submitted job.
+        """
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (int(job_id), dr, rerun, self.sql_key(sql), sql, self.SUBMITTED, None, now, now))
+
+    def update(self, job_id, status, error=None):
+        """
+        Change the status of a job.
+        """
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, error = COALESCE(?, error), updated = ? "
+                "WHERE job_id = ?",
+                (status, error, time.time(), int(job_id)))
+
+    def get(self, job_id):
+        """
+        Return the record of a job as a dict, or None.
+        """
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT {} FROM jobs WHERE job_id = ?".format(', '.join(self.COLUMNS)),
+                (int(job_id), )).fetchone()
+        return None if row is None else dict(zip(self.COLUMNS, row))
+
+    def find(self, dr, rerun, sql):
+        """
+        Return the most recent active job of a SQL query as a dict, or None.
+        """
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT {} FROM jobs WHERE dr = ? AND rerun = ? AND sql_key = ? "
+                "AND status IN ({}) ORDER BY submitted DESC LIMIT 1".format(
+                    ', '.join(self.COLUMNS), ','.join('?' * len(self.ACTIVE))),
+                (dr, rerun, self.sql_key(sql)) + self.ACTIVE).fetchone()
+        return None if row is None else dict(zip(self.COLUMNS, row))
+
+    def jobs(self, status=None, dr=None, older_than=None):
+        """
+        List the jobs in the journal as dicts.
+
+        Parameters
+        ----------
+        status: str or list
+            Only the jobs with these status. Default: None
+        dr: str
+            Only the jobs of this data release. Default: None
+        older_than: float
+            Only the jobs submitted more than this number of seconds ago. Default: None
+        """
+        where, args = [], []
+        if status is not None:
+            status = [status] if isinstance(status, str) else list(status)
+            where.append("status IN ({})".format(','.join('?' * len(status))))
+            args += status
+        if dr is not None:
+            where.append("dr = ?")
+            args.append(dr)
+        if older_than is not None:
+            where.append("submitted < ?")
+            args.append(time.time() - older_than)
+
+        sql = "SELECT {} FROM jobs".format(', '.join(self.COLUMNS))
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        with self._connect() as conn:
+            rows = conn.execute(sql + " ORDER BY submitted", args).fetchall()
+        return [dict(zip(self.COLUMNS, row)) for row in rows]
+
+    def remove(self, job_id):
+        """
+        Forget a job.
+        """
+        with self._connect() as conn:
+            conn.execute("DELETE FROM jobs WHERE job_id = ?", (int(job_id), ))
+
+    def summary(self):
+        """
+        Number of jobs of each status.
+        """
+        with self._connect() as conn:
+            return dict(conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
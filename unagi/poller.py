@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Poll the status of the SQL jobs on the HSC archive"""
+
+import math
+import time
+import random
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+__all__ = ['QueryPoller']
+
+
+class QueryPoller():
+    """
+    Track the status of all the active SQL jobs with a single background thread.
+
+    Every job watched by the poller gets its own schedule: the first check is
+    `min_interval` seconds after it is watched, then the interval grows by
+    `factor` up to `max_interval`, with a random jitter so that the checks of
+    jobs submitted together do not hit the archive at the same time. Jobs
+    watched several times (e.g. by different threads) are only checked once
+    per round. The checks that are due run in a small pool of `max_workers`
+    threads, so that a check that hangs only delays its own job; a job is not
+    checked again before its previous check is over. As soon as a job is done
+    or failed, its future is resolved and its callbacks are called from the
+    thread of its last check, so they should be quick.
+
+    Errors of `check` are retried at the next check, but the future of the job
+    fails with the error after `max_failures` consecutive errors, or at once for
+    a HTTP client error (4xx, e.g. wrong credential or unknown job id).
+
+    Examples
+    --------
+
+        >>> poller = QueryPoller(archive.check_query, max_interval=10.)
+        >>> future = poller.watch(job['id'], callback=lambda job_id, status: print(status))
+        >>> status = future.result()
+
+    Parameters
+    ----------
+    check: callable
+        Function that takes a job id and returns its status dict, e.g.
+        `unagi.hsc.Hsc.check_query`.
+    min_interval: float
+        Interval before the first check of a job in seconds. Default: 1
+    max_interval: float
+        Maximum interval between two checks of a job in seconds. Default: 30
+    factor: float
+        Growth factor of the interval after each check. Default: 1.5
+    jitter: float
+        Relative amplitude of the random jitter of the interval. Default: 0.2
+    max_failures: int
+        Number of consecutive errors of `check` before giving up on a job. Default: 5
+    max_workers: int
+        Number of checks that can run at the same time. Default: 4
+    """
+    # Final status of a job
+    TERMINAL = ('done', 'error', 'cancelled', 'canceled', 'deleted')
+
+    def __init__(self, check, min_interval=1., max_interval=30., factor=1.5, jitter=0.2,
+                 max_failures=5, max_workers=4):
+        self.check = check
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.factor = factor
+        self.jitter = jitter
+        self.max_failures = max_failures
+        self.max_workers = max_workers
+
+        self.n_checks = 0
+
+        # {job_id: [next_check, interval, future, callbacks, failures]}
+        self._jobs = {}
+        self._wakeup = threading.Condition()
+        self._polling = False
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def __contains__(self, job_id):
+        return job_id in self._jobs
+
+    def delay(self, interval):
+        """
+        Jittered delay that never goes over max_interval.
+        """
+        delay = interval * random.uniform(1. - self.jitter, 1. + self.jitter)
+        return min(delay, self.max_interval)
+
+    def watch(self, job_id, callback=None):
+        """
+        Start to track a job, return a `concurrent.futures.Future` of its final status.
+
+        The final status is 'done', 'error', 'cancelled' or 'deleted'. If the
+        status can not be checked, the future fails with the error of `check`.
+
+        Parameters
+        ----------
+        callback: callable
+            Called with (job_id, status) when the job is done or failed; if the
+            status can not be checked, status is {'status': 'error', 'error': ...}.
+            Default: None
+        """
+        with self._wakeup:
+            if job_id not in self._jobs:
+                self._jobs[job_id] = [
+                    time.time() + self.delay(self.min_interval), self.min_interval, Future(),
+                    [], 0]
+            job = self._jobs[job_id]
+            if callback is not None:
+                job[3].append(callback)
+
+            if not self._polling:
+                self._polling = True
+                threading.Thread(target=self._run, daemon=True).start()
+            self._wakeup.notify()
+
+        return job[2]
+
+    def unwatch(self, job_id):
+        """
+        Stop tracking a job, e.g. after it is cancelled.
+        """
+        with self._wakeup:
+            job = self._jobs.pop(job_id, None)
+        if job is not None:
+            job[2].cancel()
+
+    def wait(self, job_id, timeout=None):
+        """
+        Block until a job is done or failed, return its final status.
+        """
+        return self.watch(job_id).result(timeout=timeout)
+
+    def _finish(self, job_id, status, error=None):
+        """
+        Resolve the future and call the callbacks of a finished job.
+
+        With `error`, the future fails with it instead.
+        """
+        with self._wakeup:
+            job = self._jobs.pop(job_id, None)
+        if job is None:
+            return
+
+        if error is None:
+            job[2].set_result(status)
+        else:
+            job[2].set_exception(error)
+        for callback in job[3]:
+            try:
+                callback(job_id, status)
+            except Exception as e:
+                print("# Callback of SQL job {} failed: {}".format(job_id, e))
+
+    def _run(self):
+        """
+        The polling loop: hand the checks that are due over to the pool.
+        """
+        pool = ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            while True:
+                with self._wakeup:
+                    if not self._jobs:
+                        self._polling = False
+                        return
+                    now = time.time()
+                    due = [job_id for job_id, job in self._jobs.items() if job[0] <= now]
+                    if not due:
+                        # All the remaining jobs may have a check in flight
+                        timeout = min(job[0] for job in self._jobs.values()) - now
+                        self._wakeup.wait(None if math.isinf(timeout) else timeout)
+                        continue
+                    for job_id in due:
+                        # Not due again until the end of this check
+                        self._jobs[job_id][0] = math.inf
+
+                for job_id in due:
+                    pool.submit(self._check, job_id)
+        finally:
+            pool.shutdown(wait=False)
+
+    def _check(self, job_id):
+        """
+        Check the status of a job, then finish it or schedule its next check.
+        """
+        try:
+            status = self.check(job_id)
+        except Exception as e:
+            with self._wakeup:
+                job = self._jobs.get(job_id)
+                failures = 0 if job is None else job[4] + 1
+                if job is not None:
+                    job[4] = failures
+            code = getattr(getattr(e, 'response', None), 'status_code', None)
+            if failures >= self.max_failures or (code is not None and 400 <= code < 500):
+                self._finish(job_id, {'status': 'error', 'error': str(e)}, error=e)
+                return
+            # Transient network error, try again at the next check
+            status = {'status': 'unknown'}
+        else:
+            with self._wakeup:
+                self.n_checks += 1
+            if status['status'] in self.TERMINAL:
+                self._finish(job_id, status)
+                return
+
+        with self._wakeup:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                if status['status'] != 'unknown':
+                    job[4] = 0
+                job[1] = min(job[1] * self.factor, self.max_interval)
+                job[0] = time.time() + self.delay(job[1])
+                self._wakeup.notify()
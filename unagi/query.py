@@ -2,12 +2,17 @@
 # -*- coding: utf-8 -*-
 """SQL search related functions"""
 
+import re
+
+import numpy as np
+
 from . import hsc
 
-__all__ = ['HELP_BASIC', 'COLUMNS_CONTAIN', 'TABLE_SCHEMA', 'PATCH_CONTAIN',
+__all__ = ['HELP_BASIC', 'COLUMNS_CONTAIN', 'TABLE_SCHEMA', 'PATCH_CONTAIN', 'PATCH_CORNERS',
            'DR1_CLEAN', 'DR2_CLEAN', 'basic_meas_photometry',
            'basic_forced_photometry', 'column_dict_to_str', 'join_table_by_id',
-           'box_search', 'cone_search']
+           'search_columns', 'box_search', 'cone_search', 'normalize_sql', 'split_box',
+           'in_tile', 'box_contains', 'wrap_ra_range']
 
 HELP_BASIC = "SELECT * FROM help('{0}');"
 
@@ -28,6 +33,25 @@ PATCH_CONTAIN = """
     ;
     """
 
+PATCH_CORNERS = """
+    --- Corners of all the coadded patch images
+    SELECT
+        mosaic.tract,
+        mosaic.patch,
+        mosaic.filter01,
+        mosaic.llcra, mosaic.llcdec,
+        mosaic.lrcra, mosaic.lrcdec,
+        mosaic.urcra, mosaic.urcdec,
+        mosaic.ulcra, mosaic.ulcdec
+    FROM
+        {0}.mosaic
+    ;
+    """
+
+# String literals, quoted identifiers and comments in a SQL string
+SQL_TOKENS = re.compile(
+    r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|--[^\n]*|/\*.*?\*/)", re.DOTALL)
+
 DR2_CLEAN = [
     'g_pixelflags_edge', 'r_pixelflags_edge', 'i_pixelflags_edge',
     'z_pixelflags_edge', 'z_pixelflags_edge',
@@ -698,11 +722,29 @@ def sql_clean_objects(rerun):
         # TODO: need to support other reruns
         raise NameError("Wrong rerun name")
 
+def search_columns(rerun, psf=True, cmodel=True, aper=False, meas=None,
+                   shape=False, flux=False, aper_type='3_20'):
+    """
+    Return the dict of columns selected by box_search() and cone_search().
+    """
+    column_dict = basic_forced_photometry(
+        rerun, psf=psf, cmodel=cmodel, aper=aper, shape=shape,
+        flux=flux, aper_type=aper_type)
+    # Only support wide filters for now
+    if meas and meas.strip() in 'grizy':
+        column_dict.update(basic_meas_photometry(rerun, meas.strip()))
+    return column_dict
+
 def box_search(ra1, ra2, dec1, dec2, primary=True, clean=False, dr='pdr2', rerun='pdr2_wide',
                archive=None, psf=True, cmodel=True, aper=False, meas=None,
-               shape=False, flux=False, aper_type='3_20', where_list=None):
+               shape=False, flux=False, aper_type='3_20', where_list=None,
+               tracts=None, columns=None):
     """
     Get the SQL template for box search.
+
+    `tracts` restricts the search to one or a list of tracts, and `columns` only
+    selects these columns (with `object_id`, `tract`, `ra` and `dec`) out of the
+    ones given by search_columns().
     """
     # Login to HSC archive
     if archive is None:
@@ -712,12 +754,15 @@ def box_search(ra1, ra2, dec1, dec2, primary=True, clean=False, dr='pdr2', rerun
         rerun = archive.rerun
 
     # The "SELECT" part of the SQL search
-    column_dict = basic_forced_photometry(
-        rerun, psf=psf, cmodel=cmodel, aper=aper, shape=shape,
+    column_dict = search_columns(
+        rerun, psf=psf, cmodel=cmodel, aper=aper, meas=meas, shape=shape,
         flux=flux, aper_type=aper_type)
-    # Only support wide filters for now
-    if meas and meas.strip() in 'grizy':
-        column_dict.update(basic_meas_photometry(rerun, meas.strip()))
+    if columns is not None:
+        unknown = set(columns) - set(column_dict)
+        if unknown:
+            raise KeyError("# Unknown columns: {}".format(', '.join(sorted(unknown))))
+        column_dict = {key: value for key, value in column_dict.items()
+                       if key in columns or key in ('object_id', 'tract', 'ra', 'dec')}
     select_str = column_dict_to_str(column_dict)
 
     # The "FROM" part of the SQL search
@@ -749,12 +794,18 @@ def box_search(ra1, ra2, dec1, dec2, primary=True, clean=False, dr='pdr2', rerun
     # from boxSearch(coord, 350, 10, dec1, dec2). In the former, ra ∈ [350, 360] ∪ [0, 10];
     # while in the latter, ra ∈ [10, 350].
     where_str = "WHERE boxSearch(coord, {0}, {1}, {2}, {3})".format(ra1, ra2, dec1, dec2)
+    if tracts is not None:
+        tracts = [int(t) for t in np.atleast_1d(tracts)]
+        if len(tracts) == 1:
+            where_str += ' AND forced.tract = {0}'.format(tracts[0])
+        else:
+            where_str += ' AND forced.tract IN ({0})'.format(', '.join(map(str, tracts)))
     if primary:
         where_str += ' AND isprimary'
     if clean:
-        where_str += sql_clean_objects(rerun)
+        where_str += ' ' + sql_clean_objects(rerun)
     if where_list:
-        where_str += " AND ".join(where_list)
+        where_str += ' AND ' + ' AND '.join(where_list)
 
     return ' '.join([select_str, from_str, where_str])
 
@@ -772,12 +823,9 @@ def cone_search(ra, dec, rad, primary=True, clean=False, dr='pdr2', rerun='pdr2_
         rerun = archive.rerun
 
     # The "SELECT" part of the SQL search
-    column_dict = basic_forced_photometry(
-        rerun, psf=psf, cmodel=cmodel, aper=aper, shape=shape,
+    column_dict = search_columns(
+        rerun, psf=psf, cmodel=cmodel, aper=aper, meas=meas, shape=shape,
         flux=flux, aper_type=aper_type)
-    # Only support wide filters for now
-    if meas and meas.strip() in 'grizy':
-        column_dict.update(basic_meas_photometry(rerun, meas.strip()))
     select_str = column_dict_to_str(column_dict)
 
     # The "FROM" part of the SQL search
@@ -805,8 +853,138 @@ def cone_search(ra, dec, rad, primary=True, clean=False, dr='pdr2', rerun='pdr2_
     if primary:
         where_str += ' AND isprimary'
     if clean:
-        where_str += sql_clean_objects(rerun)
+        where_str += ' ' + sql_clean_objects(rerun)
     if where_list:
-        where_str += " AND ".join(where_list)
+        where_str += ' AND ' + ' AND '.join(where_list)
 
     return ' '.join([select_str, from_str, where_str])
+
+def normalize_sql(sql):
+    """
+    Return a canonical form of a SQL string.
+
+    Comments are removed, whitespace is collapsed, and everything except string
+    literals and quoted identifiers is converted to lower case (the archive is
+    a PostgreSQL server, so unquoted keywords and names are case-insensitive).
+    """
+    parts = []
+    for ii, token in enumerate(SQL_TOKENS.split(sql)):
+        if ii % 2 == 1:
+            # Comments are dropped, literals are kept as they are
+            if not token.startswith(('--', '/*')):
+                parts.append(token)
+        else:
+            token = ' '.join(token.lower().split())
+            token = re.sub(r'\s*([(),;=<>+*/-])\s*', r'\1', token)
+            if token:
+                parts.append(token)
+
+    return ' '.join(parts).rstrip(';').strip()
+
+def _ra_span(ra1, ra2):
+    """Width of the RA range from ra1 to ra2 in degree, following boxSearch()."""
+    if ra2 - ra1 >= 360.0:
+        return 360.0
+    return (ra2 - ra1) % 360.0
+
+def wrap_ra_range(ra1, ra2):
+    """
+    Wrap a RA range into [0, 360] deg, following the convention of boxSearch().
+
+    The range goes from `ra1` to `ra2`; when it crosses RA=360 deg, the result has
+    ra1 > ra2, e.g. (350, 10) for the ranges (-10, 10) or (350, 370).
+    """
+    ra_span = _ra_span(ra1, ra2)
+    ra1 = ra1 % 360.0
+    if ra1 + ra_span <= 360.0:
+        return ra1, ra1 + ra_span
+    return ra1, ra1 + ra_span - 360.0
+
+def split_box(ra1, ra2, dec1, dec2, tile_size=1.0):
+    """
+    Split a box region into tiles of roughly equal area.
+
+    The box is first cut into bands of declination no taller than `tile_size`,
+    then each band is cut along RA so that the tiles are no wider than
+    `tile_size` on the sky. The RA range follows the convention of boxSearch():
+    it goes from `ra1` to `ra2` and can cross RA=360 deg. The RA edges of the
+    tiles are wrapped into [0, 360] deg, so a tile that crosses RA=360 deg has
+    ra1 > ra2 (see wrap_ra_range()).
+
+    Parameters:
+    -----------
+    ra1, ra2, dec1, dec2: float
+        Boundaries of the box in degree.
+    tile_size: float
+        Maximum size of the tiles in degree. Default: 1.0
+
+    Returns:
+    --------
+    tiles: list
+        List of (ra1, ra2, dec1, dec2) of the tiles.
+    """
+    ra_span = _ra_span(ra1, ra2)
+
+    n_dec = max(int(np.ceil((dec2 - dec1) / tile_size)), 1)
+    dec_edges = np.linspace(dec1, dec2, n_dec + 1)
+
+    tiles = []
+    for dec_low, dec_upp in zip(dec_edges[:-1], dec_edges[1:]):
+        # The band is widest on the sky at the declination closest to the equator
+        cos_dec = np.cos(np.deg2rad(min(abs(dec_low), abs(dec_upp))))
+        if dec_low <= 0.0 <= dec_upp:
+            cos_dec = 1.0
+        n_ra = max(int(np.ceil(ra_span * cos_dec / tile_size)), 1)
+        ra_edges = ra1 + np.linspace(0.0, ra_span, n_ra + 1)
+        for ra_low, ra_upp in zip(ra_edges[:-1], ra_edges[1:]):
+            ra_low, ra_upp = wrap_ra_range(float(ra_low), float(ra_upp))
+            tiles.append((ra_low, ra_upp, float(dec_low), float(dec_upp)))
+
+    return tiles
+
+def in_tile(ra, dec, tile, box):
+    """
+    Check which objects belong to a tile created by split_box().
+
+    Tiles are treated as half-open intervals, except along the outer edges of
+    the box, so that objects on the boundary of two tiles only belong to one.
+
+    Parameters:
+    -----------
+    ra, dec: numpy array
+        Coordinates of the objects in degree.
+    tile: tuple
+        (ra1, ra2, dec1, dec2) of the tile.
+    box: tuple
+        (ra1, ra2, dec1, dec2) of the whole region.
+    """
+    ra, dec = np.asarray(ra), np.asarray(dec)
+    ra_width = _ra_span(tile[0], tile[1])
+    ra_offset = (ra - tile[0]) % 360.0
+
+    # Whether the tile is at the upper RA edge of the box, both can cross RA=360 deg
+    tile_upper = (tile[0] - box[0]) % 360.0 + ra_width
+    if np.isclose(tile_upper, _ra_span(box[0], box[1])):
+        in_ra = ra_offset <= ra_width
+    else:
+        in_ra = ra_offset < ra_width
+
+    if np.isclose(tile[3], box[3]):
+        in_dec = (dec >= tile[2]) & (dec <= tile[3])
+    else:
+        in_dec = (dec >= tile[2]) & (dec < tile[3])
+
+    return in_ra & in_dec
+
+def box_contains(box, other):
+    """
+    Check whether a box region (ra1, ra2, dec1, dec2) contains another one.
+
+    The RA ranges follow the convention of boxSearch() and can cross RA=360 deg.
+    """
+    if other[2] < box[2] or other[3] > box[3]:
+        return False
+    ra_span = _ra_span(box[0], box[1])
+    if ra_span >= 360.0:
+        return True
+    return (other[0] - box[0]) % 360.0 + _ra_span(other[0], other[1]) <= ra_span + 1e-9
@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Run many SQL jobs on the HSC archive at the same time"""
+
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, CancelledError, as_completed
+
+from .hsc import QueryError
+from .journal import JobJournal
+from .poller import QueryPoller
+
+__all__ = ['QueryScheduler']
+
+
+class QueryScheduler():
+    """
+    Keep a bounded number of SQL jobs running on the HSC archive.
+
+    SQL strings are queued with `submit` (or `map`), at most `max_jobs` of them
+    are running on the archive at any time, all the running jobs are polled by
+    the shared `QueryPoller` of the archive, and the results are downloaded as
+    soon as the corresponding jobs are done.
+
+    Examples
+    --------
+
+        >>> archive = Hsc(dr='pdr2', rerun='pdr2_wide')
+        >>> with QueryScheduler(archive, max_jobs=4) as scheduler:
+        ...     for ii, result in scheduler.map(sql_list, ordered=False):
+        ...         result.write('region_{}.fits'.format(ii))
+
+    Parameters
+    ----------
+    archive: unagi.hsc.Hsc
+        The HSC archive object.
+    max_jobs: int
+        Maximum number of jobs running on the archive, should respect the
+        limit of the account. Default: 4
+    poll_interval: float
+        Initial interval between two status checks in seconds, only used when the
+        archive does not have a shared poller. Default: 1
+    max_interval: float
+        Maximum interval between two status checks in seconds, only used when the
+        archive does not have a shared poller. Default: 30
+    poller: unagi.poller.QueryPoller
+        Poller of the status of the jobs. Default: None, use `archive.poller`
+    delete_after: bool
+        Delete the job from the archive once the result is downloaded. Default: True
+    use_cache: bool
+        Use the SQL result cache of the archive if there is one. Default: True
+    verbose: bool
+        Print the progress. Default: False
+    """
+    def __init__(self, archive, max_jobs=4, poll_interval=1., max_interval=30.,
+                 delete_after=True, use_cache=True, verbose=False, poller=None):
+        self.archive = archive
+        self.max_jobs = max_jobs
+        self.poll_interval = poll_interval
+        self.max_interval = max_interval
+        self.delete_after = delete_after
+        self.use_cache = use_cache
+        self.verbose = verbose
+
+        if poller is None:
+            poller = getattr(archive, 'poller', None)
+        if poller is None:
+            poller = QueryPoller(archive.check_query, min_interval=poll_interval,
+                                 max_interval=max_interval)
+        self.poller = poller
+
+        # Queued (sql, future) and running {job_id: (sql, [futures])}, the same
+        # job can be shared by several futures when it is re-attached to
+        self._pending = deque()
+        self._running = {}
+
+        self._downloader = ThreadPoolExecutor(max_workers=max_jobs)
+        self._wakeup = threading.Condition()
+        self._shutdown = False
+        # Set once the downloader does not accept new work
+        self._closed = False
+        self._thread = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        self.shutdown(wait=exc_type is None, cancel=exc_type is not None)
+
+    @property
+    def n_pending(self):
+        """Number of queries waiting to be submitted."""
+        return len(self._pending)
+
+    @property
+    def n_running(self):
+        """Number of jobs running on the archive."""
+        return len(self._running)
+
+    def submit(self, sql):
+        """
+        Queue a SQL query, return a `concurrent.futures.Future` of its result.
+        """
+        future = Future()
+
+        with self._wakeup:
+            if self._shutdown:
+                raise RuntimeError("# Cannot submit a query after shutdown!")
+            self._pending.append((sql, future))
+            self._start()
+            self._wakeup.notify()
+
+        return future
+
+    def map(self, sql_list, ordered=True):
+        """
+        Run a list of SQL queries, yield (index, result) pairs.
+
+        Parameters
+        ----------
+        sql_list: list of str
+            List of SQL strings.
+        ordered: bool
+            Yield the results in the order of `sql_list`; otherwise yield them
+            as soon as they are available. Default: True
+        """
+        futures = [self.submit(sql) for sql in sql_list]
+        index = {future: ii for ii, future in enumerate(futures)}
+
+        if ordered:
+            for ii, future in enumerate(futures):
+                yield ii, future.result()
+        else:
+            for future in as_completed(futures):
+                yield index[future], future.result()
+
+    def shutdown(self, wait=True, cancel=False):
+        """
+        Stop the scheduler.
+
+        Parameters
+        ----------
+        wait: bool
+            Wait for all the queued queries to finish. Default: True
+        cancel: bool
+            Cancel the queued and running jobs. Default: False
+        """
+        with self._wakeup:
+            if cancel:
+                while self._pending:
+                    _, future = self._pending.popleft()
+                    future.cancel()
+                for job_id, (_, futures) in list(self._running.items()):
+                    self.poller.unwatch(job_id)
+                    self._cancel_job(job_id)
+                    for future in futures:
+                        future.set_exception(CancelledError(
+                            "# SQL job {} is cancelled".format(job_id)))
+                self._running.clear()
+            self._shutdown = True
+            self._wakeup.notify()
+
+        if wait and self._thread is not None:
+            self._thread.join()
+        with self._wakeup:
+            self._closed = True
+        self._downloader.shutdown(wait=wait)
+
+    def _start(self):
+        """
+        Start the submission thread if necessary.
+        """
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _update_journal(self, job_id, status, error=None):
+        """
+        Record the new status of a job in the journal of the archive, if there is one.
+        """
+        journal = getattr(self.archive, 'journal', None)
+        if journal is not None:
+            journal.update(job_id, status, error=error)
+
+    def _cancel_job(self, job_id):
+        """
+        Cancel and delete a job on the archive, ignore the errors.
+        """
+        try:
+            self.archive.cancel_query(job_id)
+            self.archive.delete_query(job_id)
+        except Exception:
+            pass
+
+    def _fill(self):
+        """
+        Submit queued queries until there are max_jobs running jobs.
+        """
+        while True:
+            with self._wakeup:
+                if not self._pending or len(self._running) >= self.max_jobs:
+                    return
+                sql, future = self._pending.popleft()
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            # No need to bother the archive if the result is already cached
+            if self.archive.query_cache is not None and self.use_cache:
+                key = self.archive.query_cache.sql_key(
+                    self.archive.dr, self.archive.rerun, sql)
+                result = self.archive.query_cache.get_table(key)
+                if result is not None:
+                    future.set_result(result)
+                    continue
+
+            try:
+                # Re-attach to the same job if it is in the journal of the archive
+                job = None
+                if getattr(self.archive, 'journal', None) is not None:
+                    job = self.archive.find_job(sql)
+                if job is None:
+                    job = self.archive.submit_query(sql)
+            except Exception as e:
+                future.set_exception(e)
+                continue
+
+            with self._wakeup:
+                # The journal found a job that this scheduler is already waiting for
+                if job['id'] in self._running:
+                    self._running[job['id']][1].append(future)
+                    continue
+                self._running[job['id']] = (sql, [future])
+            if self.verbose:
+                print("# Submitted SQL job {}".format(job['id']))
+            self.poller.watch(job['id'], callback=self._finished)
+
+    def _finished(self, job_id, status):
+        """
+        Called by the poller as soon as a job is done or failed.
+        """
+        # The work is handed over under the lock, so shutdown() cannot close
+        # the downloader in between
+        with self._wakeup:
+            # The job could have been cancelled in the meantime
+            running = self._running.pop(job_id, None)
+            self._wakeup.notify()
+            if running is None:
+                return
+            sql, futures = running
+
+            if status['status'] != 'done':
+                error = status.get('error', status['status'])
+                self._update_journal(job_id, JobJournal.ERROR, error=str(error))
+                for future in futures:
+                    future.set_exception(QueryError('query error: {}'.format(error)))
+                if not self._closed:
+                    self._downloader.submit(self._cancel_job, job_id)
+            elif self._closed:
+                # The job stays on the archive, the journal can re-attach to it
+                for future in futures:
+                    future.set_exception(RuntimeError(
+                        "# SQL job {} is done after the shutdown of the scheduler".format(
+                            job_id)))
+            else:
+                self._downloader.submit(self._download, job_id, sql, futures)
+
+    def _download(self, job_id, sql, futures):
+        """
+        Download and parse the result of a finished job.
+        """
+        try:
+            self._update_journal(job_id, JobJournal.DONE)
+            response = self.archive.get_query_result(job_id)
+            result = self.archive.parse_query_result(response)
+            self._update_journal(job_id, JobJournal.FETCHED)
+
+            if self.archive.query_cache is not None and self.use_cache and result is not None:
+                key = self.archive.query_cache.sql_key(
+                    self.archive.dr, self.archive.rerun, sql)
+                self.archive.query_cache.put_table(key, result)
+
+            if self.delete_after:
+                self.archive.delete_query(job_id)
+        except Exception as e:
+            for future in futures:
+                future.set_exception(e)
+        else:
+            if self.verbose:
+                print("# Downloaded the result of SQL job {}".format(job_id))
+            for future in futures:
+                future.set_result(result)
+
+    def _run(self):
+        """
+        Submit the queued queries whenever a running job finishes.
+        """
+        while True:
+            self._fill()
+
+            with self._wakeup:
+                if self._shutdown and not self._pending and not self._running:
+                    return
+                if not self._pending or len(self._running) >= self.max_jobs:
+                    self._wakeup.wait()
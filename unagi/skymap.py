@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Local model of the HSC skymap"""
+
+import numpy as np
+
+from astropy import wcs
+
+__all__ = ['RingsSkyMap', 'patch_name', 'parse_patch']
+
+
+def patch_name(patch_x, patch_y):
+    """
+    Name of a patch in the format of '6,7', as used by the archive.
+    """
+    return np.char.add(np.char.add(np.asarray(patch_x).astype(str), ','),
+                       np.asarray(patch_y).astype(str))
+
+
+def parse_patch(patch):
+    """
+    Index of a patch from its name '6,7', or from the integer format 607 of
+    the PDR2 catalogs.
+    """
+    if isinstance(patch, str):
+        patch_x, patch_y = patch.split(',')
+        return int(patch_x), int(patch_y)
+    return int(patch) // 100, int(patch) % 100
+
+
+class RingsSkyMap():
+    """
+    Model of the `RingsSkyMap` used by the HSC pipeline.
+
+    The sky is divided into `num_rings` rings of constant declination plus two
+    polar caps. Each ring is divided into tracts, each tract has a TAN WCS
+    centered on the tract, and the tract is divided into a grid of patches of
+    `patch_inner` pixels, with `patch_border` pixels of overlap on each side
+    (so the HSC patches are 4200 x 4200 pixels).
+
+    All the methods take and return NumPy arrays, so assigning millions of
+    coordinates to tracts and patches is a single vectorized call, and does
+    not need a connection to the archive.
+
+    Examples
+    --------
+
+        >>> skymap = RingsSkyMap()
+        >>> tract, patch, x, y = skymap.find_patch(ra, dec)
+        >>> url = archive._form_patch_url(tract[0], patch[0], 'HSC-I')
+
+    Parameters
+    ----------
+    num_rings: int
+        Number of rings. Default: 120
+    ra_start: float
+        RA of the first tract of each ring in degree. Default: 0.
+    pixel_scale: float
+        Pixel scale in arcsec. Default: 0.168
+    patch_inner: int
+        Size of the inner region of the patches in pixel. Default: 4000
+    patch_border: int
+        Size of the overlapping border of the patches in pixel. Default: 100
+    tract_overlap: float
+        Minimum overlap between the tracts in degree. Default: 1 / 60.
+    """
+    def __init__(self, num_rings=120, ra_start=0., pixel_scale=0.168, patch_inner=4000,
+                 patch_border=100, tract_overlap=1. / 60.):
+        self.num_rings = num_rings
+        self.ra_start = ra_start
+        self.pixel_scale = pixel_scale
+        self.patch_inner = patch_inner
+        self.patch_border = patch_border
+        self.tract_overlap = tract_overlap
+
+        # Number of tracts in each ring
+        self.ring_size = np.pi / (num_rings + 1)
+        start_dec = self.ring_size * (np.arange(num_rings) + 0.5) - 0.5 * np.pi
+        stop_dec = start_dec + self.ring_size
+        dec = np.minimum(np.fabs(start_dec), np.fabs(stop_dec))
+        self.ring_nums = (2 * np.pi * np.cos(dec) / self.ring_size).astype('int64') + 1
+        self._ring_offset = np.concatenate([[1], 1 + np.cumsum(self.ring_nums)])
+        self.n_tracts = int(self.ring_nums.sum()) + 2
+
+        # Bounding box of the tracts: the smallest grid of patches that covers a
+        # circle of the size of the ring plus the overlap, centered on the tract
+        radius = 0.5 * self.ring_size + np.deg2rad(tract_overlap)
+        half = np.tan(radius) / np.deg2rad(pixel_scale / 3600.)
+        min_pix, max_pix = int(np.floor(-half + 0.5)), int(np.ceil(half - 0.5))
+        self.n_patches = int(np.ceil((max_pix - min_pix + 1) / patch_inner))
+        self.tract_dim = self.n_patches * patch_inner
+        # Pixel coordinate of the tract center (0-based)
+        self.crpix = ((self.tract_dim - (max_pix - min_pix + 1)) // 2) - min_pix
+
+    def tract_center(self, tract):
+        """
+        RA, Dec of the center of the tracts in degree.
+        """
+        tract = np.atleast_1d(np.asarray(tract, dtype='int64'))
+        ra, dec = np.zeros(len(tract)), np.zeros(len(tract))
+
+        dec[tract == 0] = -90.
+        dec[tract == self.n_tracts - 1] = 90.
+
+        ring_tract = (tract > 0) & (tract < self.n_tracts - 1)
+        ring = np.searchsorted(self._ring_offset, tract[ring_tract], side='right') - 1
+        index = tract[ring_tract] - self._ring_offset[ring]
+        dec[ring_tract] = np.rad2deg(self.ring_size * (ring + 1) - 0.5 * np.pi)
+        ra[ring_tract] = (np.rad2deg(2 * np.pi * index / self.ring_nums[ring]) +
+                          self.ra_start) % 360.
+
+        return ra, dec
+
+    def find_tract(self, ra, dec):
+        """
+        Tract that contains each coordinate.
+        """
+        ra = np.deg2rad(np.atleast_1d(np.asarray(ra, dtype='float64')))
+        dec = np.deg2rad(np.atleast_1d(np.asarray(dec, dtype='float64')))
+
+        first_ring_start = self.ring_size * 0.5 - 0.5 * np.pi
+        ring = np.clip(np.floor((dec - first_ring_start) / self.ring_size).astype('int64'),
+                       0, self.num_rings - 1)
+        ring_num = self.ring_nums[ring]
+        index = (np.mod(ra - np.deg2rad(self.ra_start), 2 * np.pi) /
+                 (2 * np.pi / ring_num) + 0.5).astype('int64')
+        index[index == ring_num] = 0
+
+        tract = self._ring_offset[ring] + index
+        tract[dec < first_ring_start] = 0
+        tract[dec > -first_ring_start] = self.n_tracts - 1
+        return tract
+
+    def sky_to_pixel(self, tract, ra, dec):
+        """
+        Pixel coordinates (0-based) of the coordinates in the tracts.
+        """
+        ra_0, dec_0 = self.tract_center(tract)
+        ra_0, dec_0 = np.deg2rad(ra_0), np.deg2rad(dec_0)
+        ra = np.deg2rad(np.atleast_1d(np.asarray(ra, dtype='float64')))
+        dec = np.deg2rad(np.atleast_1d(np.asarray(dec, dtype='float64')))
+
+        # Gnomonic projection
+        cos_c = (np.sin(dec_0) * np.sin(dec) +
+                 np.cos(dec_0) * np.cos(dec) * np.cos(ra - ra_0))
+        xi = np.cos(dec) * np.sin(ra - ra_0) / cos_c
+        eta = (np.cos(dec_0) * np.sin(dec) -
+               np.sin(dec_0) * np.cos(dec) * np.cos(ra - ra_0)) / cos_c
+
+        scale = np.deg2rad(self.pixel_scale / 3600.)
+        return self.crpix - xi / scale, self.crpix + eta / scale
+
+    def pixel_to_sky(self, tract, x, y):
+        """
+        RA, Dec in degree of the pixel coordinates (0-based) in the tracts.
+        """
+        ra_0, dec_0 = self.tract_center(tract)
+        ra_0, dec_0 = np.deg2rad(ra_0), np.deg2rad(dec_0)
+
+        scale = np.deg2rad(self.pixel_scale / 3600.)
+        xi = (self.crpix - np.asarray(x, dtype='float64')) * scale
+        eta = (np.asarray(y, dtype='float64') - self.crpix) * scale
+
+        # Inverse gnomonic projection
+        denom = np.cos(dec_0) - eta * np.sin(dec_0)
+        ra = ra_0 + np.arctan2(xi, denom)
+        dec = np.arctan2(np.sin(dec_0) + eta * np.cos(dec_0), np.hypot(xi, denom))
+        return np.rad2deg(ra) % 360., np.rad2deg(dec)
+
+    def find_patch(self, ra, dec):
+        """
+        Tract, patch and pixel coordinates (0-based, in the tract) of the coordinates.
+
+        Return
+        ------
+        tract: array
+            Tract numbers.
+        patch: array
+            Patch names in the format of '6,7'.
+        x, y: array
+            Pixel coordinates in the tract, the same as in the `calexp` images.
+        """
+        tract = self.find_tract(ra, dec)
+        x, y = self.sky_to_pixel(tract, ra, dec)
+        patch_x, patch_y = self.patch_index(x, y)
+        return tract, patch_name(patch_x, patch_y), x, y
+
+    def patch_index(self, x, y):
+        """
+        Index of the patches that contain the pixel coordinates.
+        """
+        patch_x = np.clip(np.floor(np.asarray(x) / self.patch_inner).astype('int64'),
+                          0, self.n_patches - 1)
+        patch_y = np.clip(np.floor(np.asarray(y) / self.patch_inner).astype('int64'),
+                          0, self.n_patches - 1)
+        return patch_x, patch_y
+
+    def patch_bbox(self, patch_x, patch_y):
+        """
+        Pixel bounding box (x0, y0, x1, y1) of the patch images, including the border.
+
+        The upper limits are exclusive.
+        """
+        patch_x, patch_y = np.asarray(patch_x), np.asarray(patch_y)
+        x0 = np.maximum(patch_x * self.patch_inner - self.patch_border, 0)
+        y0 = np.maximum(patch_y * self.patch_inner - self.patch_border, 0)
+        x1 = np.minimum((patch_x + 1) * self.patch_inner + self.patch_border, self.tract_dim)
+        y1 = np.minimum((patch_y + 1) * self.patch_inner + self.patch_border, self.tract_dim)
+        return x0, y0, x1, y1
+
+    def tract_wcs(self, tract):
+        """
+        `astropy.wcs.WCS` of a tract.
+        """
+        ra_0, dec_0 = self.tract_center(tract)
+
+        tract_wcs = wcs.WCS(naxis=2)
+        tract_wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+        tract_wcs.wcs.crval = [ra_0[0], dec_0[0]]
+        tract_wcs.wcs.crpix = [self.crpix + 1., self.crpix + 1.]
+        tract_wcs.wcs.cd = [[-self.pixel_scale / 3600., 0.], [0., self.pixel_scale / 3600.]]
+        return tract_wcs
+
+    def box_tracts(self, ra1, ra2, dec1, dec2, step=0.05):
+        """
+        Tracts that contain part of the box [ra1, ra2] x [dec1, dec2] in degree.
+
+        The box is sampled on a grid of `step` degree, so that the result can be
+        used to split a search of the region into one query per tract.
+        """
+        ra_span = (ra2 - ra1) % 360.
+        n_ra = int(np.ceil(ra_span / step)) + 1
+        n_dec = int(np.ceil((dec2 - dec1) / step)) + 1
+        ra, dec = np.meshgrid(ra1 + np.linspace(0., ra_span, n_ra),
+                              np.linspace(dec1, dec2, n_dec))
+        return np.unique(self.find_tract(ra.ravel() % 360., dec.ravel()))
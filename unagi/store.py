@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Local store of the HSC coadd patch images"""
+
+import os
+import warnings
+
+import numpy as np
+
+import astropy.units as u
+from astropy.io import fits
+from astropy.table import Table
+
+from .skymap import RingsSkyMap, parse_patch
+
+__all__ = ['PatchStore', 'check_fits']
+
+
+def check_fits(file_name):
+    """
+    Check that a FITS file is complete.
+
+    The headers of all the HDUs are parsed, and the data of the last HDU must
+    end exactly at the end of the file, so truncated downloads are rejected
+    without reading the data.
+    """
+    file_size = os.path.getsize(file_name)
+    if file_size == 0 or file_size % 2880 != 0:
+        return False
+    try:
+        with fits.open(file_name, memmap=True, lazy_load_hdus=False) as hdu_list:
+            info = hdu_list[-1].fileinfo()
+            return info['datLoc'] + info['datSpan'] == file_size
+    except (OSError, ValueError, IndexError):
+        return False
+
+
+class PatchStore():
+    """
+    Local mirror of the coadded `calexp` patch images.
+
+    The images are organized as `<root>/<rerun>/<filter>/<tract>/`, and use the
+    same file names as the archive, e.g. `calexp-HSC-I-9813-4,4.fits`. Files
+    are written to a temporary name and only renamed once they are complete,
+    so a file in the store is never a partial download.
+
+    Once the patches are in the store, `get_cutout_image` makes cutouts from
+    them without going through the archive.
+
+    Parameters
+    ----------
+    root: str
+        Root directory of the store.
+    rerun: str
+        Name of the rerun. Default: 'pdr2_wide'
+    skymap: unagi.skymap.RingsSkyMap
+        Skymap model of the rerun. Default: the HSC `RingsSkyMap`.
+    """
+    # Extensions of the calexp images
+    PLANES = ['IMAGE', 'MASK', 'VARIANCE']
+    DEFAULT_IMG_SIZE = 10.0 * u.arcsec
+
+    def __init__(self, root, rerun='pdr2_wide', skymap=None):
+        self.root = root
+        self.rerun = rerun
+        self.skymap = RingsSkyMap() if skymap is None else skymap
+
+    @staticmethod
+    def patch_str(patch):
+        """
+        Patch in the format of '6,7'.
+        """
+        return '{},{}'.format(*parse_patch(patch))
+
+    def path(self, tract, patch, filt):
+        """
+        Location of a patch image in the store.
+        """
+        patch = self.patch_str(patch)
+        file_name = '-'.join(['calexp', filt, str(tract), patch]) + '.fits'
+        return os.path.join(self.root, self.rerun, filt, str(tract), file_name)
+
+    def exists(self, tract, patch, filt, verify=False):
+        """
+        Whether a patch image is in the store, and is complete if `verify` is True.
+        """
+        file_name = self.path(tract, patch, filt)
+        if not os.path.isfile(file_name):
+            return False
+        return check_fits(file_name) if verify else True
+
+    def open(self, tract, patch, filt, memmap=True):
+        """
+        Open a patch image in the store.
+        """
+        return fits.open(self.path(tract, patch, filt), memmap=memmap)
+
+    def write(self, tract, patch, filt, chunks, expected_size=None):
+        """
+        Write a patch image from an iterator of bytes, e.g. `response.iter_content()`.
+
+        Parameters
+        ----------
+        expected_size: int
+            Size of the file in bytes, e.g. the `Content-Length` of the response.
+            Default: None
+        """
+        file_name = self.path(tract, patch, filt)
+        if not os.path.isdir(os.path.dirname(file_name)):
+            os.makedirs(os.path.dirname(file_name), exist_ok=True)
+
+        temp_file = file_name + '.part'
+        size = 0
+        try:
+            with open(temp_file, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    size += len(chunk)
+
+            if expected_size is not None and size != expected_size:
+                raise IOError("# Incomplete download: {}/{} bytes of {}".format(
+                    size, expected_size, file_name))
+            if not check_fits(temp_file):
+                raise IOError("# Not a complete FITS file: {}".format(file_name))
+
+            os.replace(temp_file, file_name)
+        finally:
+            if os.path.isfile(temp_file):
+                os.remove(temp_file)
+
+        return file_name
+
+    def patches(self, filt=None):
+        """
+        Table of the tracts, patches and filters in the store.
+        """
+        rows = []
+        rerun_dir = os.path.join(self.root, self.rerun)
+        filters = [filt] if filt is not None else (
+            sorted(os.listdir(rerun_dir)) if os.path.isdir(rerun_dir) else [])
+
+        for band in filters:
+            band_dir = os.path.join(rerun_dir, band)
+            if not os.path.isdir(band_dir):
+                continue
+            for tract in sorted(os.listdir(band_dir)):
+                for file_name in sorted(os.listdir(os.path.join(band_dir, tract))):
+                    if not file_name.endswith('.fits'):
+                        continue
+                    patch = file_name[:-5].split('-')[-1]
+                    rows.append((int(tract), patch, band))
+
+        return Table(rows=rows if rows else None, names=['tract', 'patch', 'filter01'],
+                     dtype=['int64', 'U5', 'U10'])
+
+    def _cutout_box(self, coord, coord_2=None, w_half=None, h_half=None):
+        """
+        Tract and pixel bounding box (x0, y0, nx, ny) of a cutout.
+        """
+        if coord_2 is not None:
+            # Use the tract at the middle of the two corners
+            ra_1, dec_1 = coord.ra.deg, coord.dec.deg
+            ra_2 = ra_1 + (coord_2.ra.deg - ra_1 + 180.) % 360. - 180.
+            tract = self.skymap.find_tract((ra_1 + ra_2) / 2. % 360.,
+                                           (dec_1 + coord_2.dec.deg) / 2.)
+            x, y = self.skymap.sky_to_pixel(
+                np.repeat(tract, 2), [ra_1, coord_2.ra.deg], [dec_1, coord_2.dec.deg])
+            x0, y0 = int(np.round(x.min())), int(np.round(y.min()))
+            return tract[0], x0, y0, int(np.round(x.max())) - x0 + 1, int(np.round(y.max())) - y0 + 1
+
+        w_half = self.DEFAULT_IMG_SIZE if w_half is None else w_half
+        h_half = self.DEFAULT_IMG_SIZE if h_half is None else h_half
+        w_half = w_half.to(u.arcsec).value if isinstance(w_half, u.Quantity) else float(w_half)
+        h_half = h_half.to(u.arcsec).value if isinstance(h_half, u.Quantity) else float(h_half)
+
+        tract = self.skymap.find_tract(coord.ra.deg, coord.dec.deg)
+        x, y = self.skymap.sky_to_pixel(tract, coord.ra.deg, coord.dec.deg)
+
+        # Same size as the cutout of the archive
+        nx = 2 * int(round(w_half / self.skymap.pixel_scale)) + 1
+        ny = 2 * int(round(h_half / self.skymap.pixel_scale)) + 1
+        return tract[0], int(np.round(x[0])) - nx // 2, int(np.round(y[0])) - ny // 2, nx, ny
+
+    def get_cutout_image(self, coord, coord_2=None, w_half=None, h_half=None, filt='HSC-I',
+                         img_type='coadd', image=True, variance=False, mask=False, verbose=False,
+                         use_cache=True):
+        """
+        Get HSC cutout image from the patches in the store.
+
+        Same as `unagi.hsc.Hsc.get_cutout_image`, but only the pixels of the cutout
+        are read from the memory-mapped patch images, and the cutout is stitched
+        from the inner regions of all the patches it overlaps. Pixels without a
+        patch in the store are NaN (0 in the mask). `use_cache` is ignored.
+
+        A cutout is always made from the patches of a single tract, the one that
+        contains its center. When the cutout crosses into a neighbouring tract, the
+        pixels beyond the patches of that tract are NaN, and a warning is issued;
+        use the archive for such cutouts.
+
+        Parameters:
+        -----------
+        coord: astropy.coordinates.SkyCoord
+            Center of the cutout, or its first corner if `coord_2` is used.
+        w_half, h_half: float or astropy.units.Quantity
+            Half of the image width and height, in arcsec if it is a float.
+        """
+        from .hsc import Hsc
+
+        if img_type != 'coadd':
+            raise ValueError("# Only coadd cutouts can be made from the patch store")
+
+        if filt not in Hsc.FILTER_LIST:
+            if filt not in Hsc.FILTER_SHORT:
+                raise ValueError('Unknown filter: {}'.format(filt))
+            filt = Hsc.FILTER_LIST[Hsc.FILTER_SHORT.index(filt)]
+
+        planes = [name for name, flag in zip(self.PLANES, [image, mask, variance]) if flag]
+        tract, x0, y0, nx, ny = self._cutout_box(
+            coord, coord_2=coord_2, w_half=w_half, h_half=h_half)
+
+        # The patches of the other tracts are not used
+        corners_x, corners_y = [x0, x0 + nx - 1, x0, x0 + nx - 1], [y0, y0, y0 + ny - 1, y0 + ny - 1]
+        ra, dec = self.skymap.pixel_to_sky(np.repeat(tract, 4), corners_x, corners_y)
+        outside = (min(x0, y0) < 0 or max(x0 + nx, y0 + ny) > self.skymap.tract_dim)
+        if outside or np.any(self.skymap.find_tract(ra, dec) != tract):
+            warnings.warn("# The cutout crosses the boundary of tract {}, the pixels that are "
+                          "not in its patches are NaN".format(tract))
+
+        inner, n_patches = self.skymap.patch_inner, self.skymap.n_patches
+        data, header = {}, None
+        for patch_y in range(max(y0 // inner, 0), min((y0 + ny - 1) // inner, n_patches - 1) + 1):
+            for patch_x in range(max(x0 // inner, 0), min((x0 + nx - 1) // inner, n_patches - 1) + 1):
+                patch = '{},{}'.format(patch_x, patch_y)
+                if not self.exists(tract, patch, filt):
+                    if verbose:
+                        print("# Patch {} {} {} is not in the store".format(tract, patch, filt))
+                    continue
+
+                # Overlap between the cutout and the inner region of the patch
+                xx0, xx1 = max(x0, patch_x * inner), min(x0 + nx, (patch_x + 1) * inner)
+                yy0, yy1 = max(y0, patch_y * inner), min(y0 + ny, (patch_y + 1) * inner)
+
+                if verbose:
+                    print("# Read [{}:{}, {}:{}] from {}".format(
+                        yy0, yy1, xx0, xx1, self.path(tract, patch, filt)))
+
+                with self.open(tract, patch, filt) as hdu_list:
+                    if header is None:
+                        header = {'PRIMARY': hdu_list[0].header.copy()}
+                    for name in planes:
+                        hdu = hdu_list[name]
+                        # Origin of the patch image in the tract
+                        px0 = -int(hdu.header.get('LTV1', -self.skymap.patch_bbox(patch_x, patch_y)[0]))
+                        py0 = -int(hdu.header.get('LTV2', -self.skymap.patch_bbox(patch_x, patch_y)[1]))
+
+                        if name not in data:
+                            dtype = hdu.section[0:1, 0:1].dtype
+                            fill = 0 if np.issubdtype(dtype, np.integer) else np.nan
+                            data[name] = np.full((ny, nx), fill, dtype=dtype)
+                            header[name] = hdu.header.copy()
+                            for key, shift in [('CRPIX1', x0 - px0), ('CRPIX2', y0 - py0),
+                                               ('CRPIX1A', x0 - px0), ('CRPIX2A', y0 - py0),
+                                               ('LTV1', x0 - px0), ('LTV2', y0 - py0)]:
+                                if key in header[name]:
+                                    header[name][key] = header[name][key] - shift
+
+                        data[name][yy0 - y0:yy1 - y0, xx0 - x0:xx1 - x0] = hdu.section[
+                            yy0 - py0:yy1 - py0, xx0 - px0:xx1 - px0]
+
+        if header is None:
+            raise IOError("# No patch of tract {} in the store covers the cutout".format(tract))
+
+        hdus = [fits.PrimaryHDU(header=header['PRIMARY'])]
+        for name in planes:
+            hdus.append(fits.ImageHDU(data=data[name], header=header[name], name=name))
+        return fits.HDUList(hdus)
@@ -1,34 +1,43 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import io
 import os
-import shutil
+import hashlib
+import tarfile
+import multiprocessing
 import tempfile
+import threading
 import time
-import glob
 from collections.abc import Iterable
 
 import requests
-import tarfile
 import numpy as np
 import astropy.units as u
 from astropy import wcs
+from astropy.coordinates import SkyCoord
 from astropy.io import fits
-from astropy.utils.data import download_file
+from astropy.table import Table, unique, vstack
 from astropy.visualization import make_lupton_rgb
-from multiprocessing import Pool
 from functools import partial
-from fits2hdf.io.fitsio import read_fits
-from fits2hdf.io.hdfio import export_hdf
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from collections import deque
+from queue import Queue, Empty
 import h5py
-from tenacity import retry, stop_after_attempt, wait_random
 
 from . import query
 from .hsc import Hsc
+from .footprint import FootprintIndex
+from .skymap import RingsSkyMap
+from .store import PatchStore
+from .scheduler import QueryScheduler
+from .bulk import (AdaptiveController, CutoutManifest, StackedCutoutWriter, cutout_stamps,
+                   file_checksum, iter_tar_members, plan_cutout_groups, write_fits_hdf)
 from .utils import r_phy_to_ang
 
 __all__ = ['hsc_tricolor', 'hsc_cutout', 'hsc_psf',
-           'hsc_cone_search', 'hsc_box_search', 'hsc_check_coverage']
+           'hsc_cone_search', 'hsc_box_search', 'hsc_check_coverage',
+           'hsc_tract_patch', 'hsc_bulk_patch', 'hsc_bulk_cutout']
 
 ANG_UNITS = ['arcsec', 'arcsecond', 'arcmin', 'arcminute', 'deg']
 PHY_UNITS = ['pc', 'kpc', 'Mpc']
@@ -37,9 +46,11 @@ def hsc_tricolor(coord, cutout_size=10.0 * u.Unit('arcsec'), coord_2=None,
                  filters='gri', dr='dr2', rerun='s18a_wide', redshift=None,
                  cosmo=None, prefix=None, use_saved=False, save_img=False,
                  verbose=True, rgb_order=False, hdu=1, archive=None, output_dir='./',
-                 save_rgb=False, rgb_q=15, rgb_stretch=0.5, rgb_min=0):
+                 save_rgb=False, rgb_q=15, rgb_stretch=0.5, rgb_min=0, max_workers=None):
     """
     Generate HSC 3-color picture using coadd image.
+
+    The three bands are retrieved concurrently using up to `max_workers` threads.
     """
     # Login to HSC archive
     if archive is None:
@@ -114,11 +125,8 @@ def hsc_tricolor(coord, cutout_size=10.0 * u.Unit('arcsec'), coord_2=None,
     else:
         rgb_jpg = None
 
-    # List of RGB data
-    rgb_cube = []
-
-    # Load the cutout images in three bands
-    for ii, filt in enumerate(filter_list):
+    def _get_cutout(ii):
+        filt = filter_list[ii]
         if fits_save[ii] and use_saved:
             if verbose:
                 print("# Read in saved FITS file: {}".format(fits_save[ii]))
@@ -130,11 +138,15 @@ def hsc_tricolor(coord, cutout_size=10.0 * u.Unit('arcsec'), coord_2=None,
                 coord, coord_2=coord_2, w_half=ang_size_w, h_half=ang_size_h, filt=filt)
             if save_img:
                 _ = cutout_hdu.writeto(fits_list[ii], overwrite=True)
+        return cutout_hdu
+
+    # Load the cutout images in three bands
+    cutout_list = _map_filters(_get_cutout, len(filter_list), max_workers=max_workers)
 
-        if ii == 0:
-            cutout_wcs = wcs.WCS(cutout_hdu[hdu].header)
+    cutout_wcs = wcs.WCS(cutout_list[0][hdu].header)
 
-        rgb_cube.append(cutout_hdu[hdu].data)
+    # List of RGB data
+    rgb_cube = [cutout_hdu[hdu].data for cutout_hdu in cutout_list]
 
     # If the filters are not in RGB order, reverse it
     if not rgb_order:
@@ -149,9 +161,18 @@ def hsc_tricolor(coord, cutout_size=10.0 * u.Unit('arcsec'), coord_2=None,
 def hsc_cutout(coord, coord_2=None, cutout_size=10.0 * u.Unit('arcsec'), filters='i',
                dr='dr2', rerun='s18a_wide', redshift=None, cosmo=None, img_type='coadd',
                prefix=None, verbose=True, archive=None, save_output=True, use_saved=False,
-               output_dir='./', **kwargs):
+               output_dir='./', max_workers=None, extract_warp=False, **kwargs):
     """
     Generate HSC cutout images.
+
+    The cutouts in different bands are retrieved concurrently using up to
+    `max_workers` threads (Default: one per filter), and returned in the
+    order of `filters`.
+
+    For `img_type='warp'`, the tarball of warped images is saved by default.
+    With `extract_warp=True`, the tarball is streamed and extracted on the fly
+    instead: the warped images are returned as a list of HDUList, and saved as
+    FITS files in one directory per filter if `save_output` is True.
     """
     # Login to HSC archive
     if archive is None:
@@ -211,23 +232,30 @@ def hsc_cutout(coord, coord_2=None, cutout_size=10.0 * u.Unit('arcsec'), filters
     # List of fits file
     if img_type == 'coadd':
         output_list = ['_'.join([prefix, f]) + '.fits' for f in filter_list]
+    elif img_type == 'warp' and extract_warp:
+        output_list = ['_'.join([prefix, f]) for f in filter_list]
     elif img_type == 'warp':
         output_list = ['_'.join([prefix, f]) + '.tar' for f in filter_list]
     else:
         raise Exception("# Wrong image type: coadd or warp !")
 
     # Availability of each file
-    file_available = [os.path.isfile(f) or os.path.islink(f) for f in output_list]
+    file_available = [os.path.isfile(f) or os.path.islink(f) or os.path.isdir(f)
+                      for f in output_list]
 
     # Get the cutout in each band
-    cutout_list = []
-
-    for ii, filt in enumerate(filter_list):
+    def _get_cutout(ii):
+        filt = filter_list[ii]
         if file_available[ii] and use_saved:
             if img_type == 'coadd':
                 if verbose:
                     print("# Read in saved FITS file: {}".format(output_list[ii]))
                 cutout_hdu = fits.open(output_list[ii])
+            elif extract_warp:
+                if verbose:
+                    print("# Read in saved warped images in: {}".format(output_list[ii]))
+                cutout_hdu = [fits.open(os.path.join(output_list[ii], f))
+                              for f in sorted(os.listdir(output_list[ii])) if f.endswith('.fits')]
             else:
                 if verbose:
                     print("# Read in saved TAR file: {}".format(output_list[ii]))
@@ -240,112 +268,363 @@ def hsc_cutout(coord, coord_2=None, cutout_size=10.0 * u.Unit('arcsec'), filters
                 else:
                     print("# Retrieving warped images in filter: {}".format(filt))
 
-            # Get the FITS data or the URL of compressed tarball
+            # Get the FITS data or the URL of compressed tarball. The coadd image is
+            # streamed to the output file and memory-mapped when it is saved.
+            output_file = output_list[ii] if (img_type == 'coadd' and save_output) else None
             cutout_hdu = archive.get_cutout_image(
                 coord, coord_2=coord_2, w_half=ang_size_w, h_half=ang_size_h,
-                filt=filt, img_type=img_type, **kwargs)
+                filt=filt, img_type=img_type, output_file=output_file, **kwargs)
 
-            if img_type == 'coadd' and save_output:
-                # Download FITS file for coadd image.
-                _ = cutout_hdu.writeto(output_list[ii], overwrite=True)
-
-            if img_type == 'warp':
+            if img_type == 'warp' and extract_warp:
+                # Extract the warpped images while downloading the tarball.
+                cutout_hdu = _stream_warp(
+                    archive, cutout_hdu, output_dir=output_list[ii] if save_output else None)
+            elif img_type == 'warp':
                 # Download the tarball for warpped images.
-                _ = shutil.move(
-                    download_file(cutout_hdu, show_progress=False), output_list[ii])
+                _ = archive._download_file(cutout_hdu, output_list[ii])
+
+        return cutout_hdu
 
-        # Append the HDU to the list
-        cutout_list.append(cutout_hdu)
+    cutout_list = _map_filters(_get_cutout, len(filter_list), max_workers=max_workers)
 
     if len(filter_list) == 1:
         return cutout_list[0]
 
     return cutout_list
 
-# 5 Attempts at downloading the batch, waiting between 5 and 30s between attempts
-@retry(wait=wait_random(min=5, max=30), stop=stop_after_attempt(5))
-def _download_cutouts(args, url=None, filters=None, tmp_dir=None, auth=None):
-    list_table, ids, batch_index = args
-
-    session = requests.Session()
-    session.auth = auth
-
-    output_file = os.path.join(tmp_dir, 'batch_cutout_%d.hdf'%batch_index)
-    # Check if output cutout file exists, if it does, we are good
-    # TODO: check that file  is ok, but it most probably is
-    if os.path.isfile(output_file):
-        print('Found cutout file for batch file %d, skipping download'%batch_index)
-        return output_file
-
-    # Download batches for all bands
-    output_paths = {}
-    for filt in filters:
-        print('Download filter %s for batch %d'%(filt, batch_index))
-        list_table['filter'] = filt
+def _stream_warp(archive, url, output_dir=None, chunk_size=1048576):
+    """Extract the warped images from a tarball while it is downloaded."""
+    if output_dir is not None and not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
 
-        # Saving download file to folder
-        filename = os.path.join(tmp_dir, ('batch_%s_%d')%(filt, batch_index))
-        list_table.write(filename, format='ascii.tab')
+    hdu_list = []
+    with archive._http_get(url, stream=True) as response:
+        response.raw.decode_content = True
+        for name, content in iter_tar_members(response.raw, bufsize=chunk_size):
+            if not name.endswith('.fits'):
+                continue
+            if output_dir is not None:
+                with open(os.path.join(output_dir, os.path.basename(name)), 'wb') as f:
+                    f.write(content)
+            hdu_list.append(fits.open(io.BytesIO(content)))
+
+    return hdu_list
+
+def _parse_retry_after(value):
+    """Delay in seconds from the Retry-After header of a response."""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def _store_cutout(content, file_names, ra=None, dec=None, w_half=None, h_half=None):
+    """
+    Check that a cutout is a valid FITS file, save it, and return its checksum.
 
-        # Request download
-        resp = session.post(url, files={'list': open(filename, 'rb')}, stream=True)
+    If the coordinates of several targets are given, the cutout is shared by
+    all of them: their stamps are sliced out of it and saved in `file_names`.
+    Return the list of checksums.
 
-        # Checking that access worked after number of retries
-        assert(resp.status_code == 200)
-        tar_filename = resp.headers['Content-Disposition'].split('"')[-2]
+    This is the CPU-bound part of the download, it runs in a process pool.
+    """
+    with fits.open(io.BytesIO(content)) as hdu_list:
+        hdu_list.verify('exception')
+        for hdu in hdu_list:
+            _ = hdu.data
+
+        if ra is not None:
+            contents = []
+            for stamp in cutout_stamps(hdu_list, ra, dec, w_half, h_half):
+                buffer = io.BytesIO()
+                stamp.writeto(buffer)
+                contents.append(buffer.getvalue())
+        else:
+            contents = [content]
 
-        # Proceed to download the data
-        with open(os.path.join(tmp_dir, tar_filename), 'wb') as f:
-            for chunk in resp.iter_content(chunk_size=1024):
-                f.write(chunk)
+    checksums = []
+    for file_name, data in zip(file_names, contents):
+        with open(file_name, 'wb') as f:
+            f.write(data)
+        # Same as file_checksum, without reading the file again
+        checksums.append(hashlib.sha1(data).hexdigest())
 
-        # Untar the archive and remove file
-        with tarfile.TarFile(os.path.join(tmp_dir, tar_filename), "r") as tarball:
-            tarball.extractall(tmp_dir)
+    return checksums
+
+def _download_cutouts(args, url=None, tmp_dir=None, manifest_file=None, session=None,
+                      timeout=None, cpu_pool=None, slots=None, w_half=None, h_half=None,
+                      chunk_size=1048576):
+    """
+    Download the cutouts of one batch of objects in one filter.
 
-        # Removing tar file after extraction
+    Each row of the list table is one cutout, shared by the objects listed
+    in `members`: an array of (object_id, ra, dec) for each row. Cutouts of
+    more than one object are sliced in stamps of `w_half` x `h_half` arcsec.
+
+    This is the I/O-bound part of the download, it runs in a thread and uses
+    the shared `session`. The cutouts are handed over to the `cpu_pool` as
+    they come out of the tarball; `slots` is a semaphore that bounds the
+    number of cutouts waiting there, so the download slows down when the CPU
+    stage cannot keep up.
+
+    Return (batch_index, status, retry_after, elapsed), where status is the
+    HTTP status code of the request, or None if the request failed.
+    """
+    list_table, members, batch_index, filt = args
+
+    # The manifest records every cutout, so the driver only requests the missing ones
+    manifest = CutoutManifest(manifest_file)
+    object_dir = os.path.join(tmp_dir, 'objects')
+
+    list_table = list_table.copy()
+    list_table['filter'] = filt
+
+    # Saving download file to folder
+    filename = os.path.join(tmp_dir, ('batch_%s_%d')%(filt, batch_index))
+    list_table.write(filename, format='ascii.tab', overwrite=True)
+
+    def _release(future):
+        slots.release()
+
+    def _record(stored):
+        """Add the cutouts that are saved to the manifest."""
+        records = []
+        for object_ids, output_filenames, future in stored:
+            try:
+                records += [(object_id, filt, batch_index, output_filename, checksum)
+                            for object_id, output_filename, checksum in
+                            zip(object_ids, output_filenames, future.result())]
+            except Exception as e:
+                print('Invalid cutout for objects %s in filter %s: %s'%(
+                    ', '.join('%d'%i for i in object_ids), filt, e))
+        manifest.add(records)
+
+    start = time.time()
+    stored = []
+    try:
+        # Request download
+        with open(filename, 'rb') as list_file:
+            resp = session.post(url, files={'list': list_file}, stream=True, timeout=timeout)
+
+        with resp:
+            if resp.status_code != 200:
+                return (batch_index, resp.status_code,
+                        _parse_retry_after(resp.headers.get('Retry-After')), time.time() - start)
+
+            # Stream the tarball, each FITS file is saved under the name of its
+            # object, it will be written into the final output directly
+            resp.raw.decode_content = True
+            for name, content in iter_tar_members(resp.raw, bufsize=chunk_size):
+                if not name.endswith('.fits'):
+                    continue
+                indx = int(os.path.basename(name).split('-')[0]) - 2
+                objects = members[indx]
+                output_filenames = [os.path.join(object_dir, '%d_%s.fits'%(object_id, filt))
+                                    for object_id in objects['object_id']]
+
+                slots.acquire()
+                if len(objects) > 1:
+                    future = cpu_pool.submit(
+                        _store_cutout, content, output_filenames, ra=objects['ra'],
+                        dec=objects['dec'], w_half=w_half, h_half=h_half)
+                else:
+                    future = cpu_pool.submit(_store_cutout, content, output_filenames)
+                future.add_done_callback(_release)
+                stored.append((objects['object_id'], output_filenames, future))
+
+                # Record the progress regularly, so a crash only loses a few objects
+                if len(stored) >= 100 and stored[0][2].done():
+                    _record(stored)
+                    stored = []
+    except (requests.exceptions.RequestException, tarfile.TarError) as e:
+        print('Download of batch %d in filter %s failed: %s'%(batch_index, filt, e))
+        return batch_index, None, None, time.time() - start
+    finally:
+        _record(stored)
         os.remove(filename)
-        os.remove(os.path.join(tmp_dir, tar_filename))
-
-        # Recover path to output dir
-        output_path = os.path.join(tmp_dir, tar_filename.split('.tar')[0])
-        output_paths[filt] = output_path
-
-        # Transform each file into an HDFFITS format, named based on the object ids
-        fnames = glob.glob(output_path+'/*.fits')
-        for fname in fnames:
-            indx = int(fname.split(output_path+'/')[1].split('-')[0]) - 2
-            output_filename = os.path.join(output_path, '%d.hdf'%ids[indx])
-            a = read_fits(fname)
-            export_hdf(a, output_filename)
-            # Removing converted file
-            os.remove(fname)
-
-    # At this stage all filters have been  downloaded for this batch, now
-    # aggregating all of them into a single HDF file
-    with h5py.File(output_file, mode='w') as d:
-        for id in ids:
-            for f in filters:
-                with h5py.File( os.path.join(output_paths[f], '%d.hdf'%id), mode='r+') as s:
-                    d.copy(s, '%d/%s'%(id,f))
-
-    # For good measure, remove all temporary directory
-    for f in filters:
-        shutil.rmtree(output_paths[f])
-
-    return output_file
+
+    return batch_index, 200, None, time.time() - start
+
+def _run_downloads(download, todo, controller, n_threads, max_attempts=5, verbose=True):
+    """
+    Download the cutouts of a bulk job, batch by batch.
+
+    `todo` is a list of (filter, list table, members) of the cutouts to
+    download, see `_download_cutouts`. The batches are cut from it on the fly,
+    so their size and the number of concurrent requests follow the
+    `controller`. Failed batches are sent again, at most `max_attempts` times.
+    """
+    work = deque((filt, list_table, members, 0) for filt, list_table, members in todo
+                 if len(list_table))
+    done = Queue()
+    in_flight = {}
+    batch_index = 0
+
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        while work or in_flight:
+            # Send new requests while the controller allows it
+            while work and len(in_flight) < controller.concurrency and not controller.wait_time:
+                filt, list_table, members, attempt = work.popleft()
+                size = controller.batch_size
+                if len(list_table) > size:
+                    work.appendleft((filt, list_table[size:], members[size:], attempt))
+                    list_table, members = list_table[:size], members[:size]
+                if verbose:
+                    print('Download filter %s for batch %d (%d cutouts)'%(
+                        filt, batch_index, len(list_table)))
+                in_flight[batch_index] = (filt, list_table, members, attempt)
+                future = pool.submit(download, (list_table, members, batch_index, filt))
+                future.add_done_callback(
+                    lambda f: done.put(f.exception() if f.exception() else f.result()))
+                batch_index += 1
+
+            if not in_flight:
+                time.sleep(controller.wait_time)
+                continue
+
+            try:
+                result = done.get(timeout=(controller.wait_time or None) if work else None)
+            except Empty:
+                continue
+            if isinstance(result, Exception):
+                raise result
+
+            index, status, retry_after, elapsed = result
+            filt, list_table, members, attempt = in_flight.pop(index)
+            if status == 200:
+                controller.success(len(list_table), elapsed)
+                continue
+
+            # The archive is overloaded, it can say for how long
+            if status in (429, 503):
+                controller.throttled(retry_after)
+            else:
+                controller.failure()
+
+            if attempt + 1 < max_attempts:
+                work.appendleft((filt, list_table, members, attempt + 1))
+            else:
+                print('Giving up on %d cutouts in filter %s after %d attempts'%(
+                    len(list_table), filt, max_attempts))
+
+    return controller.summary()
+
+def _merge_cutouts(output_filename, ids, filters, manifest, chunk_size=1000,
+                   layout='groups', planes=('IMAGE',), **kwargs):
+    """
+    Write the downloaded cutouts into the final HDF5 file.
+
+    Objects are merged in chunks, and the manifest is only updated once a
+    chunk is safely written, so an interrupted merge can be resumed. Return the
+    list of objects that could not be merged because their cutout is missing
+    or corrupted; they are removed from the manifest.
+
+    With `layout='groups'`, each cutout goes to its own `object_id/filter`
+    group; with `layout='stacked'`, all cutouts go to dense arrays (see
+    `unagi.bulk.StackedCutoutWriter`, which receives the other `kwargs`).
+    """
+    merged = manifest.merged_cutouts(ids)
+    failed = []
+
+    # Objects are written one by one, the chunk cache must hold a few chunks
+    # of the stacked layout to avoid compressing them again at every write
+    with h5py.File(output_filename, 'a', rdcc_nbytes=256 * 1024 ** 2,
+                   rdcc_nslots=10007, rdcc_w0=1.) as d:
+        if layout == 'stacked':
+            writer = StackedCutoutWriter(d, ids, filters, planes=planes, **kwargs)
+
+        for start in range(0, len(ids), chunk_size):
+            # Only the filters that are not merged yet, e.g. when filters are added
+            chunk = [(start + ii, i, [f for f in filters if (int(i), f) not in merged])
+                     for ii, i in enumerate(ids[start:start + chunk_size])]
+            done, temp_files = [], []
+            for index, object_id, todo in chunk:
+                if not todo:
+                    continue
+                for f in todo:
+                    key = '%d/%s'%(object_id, f)
+                    # Left over from an interrupted merge
+                    if layout == 'groups' and key in d:
+                        del d[key]
+
+                records = [manifest.get(object_id, f) for f in todo]
+                bad = [f for f, record in zip(todo, records)
+                       if record is None or not os.path.isfile(record[0])
+                       or file_checksum(record[0]) != record[1]]
+                if bad:
+                    for f in bad:
+                        manifest.remove(object_id, f)
+                    if layout == 'stacked':
+                        writer.clear(index)
+                    failed.append(object_id)
+                    continue
+
+                for f, (path, _, _) in zip(todo, records):
+                    if layout == 'stacked':
+                        writer.write(index, f, path)
+                    else:
+                        write_fits_hdf(d.create_group('%d/%s'%(object_id, f)), path)
+                    temp_files.append(path)
+                    done.append((object_id, f))
+
+            d.flush()
+            manifest.mark_merged(done)
+
+            # Now that they are safely merged, remove the temporary files
+            for f in temp_files:
+                os.remove(f)
+
+    return failed
 
 def hsc_bulk_cutout(table, cutout_size=10.0 * u.Unit('arcsec'),
                     filters='i', dr='dr2', rerun='s18a_wide', img_type='coadd',
                     verbose=True, archive=None,
                     image=True, variance=False, mask=False, nproc=1,
-                    tmp_dir=None, output_dir='./', overwrite=False, **kwargs):
+                    tmp_dir=None, output_dir='./', overwrite=False, layout='groups',
+                    chunks=None, compression=None, compression_opts=None, controller=None,
+                    n_cpu=None, queue_size=256, group_targets=False, **kwargs):
     """
     Generate HSC cutout images in bulk.
 
     table: astropy table
         Astropy table of with at least object_id, and (ra, dec) in deg.
+    tmp_dir: str
+        Directory for the downloaded cutouts and the manifest of the job.
+        Run again with the same `tmp_dir` to resume an interrupted job.
+    layout: str
+        Layout of the output file. 'groups': one `object_id/filter` group per
+        cutout. 'stacked': dense (N, n_filters, n_planes, H, W) arrays in the
+        order of the table, see `unagi.bulk.StackedCutoutWriter`. Default: 'groups'
+    chunks: int or tuple
+        For the 'stacked' layout, number of objects in a HDF5 chunk, or the
+        shape of a chunk. Default: None, one object per chunk
+    compression: str
+        For the 'stacked' layout, compression of the datasets, e.g. 'gzip' or 'lzf'.
+        Default: None
+    compression_opts:
+        For the 'stacked' layout, options of the compression filter. Default: None
+    nproc: int
+        Maximum number of concurrent download requests. The requests run in
+        threads that share the HTTP session of the archive. Default: 1
+    controller: unagi.bulk.AdaptiveController
+        Adapts the number of objects per request and the number of concurrent
+        requests to the latency, the throughput and the errors of the archive.
+        Default: None, start with small batches and one request, and go up to
+        1000 objects per request and `nproc` concurrent requests.
+    n_cpu: int
+        Number of processes that check and save the downloaded cutouts. They are
+        started with the 'spawn' method, so scripts need a `__main__` guard.
+        Default: None, the number of CPUs
+    queue_size: int
+        Maximum number of downloaded cutouts waiting to be saved. Default: 256
+    group_targets: bool
+        Download one larger cutout for groups of nearby objects, and slice the
+        cutouts of the objects out of it locally, see
+        `unagi.bulk.plan_cutout_groups`. Saves bandwidth for clustered
+        targets. Default: False
     """
+    if layout not in ('groups', 'stacked'):
+        raise ValueError("# Wrong layout: groups or stacked !")
+
     # Login to HSC archive
     if archive is None:
         archive = Hsc(dr=dr, rerun=rerun)
@@ -355,19 +634,33 @@ def hsc_bulk_cutout(table, cutout_size=10.0 * u.Unit('arcsec'),
         if dr[0] == 'p':
             rerun = rerun.replace(dr + '_', '')
 
-    # Creates a requests session
-    auth = (archive.archive._username, archive.archive._password)
-
     # Get temporary directory for dowloading and staging
     if tmp_dir is None:
         tmp_dir = tempfile.mkdtemp()
 
+    if not os.path.exists(os.path.join(tmp_dir, 'objects')):
+        os.makedirs(os.path.join(tmp_dir, 'objects'))
+
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
+    # Progress of the job, used to resume it if it is interrupted
+    manifest_file = os.path.join(tmp_dir, 'manifest.sqlite')
+    manifest = CutoutManifest(manifest_file)
+
     output_filename = os.path.join(output_dir, 'cutouts_%s_%s_%s.hdf'%(dr, rerun, img_type))
-    if not overwrite:
-        assert not os.path.isfile(output_filename), "Output file already exists: %s"%output_filename
+    if os.path.isfile(output_filename):
+        if overwrite:
+            os.remove(output_filename)
+            manifest.reset_merged()
+        else:
+            # An output file that is not in the manifest is not ours to touch
+            assert manifest.merged_cutouts(table['object_id']), \
+                "Output file already exists: %s"%output_filename
+            print("Resuming the job in %s"%tmp_dir)
+    else:
+        # The cutouts merged into an output file that is gone have to be downloaded again
+        manifest.reset_merged()
 
     # Ensure correct filters
     filter_list = list(filters)
@@ -390,56 +683,199 @@ def hsc_bulk_cutout(table, cutout_size=10.0 * u.Unit('arcsec'),
     else:
         ang_size_w = ang_size_h = _get_cutout_size(cutout_size, verbose=verbose)
 
-    # Compute the number of batches to download
-    # There is a hard limit of 1000 cutouts at a time
-    batch_size = 1000
-    n_batches = len(table) // batch_size
-    if len(table) % batch_size > 0:
-        n_batches = n_batches + 1
-
-    # Step 1: Create batches of object ids and coordinates
-    batches = []
-    for batch_index in range(n_batches):
-        list_table = table[['ra', 'dec', 'object_id']][batch_index*batch_size:(batch_index+1)*batch_size]
-        list_table['sw'] = str(ang_size_w.value)+'asec'
-        list_table['sh'] = str(ang_size_h.value)+'asec'
+    # Step 1: List of object ids and coordinates
+    objects = np.empty(len(table), dtype=[('object_id', 'int64'), ('ra', 'float64'), ('dec', 'float64')])
+    objects['object_id'] = table['object_id']
+    objects['ra'] = table['ra']
+    objects['dec'] = table['dec']
+    ids = objects['object_id']
+
+    # Only the cutouts that are not in the manifest yet are downloaded
+    todo = []
+    n_objects, n_pixels, n_pixels_single = 0, 0., 0.
+    for filt in filter_list:
+        rows = np.flatnonzero(np.isin(ids, manifest.missing(ids, filt)))
+        if len(rows) == 0:
+            print('Found all cutouts in filter %s, skipping download'%filt)
+            continue
+
+        if group_targets:
+            # Nearby objects share one larger cutout
+            groups = plan_cutout_groups(
+                objects['ra'][rows], objects['dec'][rows], ang_size_w.value, ang_size_h.value,
+                max_size=archive.MAX_CUTOUT.to(u.Unit('arcsec')).value)
+            ra, dec, sw, sh = [np.array([g[k] for g in groups]) for k in range(4)]
+            members = [objects[rows[g[4]]] for g in groups]
+        else:
+            ra, dec = objects['ra'][rows], objects['dec'][rows]
+            sw = np.full(len(rows), ang_size_w.value)
+            sh = np.full(len(rows), ang_size_h.value)
+            members = [objects[ii:ii + 1] for ii in rows]
+
+        n_objects += len(rows)
+        n_pixels += np.sum(4. * sw * sh)
+        n_pixels_single += len(rows) * 4. * ang_size_w.value * ang_size_h.value
+
+        list_table = Table()
+        list_table['#?'] = np.full(len(ra), '')
+        list_table['ra'] = ra
+        list_table['dec'] = dec
+        list_table['sw'] = [str(w)+'asec' for w in sw]
+        list_table['sh'] = [str(h)+'asec' for h in sh]
+        list_table['filter'] = filt
         list_table['rerun'] = archive.rerun
-        list_table['filter'] = archive._check_filter(filters[0])
-        list_table['type'] = img_type
         list_table['image'] = 'true' if image else 'false'
         list_table['variance'] = 'true' if variance else 'false'
         list_table['mask'] = 'true' if mask else 'false'
-        list_table['#?'] = ''
-        # Saving object ids corresponding to the downloaded objects
-        ids = list_table['object_id']
-        list_table = list_table[['#?', 'ra', 'dec', 'sw', 'sh', 'filter', 'rerun', 'image', 'variance', 'mask', 'type']]
-        batches.append((list_table, ids, batch_index))
+        list_table['type'] = img_type
+        todo.append((filt, list_table, members))
+
+    if group_targets and n_objects:
+        print("# %d objects in %d cutouts, %.0f%% fewer pixels to download"%(
+            n_objects, sum(len(t) for _, t, _ in todo), 100. * (1. - n_pixels / n_pixels_single)))
 
     # Step 2: Download fits files
-    download_cutouts = partial(_download_cutouts,
-                               url=archive.archive.img_url,
-                               tmp_dir=tmp_dir,
-                               filters=filter_list,
-                               auth=auth)
-
-    #  Downloading mutliple batches of data in parallel
-    print("Starting download of %d batches ..."%n_batches)
-    with Pool(nproc) as pool:
-        temp_files = pool.map(download_cutouts, batches, chunksize=1)
+    # The batch size and the number of concurrent requests adapt to the archive
+    if controller is None:
+        controller = AdaptiveController(max_concurrency=nproc)
+    n_threads = max(nproc, controller.max_concurrency)
+    # One keep-alive connection per download thread, the default pool only keeps 10
+    archive.mount_pool(archive.archive.img_url, n_threads)
+
+    #  Downloading mutliple batches of data in parallel: the requests run in
+    #  threads, the downloaded cutouts are checked and saved by processes.
+    #  The processes are started lazily by the download threads, forking
+    #  while other threads hold the locks of requests can deadlock, so they
+    #  are spawned instead
+    print("Starting download of %d cutouts ..."%sum(len(t) for _, t, _ in todo))
+    with ProcessPoolExecutor(max_workers=n_cpu,
+                             mp_context=multiprocessing.get_context('spawn')) as cpu_pool:
+        download_cutouts = partial(_download_cutouts,
+                                   url=archive.archive.img_url,
+                                   tmp_dir=tmp_dir,
+                                   manifest_file=manifest_file,
+                                   session=archive.session,
+                                   timeout=archive.timeout,
+                                   cpu_pool=cpu_pool,
+                                   slots=threading.BoundedSemaphore(queue_size),
+                                   w_half=ang_size_w.value,
+                                   h_half=ang_size_h.value)
+        stats = _run_downloads(download_cutouts, todo, controller,
+                               n_threads, verbose=verbose)
     print("Download finalized, aggregating cutouts.")
+    if verbose:
+        print("# Requests: %(success)d done, %(throttled)d throttled, %(failure)d failed; "
+              "final batch size %(batch_size)d, concurrency %(concurrency)d"%stats)
 
     # At this point, we have a bunch of individual HDF files, we just need to
-    # merge them back together
-    with h5py.File(output_filename, 'w') as d:
-        for f in temp_files:
-            with h5py.File(f,'r') as s:
-                for k in s.keys():
-                    d.copy(s[k], '/'+k)
-            # Now that everything is done, remove temporary hdf file
-            os.remove(f)
+    # merge them together
+    planes = [p for p, use in zip(['IMAGE', 'MASK', 'VARIANCE'], [image, mask, variance]) if use]
+    failed = _merge_cutouts(output_filename, table['object_id'], filter_list, manifest,
+                            layout=layout, planes=planes, chunks=chunks,
+                            compression=compression, compression_opts=compression_opts)
+    if failed:
+        raise Exception(
+            "# %d objects have missing or corrupted cutouts, run again with tmp_dir=%s "
+            "to download them"%(len(failed), tmp_dir))
 
     return output_filename
 
+def _download_patch(args, archive=None, store=None, chunk_size=1048576, max_attempts=3):
+    """Stream one patch image into the patch store, retry on failures."""
+    tract, patch, filt = args
+    url = archive._form_patch_url(tract, store.patch_str(patch), filt)
+
+    for attempt in range(max_attempts):
+        try:
+            with archive._http_get(url, stream=True) as response:
+                expected_size = response.headers.get('Content-Length')
+                return store.write(
+                    tract, patch, filt, response.iter_content(chunk_size=chunk_size),
+                    expected_size=int(expected_size) if expected_size else None)
+        except requests.exceptions.HTTPError as e:
+            # The patch does not exist, there is no point to retry
+            if e.response is not None and e.response.status_code == 404:
+                return None
+            error = e
+        except (requests.exceptions.RequestException, IOError) as e:
+            error = e
+        time.sleep(2 ** attempt)
+
+    print("# Can not download patch {} {} {}: {}".format(tract, patch, filt, error))
+    return None
+
+def hsc_bulk_patch(patches, store, dr='pdr2', rerun='pdr2_wide', archive=None, n_threads=4,
+                   overwrite=False, verify=False, chunk_size=1048576, max_attempts=3,
+                   verbose=True):
+    """
+    Download the coadded `calexp` images of a list of patches into a local patch store.
+
+    The images are streamed to disk by `n_threads` concurrent requests that share the
+    HTTP session of the archive. Images that are already in the store are skipped, and
+    a download is only kept when it is a complete FITS file of the expected size.
+
+    Parameters
+    ----------
+    patches: list or astropy.table.Table
+        List of (tract, patch, filter), or a table with `tract`, `patch` and `filter01`
+        columns, e.g. from `unagi.footprint.FootprintIndex`. Patch can be '6,7' or 607,
+        filter can be 'HSC-I' or 'i'.
+    store: str or unagi.store.PatchStore
+        Patch store, or its root directory.
+    n_threads: int
+        Number of concurrent downloads. Default: 4
+    overwrite: bool
+        Download the images that are already in the store again. Default: False
+    verify: bool
+        Check that the images already in the store are complete FITS files, and
+        download them again otherwise. Default: False
+
+    Return
+    ------
+        List of the files in the store, None for the patches that can not be downloaded.
+    """
+    # Login to HSC archive
+    if archive is None:
+        archive = Hsc(dr=dr, rerun=rerun)
+    else:
+        dr = archive.dr
+        rerun = archive.rerun
+
+    if not isinstance(store, PatchStore):
+        store = PatchStore(store, rerun=rerun)
+
+    if isinstance(patches, Table):
+        patches = zip(patches['tract'], patches['patch'], patches['filter01'])
+    patches = [(int(tract), store.patch_str(patch), archive._check_filter(str(filt).strip()))
+               for tract, patch, filt in patches]
+
+    if overwrite:
+        todo = list(patches)
+    else:
+        todo = [p for p in patches if not store.exists(*p, verify=verify)]
+    if verbose:
+        print("# {}/{} patches are already in the store".format(len(patches) - len(todo), len(patches)))
+
+    download = partial(_download_patch, archive=archive, store=store, chunk_size=chunk_size,
+                       max_attempts=max_attempts)
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        for ii, output in enumerate(pool.map(download, todo)):
+            if verbose and output is not None:
+                print("# {}/{}: {}".format(ii + 1, len(todo), output))
+
+    return [store.path(*p) if store.exists(*p) else None for p in patches]
+
+def _map_filters(func, n_filters, max_workers=None):
+    """Call func(index) for each filter concurrently and keep the order of the results."""
+    if max_workers is None:
+        max_workers = n_filters
+
+    if max_workers <= 1 or n_filters <= 1:
+        return [func(ii) for ii in range(n_filters)]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(func, range(n_filters)))
+
 def _get_cutout_size(cutout_size, redshift=None, cosmo=None, verbose=True):
     """Parse the input for the size of the cutout."""
     if not isinstance(cutout_size, u.quantity.Quantity):
@@ -465,9 +901,13 @@ def _get_cutout_size(cutout_size, redshift=None, cosmo=None, verbose=True):
 
 def hsc_psf(coord, centered=True, filters='i', dr='dr2', rerun='s18a_wide',
             img_type='coadd', prefix=None, verbose=True, archive=None, save_output=True,
-            use_saved=False, output_dir='./'):
+            use_saved=False, output_dir='./', max_workers=None):
     """
     Generate HSC PSF models.
+
+    The PSF models in different bands are retrieved concurrently using up to
+    `max_workers` threads (Default: one per filter), and returned in the
+    order of `filters`.
     """
     # Login to HSC archive
     if archive is None:
@@ -508,9 +948,8 @@ def hsc_psf(coord, centered=True, filters='i', dr='dr2', rerun='s18a_wide',
     file_available = [os.path.isfile(f) or os.path.islink(f) for f in output_list]
 
     # Get the cutout in each band
-    psf_list = []
-
-    for ii, filt in enumerate(filter_list):
+    def _get_psf(ii):
+        filt = filter_list[ii]
         if file_available[ii] and use_saved:
             if img_type == 'coadd':
                 if verbose:
@@ -538,22 +977,72 @@ def hsc_psf(coord, centered=True, filters='i', dr='dr2', rerun='s18a_wide',
 
             if img_type == 'warp':
                 # Download the tarball for warpped images.
-                _ = shutil.move(
-                    download_file(psf_hdu, show_progress=False), output_list[ii])
+                _ = archive._download_file(psf_hdu, output_list[ii])
+
+        return psf_hdu
 
-        # Append the HDU to the list
-        psf_list.append(psf_hdu)
+    psf_list = _map_filters(_get_psf, len(filter_list), max_workers=max_workers)
 
     if len(filter_list) == 1:
         return psf_list[0]
 
     return psf_list
 
+def _sharded_search(archive, box, tiles, tile_select=None, output_dir=None,
+                    max_jobs=4, verbose=True, **kwargs):
+    """
+    Run one box search per tile through a QueryScheduler and gather the results.
+
+    Objects on the boundary of two tiles are only kept in one of them, and
+    `tile_select(objects)` can further remove the objects outside the region.
+    If `output_dir` is set, each tile is written to its own FITS file as soon
+    as it arrives and the list of files is returned instead of a table.
+    """
+    sql_list = [query.box_search(*tile, archive=archive, **kwargs) for tile in tiles]
+
+    if verbose:
+        print("# Split the search region into {} tiles".format(len(tiles)))
+
+    if output_dir is not None and not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    results = []
+    with QueryScheduler(archive, max_jobs=max_jobs, verbose=verbose) as scheduler:
+        for ii, objects in scheduler.map(sql_list, ordered=False):
+            objects = objects[query.in_tile(objects['ra'], objects['dec'], tiles[ii], box)]
+            if tile_select is not None:
+                objects = objects[tile_select(objects)]
+
+            if output_dir is None:
+                results.append(objects)
+            else:
+                tile_file = os.path.join(output_dir, 'search_tile_{:04d}.fits'.format(ii))
+                objects.write(tile_file, overwrite=True)
+                results.append(tile_file)
+                if verbose:
+                    print("# Save tile {} to {}".format(ii, tile_file))
+
+    if output_dir is not None:
+        return sorted(results)
+
+    return unique(vstack(results, metadata_conflicts='silent'), keys='object_id')
+
+def _get_tile_size(tile_size):
+    """Parse the size of the tiles, in degree."""
+    if isinstance(tile_size, u.quantity.Quantity):
+        return tile_size.to(u.Unit('deg')).value
+    return float(tile_size)
+
 def hsc_cone_search(coord, radius=10.0 * u.Unit('arcsec'), redshift=None,
                     archive=None, dr='pdr2', rerun='pdr2_wide', cosmo=None,
-                    verbose=True, **kwargs):
+                    verbose=True, tile_size=None, max_jobs=4, output_dir=None, **kwargs):
     """
     Search for objects within a cone area.
+
+    For large regions, set `tile_size` (in degree) to split the cone into box
+    searches that run concurrently (up to `max_jobs` at a time). Objects outside
+    the cone and duplicates at the tile boundaries are removed locally. With
+    `output_dir`, each tile is saved to disk and the list of files is returned.
     """
     if archive is None:
         archive = Hsc(dr=dr, rerun=rerun)
@@ -568,16 +1057,59 @@ def hsc_cone_search(coord, radius=10.0 * u.Unit('arcsec'), redshift=None,
     rad_arcsec = _get_cutout_size(
         radius, redshift=redshift, cosmo=cosmo, verbose=verbose).to(u.Unit('arcsec'))
 
-    objects = archive.sql_query(
-        query.cone_search(ra, dec, rad_arcsec, archive=archive, **kwargs), verbose=True)
-
-    return objects
+    if tile_size is not None:
+        tile_size = _get_tile_size(tile_size)
+        rad_deg = rad_arcsec.to(u.Unit('deg')).value
+
+    if tile_size is None or rad_deg * 2.0 <= tile_size:
+        objects = archive.sql_query(
+            query.cone_search(ra, dec, rad_arcsec, archive=archive, **kwargs), verbose=True)
+        return objects
+
+    # Tiles covering the bounding box of the cone
+    ra_half = min(rad_deg / max(np.cos(np.deg2rad(min(abs(dec) + rad_deg, 90.0))), 1e-6), 180.0)
+    box = (ra - ra_half, ra + ra_half, dec - rad_deg, dec + rad_deg)
+    tiles = [tile for tile in query.split_box(*box, tile_size=tile_size)
+             if _tile_distance(ra, dec, tile) <= rad_deg]
+
+    def _in_cone(objects):
+        return coord.separation(
+            SkyCoord(objects['ra'], objects['dec'], unit='deg')).deg <= rad_deg
+
+    return _sharded_search(
+        archive, box, tiles, tile_select=_in_cone, output_dir=output_dir,
+        max_jobs=max_jobs, verbose=verbose, **kwargs)
+
+def _tile_distance(ra, dec, tile):
+    """Angular distance in degree between a position and the closest point of a tile."""
+    ra_offset = (ra - tile[0]) % 360.0
+    # The tile can cross RA=360 deg
+    ra_width = (tile[1] - tile[0]) % 360.0
+    if ra_offset > ra_width:
+        # Pick the closer RA edge
+        ra_near = tile[1] if ra_offset - ra_width < 360.0 - ra_offset else tile[0]
+    else:
+        ra_near = ra
+    dec_near = np.clip(dec, tile[2], tile[3])
+    return SkyCoord(ra, dec, unit='deg').separation(
+        SkyCoord(ra_near % 360.0, dec_near, unit='deg')).deg
 
 def hsc_box_search(coord, box_size=10.0 * u.Unit('arcsec'), coord_2=None, redshift=None,
                    archive=None, dr='pdr2', rerun='pdr2_wide', cosmo=None,
-                   verbose=True, **kwargs):
+                   verbose=True, tile_size=None, max_jobs=4, output_dir=None,
+                   catalog_store=None, **kwargs):
     """
     Search for objects within a box area.
+
+    For large regions, set `tile_size` (in degree) to split the box into tiles
+    of roughly equal area that are searched concurrently (up to `max_jobs` at a
+    time). Duplicated objects at the tile boundaries are removed. With
+    `output_dir`, each tile is saved to disk and the list of files is returned.
+
+    With a `unagi.catstore.CatalogStore` as `catalog_store`, the search is synced
+    incrementally: only the tracts and columns that are not in the store yet are
+    searched on the archive, and the objects are returned from the store
+    (`tile_size` and `output_dir` are not used).
     """
     # Login to HSC archive
     if archive is None:
@@ -608,30 +1140,93 @@ def hsc_box_search(coord, box_size=10.0 * u.Unit('arcsec'), coord_2=None, redshi
         ra1, dec1 = coord.ra.value, coord.dec.value
         ra2, dec2 = coord_2.ra.value, coord_2.dec.value
 
+    if catalog_store is not None:
+        return catalog_store.box_search(
+            archive, ra1, ra2, dec1, dec2, verbose=verbose, **kwargs)
+
+    if tile_size is not None:
+        tile_size = _get_tile_size(tile_size)
+        tiles = query.split_box(ra1, ra2, dec1, dec2, tile_size=tile_size)
+        if len(tiles) > 1:
+            return _sharded_search(
+                archive, (ra1, ra2, dec1, dec2), tiles, output_dir=output_dir,
+                max_jobs=max_jobs, verbose=verbose, **kwargs)
+
     objects = archive.sql_query(
         query.box_search(ra1, ra2, dec1, dec2, archive=archive, **kwargs), verbose=True)
 
     return objects
 
+def hsc_tract_patch(coord, skymap=None):
+    """
+    Find the tract and patch of the coordinates using the local skymap model.
+
+    Parameters
+    ----------
+    coord: astropy.coordinates.SkyCoord
+        Coordinates, can be an array.
+    skymap: unagi.skymap.RingsSkyMap
+        Skymap model. Default: the HSC `RingsSkyMap`.
+
+    Return
+    ------
+        Table with the coordinates, tract, patch, and pixel coordinates in the tract.
+    """
+    if skymap is None:
+        skymap = RingsSkyMap()
+
+    ra, dec = np.atleast_1d(coord.ra.deg), np.atleast_1d(coord.dec.deg)
+    tract, patch, x, y = skymap.find_patch(ra, dec)
+
+    return Table([ra, dec, tract, patch, x, y], names=['ra', 'dec', 'tract', 'patch', 'x', 'y'])
+
 def hsc_check_coverage(coord, dr='pdr2', rerun='pdr2_wide', archive=None, verbose=False,
-                       return_filter=False):
+                       return_filter=False, offline=False):
     """
     Check if the coordinate is covered by HSC footprint.
 
     TODO: This is not very fast, will take at least a few seconds for one object.
           And it does not guarentee that the location has data.
+
+    With `offline=True`, the saved footprint index of the rerun is used instead
+    (see `unagi.hsc.Hsc.footprint`). This does not need to login, and `coord`
+    can be an array of coordinates: the result is then a table with the tract,
+    patch, and one boolean column per filter for each coordinate.
     """
-    # Login to HSC archive
-    if archive is None:
-        archive = Hsc(dr=dr, rerun=rerun)
+    if offline:
+        if archive is None:
+            index = FootprintIndex.load(rerun)
+        else:
+            index = archive.footprint()
+
+        tract, patch, covered = index.lookup(coord.ra.deg, coord.dec.deg)
+
+        if coord.isscalar:
+            filter_list = [filt for filt, flag in zip(index.filters, covered[0]) if flag]
+            coverage = Table(
+                [[tract[0]] * len(filter_list), [patch[0]] * len(filter_list), filter_list],
+                names=['tract', 'patch', 'filter01'])
+        else:
+            filter_list = [list(np.asarray(index.filters)[flags]) for flags in covered]
+            coverage = Table([coord.ra.deg, coord.dec.deg, tract, patch],
+                             names=['ra', 'dec', 'tract', 'patch'])
+            for ii, filt in enumerate(index.filters):
+                coverage[filt] = covered[:, ii]
+            if verbose:
+                print("# {}/{} coordinates are covered".format(covered.any(1).sum(), len(coord)))
+                verbose = False
     else:
-        dr = archive.dr
-        rerun = archive.rerun
+        # Login to HSC archive
+        if archive is None:
+            archive = Hsc(dr=dr, rerun=rerun)
+        else:
+            dr = archive.dr
+            rerun = archive.rerun
 
-    sql_str = query.PATCH_CONTAIN.format(rerun, coord.ra.value, coord.dec.value)
+        sql_str = query.PATCH_CONTAIN.format(rerun, coord.ra.value, coord.dec.value)
 
-    coverage = archive.sql_query(sql_str, verbose=False)
-    filter_list = list(np.unique(coverage['filter01']))
+        coverage = archive.sql_query(sql_str, verbose=False)
+        filter_list = list(np.unique(coverage['filter01']))
 
     if verbose:
         if filter_list:
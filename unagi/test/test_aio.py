@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import (division, print_function, absolute_import,
+                        unicode_literals)
+
+import time
+import types
+import asyncio
+
+import pytest
+
+from unagi import aio
+
+
+class SlowHsc():
+    """Hsc that takes a while to log in."""
+    def __init__(self, dr='pdr2', rerun='pdr2_wide', verbose=True, config_file=None):
+        time.sleep(0.3)
+        self.dr, self.rerun = dr, rerun
+        self.archive = types.SimpleNamespace(timeout=60.)
+
+
+def test_create_does_not_block(monkeypatch):
+    monkeypatch.setattr(aio, 'Hsc', SlowHsc)
+    ticks = []
+
+    async def tick():
+        for _ in range(5):
+            ticks.append(time.time())
+            await asyncio.sleep(0.05)
+
+    async def create():
+        archive = await aio.AsyncHsc.create(rerun='pdr2_dud')
+        return archive, time.time()
+
+    async def main():
+        return (await asyncio.gather(create(), tick()))[0]
+
+    archive, created = asyncio.run(main())
+    assert archive.rerun == 'pdr2_dud' and archive.timeout == 60.
+    # The event loop kept running during the login
+    assert len([t for t in ticks if t < created]) >= 3
+
+
+def _archive(url, timeout):
+    """Hsc object that only knows the URLs of a local server."""
+    archive = types.SimpleNamespace(dr='pdr2', rerun='pdr2_wide', sql_version=1,
+                                    _credential=lambda: {})
+    archive.archive = types.SimpleNamespace(cat_url=url, timeout=timeout,
+                                            _username='user', _password='pass')
+    return archive
+
+
+def test_slow_download_is_not_cut(tmp_path):
+    from aiohttp import web
+
+    async def download(request):
+        response = web.StreamResponse()
+        await response.prepare(request)
+        # Longer than the timeout in total, but never idle for that long
+        for _ in range(6):
+            await response.write(b'x' * 1000)
+            await asyncio.sleep(0.1)
+        await response.write_eof()
+        return response
+
+    async def main():
+        app = web.Application()
+        app.router.add_post('/download', download)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        try:
+            async with aio.AsyncHsc(archive=_archive(
+                    'http://127.0.0.1:{}/'.format(port), 0.35)) as archive:
+                content = await archive.get_query_result(1)
+                path = await archive.get_query_result(1, file_path=str(tmp_path / 'result'))
+        finally:
+            await runner.cleanup()
+        return content, path
+
+    content, path = asyncio.run(main())
+    assert len(content) == 6000
+    assert open(path, 'rb').read() == content
+
+
+def test_missing_aiohttp(monkeypatch):
+    import sys
+    monkeypatch.setitem(sys.modules, 'aiohttp', None)
+
+    with pytest.raises(ImportError, match='aiohttp'):
+        aio.AsyncHsc(archive=_archive('http://127.0.0.1/', 1.))
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import (division, print_function, absolute_import,
+                        unicode_literals)
+
+import io
+import os
+
+import h5py
+import numpy as np
+import pytest
+
+from astropy.io import fits
+
+from unagi.bulk import (AdaptiveController, CutoutManifest, StackedCutoutWriter, file_checksum,
+                        plan_cutout_groups, write_fits_hdf)
+from unagi.task import _merge_cutouts
+
+
+def _download(tmp_path, manifest, ids, filt):
+    """Write fake cutouts of some objects in one filter and record them."""
+    records = []
+    for object_id in manifest.missing(ids, filt):
+        path = str(tmp_path / '{}_{}.fits'.format(object_id, filt))
+        fits.HDUList([fits.PrimaryHDU(),
+                      fits.ImageHDU(np.full((4, 4), object_id, dtype='float32'),
+                                    name='IMAGE')]).writeto(path)
+        records.append((object_id, filt, 0, path, file_checksum(path)))
+    manifest.add(records)
+    return [record[0] for record in records]
+
+
+def test_manifest_merged_per_filter(tmp_path):
+    manifest = CutoutManifest(str(tmp_path / 'manifest.sqlite'))
+    manifest.add([(1, 'HSC-I', 0, None, None), (1, 'HSC-R', 0, None, None),
+                  (2, 'HSC-I', 0, None, None)])
+    manifest.mark_merged([(1, 'HSC-I'), (2, 'HSC-I')])
+
+    assert manifest.merged([1, 2], ['HSC-I']) == {1, 2}
+    assert manifest.merged([1, 2], ['HSC-I', 'HSC-R']) == set()
+    assert manifest.missing([1, 2], 'HSC-R') == [1, 2]
+
+    manifest.reset_merged()
+    assert manifest.merged_cutouts([1, 2]) == set()
+
+
+def test_merge_with_an_added_filter(tmp_path):
+    manifest = CutoutManifest(str(tmp_path / 'manifest.sqlite'))
+    output = str(tmp_path / 'cutouts.hdf')
+    ids = [10, 11, 12]
+
+    _download(tmp_path, manifest, ids, 'HSC-I')
+    assert _merge_cutouts(output, ids, ['HSC-I'], manifest) == []
+
+    # Run again with one more filter: only the new cutouts are downloaded and merged
+    assert _download(tmp_path, manifest, ids, 'HSC-I') == []
+    assert _download(tmp_path, manifest, ids, 'HSC-R') == ids
+    assert _merge_cutouts(output, ids, ['HSC-I', 'HSC-R'], manifest) == []
+
+    assert manifest.merged(ids, ['HSC-I', 'HSC-R']) == set(ids)
+    assert not [f for f in os.listdir(str(tmp_path)) if f.endswith('.fits')]
+    with h5py.File(output, 'r') as d:
+        for object_id in ids:
+            assert sorted(d['%d' % object_id]) == ['HSC-I', 'HSC-R']
+            assert np.all(d['%d/HSC-R/IMAGE/DATA' % object_id][:] == object_id)
+
+
+def test_stacked_output_with_other_filters(tmp_path):
+    with h5py.File(str(tmp_path / 'cutouts.hdf'), 'a') as output:
+        StackedCutoutWriter(output, [1, 2], ['HSC-I'])
+        StackedCutoutWriter(output, [1, 2], ['HSC-I'])
+        with pytest.raises(ValueError):
+            StackedCutoutWriter(output, [1, 2], ['HSC-I', 'HSC-R'])
+
+
+def test_plan_cutout_groups_across_ra_zero():
+    ra, dec = np.array([359.9995, 0.0005, 180.]), np.array([0., 0., 0.])
+    groups = plan_cutout_groups(ra, dec, 20., 20.)
+
+    assert sorted(len(group[4]) for group in groups) == [1, 2]
+    pair = [group for group in groups if len(group[4]) == 2][0]
+    assert np.isclose(pair[0], 0.) or np.isclose(pair[0], 360.)
+
+
+class _Clock():
+    """Clock that only moves when told to."""
+    def __init__(self):
+        self.now = 1000.
+
+    def __call__(self):
+        return self.now
+
+
+def test_controller_additive_increase():
+    clock = _Clock()
+    controller = AdaptiveController(batch_size=100, batch_step=100, max_concurrency=3,
+                                    clock=clock)
+
+    # Rounds of `concurrency` requests with a steady throughput
+    for concurrency, batch_size in [(1, 100), (2, 200), (3, 300), (3, 400)]:
+        assert controller.concurrency == concurrency
+        assert controller.batch_size == batch_size
+        for _ in range(controller.concurrency):
+            clock.now += 1.
+            controller.success(100)
+    assert (controller.concurrency, controller.batch_size) == (3, 500)
+
+    # The round is slower: one request less in parallel
+    for _ in range(3):
+        clock.now += 10.
+        controller.success(100)
+    assert (controller.concurrency, controller.batch_size) == (2, 500)
+    assert controller.summary()['success'] == 12 and controller.n_objects == 1200
+
+
+def test_controller_back_off():
+    clock = _Clock()
+    controller = AdaptiveController(batch_size=800, concurrency=4, max_concurrency=4,
+                                    backoff=1., max_backoff=3., clock=clock)
+
+    controller.failure()
+    assert (controller.concurrency, controller.batch_size) == (2, 400)
+    assert controller.wait_time == 1.
+
+    # Consecutive errors double the pause, up to max_backoff
+    controller.failure()
+    assert controller.wait_time == 2.
+    controller.failure()
+    controller.failure()
+    assert controller.wait_time == 3.
+    assert (controller.concurrency, controller.batch_size) == (1, 50)
+
+    clock.now += 3.
+    assert controller.wait_time == 0.
+    controller.success(10)
+    assert (controller.concurrency, controller.batch_size) == (2, 150)
+
+    # Retry-After of the server, and the counter starts again after a success
+    controller.throttled(retry_after=30.)
+    assert controller.wait_time == 30.
+    clock.now += 30.
+    controller.throttled()
+    assert controller.wait_time == 2.
+    assert (controller.concurrency, controller.batch_size) == (1, 37)
+    assert controller.summary()['throttled'] == 2 and controller.summary()['failure'] == 4
+
+
+def _cutout(value, shape, name=None):
+    """In-memory FITS cutout with image, mask and variance planes."""
+    header = fits.Header([('OBJECT', 'test %d' % value)])
+    hdu_list = fits.HDUList([
+        fits.PrimaryHDU(),
+        fits.ImageHDU(np.full(shape, value, dtype='float32'), header=header, name='IMAGE'),
+        fits.ImageHDU(np.full(shape, value, dtype='int32'), name='MASK'),
+        fits.ImageHDU(np.full(shape, value * 0.5, dtype='float32'), name='VARIANCE')])
+    if name is None:
+        buffer = io.BytesIO()
+        hdu_list.writeto(buffer)
+        buffer.seek(0)
+        return buffer
+    hdu_list.writeto(name)
+    return name
+
+
+def test_stacked_layout(tmp_path):
+    output_file = str(tmp_path / 'cutouts.hdf')
+    with h5py.File(output_file, 'w') as output:
+        writer = StackedCutoutWriter(output, [10, 11, 12], ['HSC-I', 'HSC-R'],
+                                     planes=('IMAGE', 'MASK', 'VARIANCE'), chunks=2,
+                                     compression='gzip', compression_opts=4)
+        writer.write(0, 'HSC-I', _cutout(1, (5, 5)))
+        # A larger cutout makes the datasets larger
+        writer.write(1, 'HSC-R', _cutout(2, (7, 6)))
+        writer.write(2, 'HSC-I', _cutout(3, (3, 3)))
+        writer.write(2, 'HSC-R', _cutout(4, (3, 3)))
+        writer.clear(2)
+
+    with h5py.File(output_file, 'r') as output:
+        cutouts, mask = output['cutouts'], output['mask']
+        assert [str(f) for f in output.attrs['filters']] == ['HSC-I', 'HSC-R']
+        assert [str(p) for p in cutouts.attrs['planes']] == ['IMAGE', 'VARIANCE']
+        assert output['object_id'][:].tolist() == [10, 11, 12]
+        assert cutouts.shape == (3, 2, 2, 7, 6) and mask.shape == (3, 2, 7, 6)
+        assert cutouts.chunks[0] == 2 and cutouts.compression == 'gzip'
+        assert cutouts.compression_opts == 4
+
+        # Smaller cutouts are padded with NaN, and 0 in the mask
+        assert np.all(cutouts[0, 0, 0, :5, :5] == 1.) and np.all(cutouts[0, 0, 1, :5, :5] == 0.5)
+        assert np.isnan(cutouts[0, 0, :, 5:]).all() and np.isnan(cutouts[0, 0, :, :, 5:]).all()
+        assert np.all(mask[0, 0, :5, :5] == 1) and np.all(mask[0, 0, 5:] == 0)
+        assert np.all(cutouts[1, 1, 0] == 2.)
+
+        # Missing and cleared cutouts
+        assert output['shape'][:].tolist() == [
+            [[5, 5], [0, 0]], [[0, 0], [7, 6]], [[0, 0], [0, 0]]]
+        assert output['header'][0, 1] in (b'', '')
+        header = output['header'][0, 0]
+        header = fits.Header.fromstring(header.decode() if isinstance(header, bytes) else header)
+        assert header['OBJECT'] == 'test 1'
+
+
+def test_write_fits_hdf(tmp_path):
+    fits_file = _cutout(5, (4, 3), name=str(tmp_path / 'cutout.fits'))
+    with fits.open(fits_file, mode='append') as hdu_list:
+        hdu_list.append(fits.BinTableHDU.from_columns(
+            [fits.Column(name='flux', format='E', unit='nJy', array=np.arange(3.))],
+            name='TABLE'))
+
+    with h5py.File(str(tmp_path / 'cutouts.hdf'), 'w') as output:
+        write_fits_hdf(output.create_group('10/HSC-I'), fits_file, compression='gzip')
+
+    with h5py.File(str(tmp_path / 'cutouts.hdf'), 'r') as output:
+        group = output['10/HSC-I']
+        assert sorted(group) == ['IMAGE', 'MASK', 'PRIMARY', 'TABLE', 'VARIANCE']
+        assert 'DATA' not in group['PRIMARY']
+        assert group['IMAGE/DATA'].shape == (4, 3)
+        assert np.all(group['IMAGE/DATA'][:] == 5.)
+        assert group['MASK/DATA'].dtype.kind == 'i'
+        assert group['IMAGE/DATA'].compression == 'gzip'
+        assert group['IMAGE'].attrs['OBJECT'] == 'test 5'
+        assert 'NAXIS1' not in group['IMAGE'].attrs
+        assert group['TABLE/DATA/flux'][:].tolist() == [0., 1., 2.]
+        assert group['TABLE/DATA/flux'].attrs['UNITS'][0] == b'nJy'
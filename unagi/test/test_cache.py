@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import (division, print_function, absolute_import,
+                        unicode_literals)
+
+import os
+import time
+
+import numpy as np
+import pytest
+
+from astropy.table import Table
+
+from unagi.cache import CutoutCache, DiskCache, QueryCache
+from unagi.test.test_journal import FakeArchive
+
+
+def _age(cache, key, seconds):
+    """Pretend that an entry was last used a while ago."""
+    when = time.time() - seconds
+    os.utime(cache._path(key), (when, when))
+
+
+def test_disk_cache_size_and_lru(tmp_path):
+    cache = DiskCache(str(tmp_path), max_size=1000, low_water=0.6)
+    for ii in range(5):
+        cache.put('key_{}'.format(ii), b'x' * 180)
+        _age(cache, 'key_{}'.format(ii), 100 - ii)
+    assert cache.size == 900
+
+    # A hit makes key_0 the most recently used entry
+    assert cache.get('key_0') == b'x' * 180
+    cache.put('key_0', b'y' * 100)
+    assert cache.size == 820
+    assert cache.get('key_0') == b'y' * 100
+
+    # Over the limit: evict the oldest entries down to the low-water mark
+    cache.put('key_5', b'x' * 200)
+    assert cache.size == 480
+    assert [key in cache for key in ['key_0', 'key_1', 'key_2', 'key_3', 'key_4', 'key_5']] == [
+        True, False, False, False, True, True]
+    assert cache.size == sum(os.path.getsize(path) for path, _ in cache._entries())
+
+    # The size is read again from the disk
+    assert DiskCache(str(tmp_path), max_size=1000).size == cache.size
+    cache.remove('key_0')
+    assert cache.size == 380 and cache.get('key_0') is None
+    assert (cache.hits, cache.misses) == (2, 1)
+
+    cache.clear()
+    assert cache.size == 0 and cache._entries() == []
+
+
+def test_disk_cache_atomic_write(tmp_path):
+    cache = DiskCache(str(tmp_path))
+    cache.put('key', b'old')
+
+    def _fail(tmp_file):
+        with open(tmp_file, 'wb') as f:
+            f.write(b'truncated')
+        raise IOError('disk is full')
+
+    with pytest.raises(IOError):
+        cache._atomic_write('key', _fail)
+    assert cache.get('key') == b'old'
+    assert cache.size == 3
+    # No temporary file left behind
+    assert [name for _, _, files in os.walk(str(tmp_path)) for name in files] == ['key']
+
+
+def test_cutout_cache_url_key(tmp_path):
+    cache = CutoutCache(str(tmp_path))
+    url = 'https://hsc-release.mtk.nao.ac.jp/das_quarry/cgi-bin/quarryImage?ra=150.0&dec=2.0&filter=HSC-I'
+    same = 'https://hsc-release.mtk.nao.ac.jp/das_quarry/cgi-bin/quarryImage?filter=HSC-I&dec=2.0&ra=150.0'
+
+    assert cache.url_key('pdr2', url) == cache.url_key('pdr2', same)
+    assert cache.url_key('pdr2', url) != cache.url_key('pdr1', url)
+    assert cache.url_key('pdr2', url) != cache.url_key('pdr2', url.replace('HSC-I', 'HSC-R'))
+    assert cache.url_key('pdr2', url) != cache.url_key(
+        'pdr2', url.replace('quarryImage', 'getpsf'))
+
+    fits_file = str(tmp_path / 'cutout.fits')
+    with open(fits_file, 'wb') as f:
+        f.write(b'SIMPLE')
+    path = cache.put_file(cache.url_key('pdr2', url), fits_file)
+    assert path.endswith('.fits')
+    assert cache.get_file(cache.url_key('pdr2', same), str(tmp_path / 'copy.fits'))
+    assert open(str(tmp_path / 'copy.fits'), 'rb').read() == b'SIMPLE'
+
+
+def test_query_cache_round_trip(tmp_path):
+    cache = QueryCache(str(tmp_path))
+    key = cache.sql_key('pdr2', 'pdr2_wide', 'SELECT object_id FROM pdr2_wide.forced')
+    assert key == cache.sql_key('pdr2', 'pdr2_wide', 'select object_id\nfrom pdr2_wide.forced')
+    assert key != cache.sql_key('pdr2', 'pdr2_dud', 'SELECT object_id FROM pdr2_wide.forced')
+    assert cache.get_table(key) is None
+
+    table = Table({'object_id': np.arange(5), 'ra': np.linspace(0., 1., 5)})
+    table['ra'].unit = 'deg'
+    cache.put_table(key, table)
+
+    cached = cache.get_table(key)
+    assert cached.colnames == ['object_id', 'ra']
+    assert np.all(cached['ra'] == table['ra'])
+    assert cached['ra'].unit == 'deg'
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_query_cache_ttl(tmp_path):
+    cache = QueryCache(str(tmp_path), ttl=0.05)
+    key = cache.sql_key('pdr2', 'pdr2_wide', 'SELECT 1')
+    cache.put_table(key, Table({'a': [1]}))
+    assert cache.get_table(key) is not None
+
+    time.sleep(0.1)
+    assert cache.get_table(key) is None
+    assert key not in cache
+
+    # Entries never expire without a ttl
+    cache = QueryCache(str(tmp_path), ttl=None)
+    cache.put_table(key, Table({'a': [1]}))
+    time.sleep(0.1)
+    assert cache.get_table(key) is not None
+
+
+def test_unreadable_result_is_not_cached(tmp_path):
+    archive = FakeArchive(query_cache=QueryCache(str(tmp_path / 'cache')))
+    out_file = str(tmp_path / 'result.fits')
+
+    assert archive.sql_query('BROKEN', out_file=out_file, verbose=False) is None
+    assert not (tmp_path / 'result.fits').exists()
+    assert archive.query_cache.size == 0
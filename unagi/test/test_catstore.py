@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import (division, print_function, absolute_import,
+                        unicode_literals)
+
+import re
+
+import numpy as np
+
+from astropy.table import Table
+
+from unagi.catstore import CatalogStore
+from unagi.skymap import RingsSkyMap
+
+
+class FakeArchive():
+    """Run the SQL of box_search() on a random catalog."""
+    def __init__(self, ra_range, dec_range, n_objects=20000, seed=1):
+        rng = np.random.default_rng(seed)
+        self.dr, self.rerun = 'pdr2', 'pdr2_wide'
+        self.objects = {
+            'object_id': np.arange(n_objects) + 1000,
+            'ra': rng.uniform(ra_range[0], ra_range[1], n_objects) % 360.,
+            'dec': rng.uniform(dec_range[0], dec_range[1], n_objects)}
+        self.objects['tract'] = RingsSkyMap().find_tract(self.objects['ra'], self.objects['dec'])
+        self.sql = []
+
+    def in_box(self, ra1, ra2, dec1, dec2):
+        ra, dec = self.objects['ra'], self.objects['dec']
+        return ((ra - ra1) % 360. <= (ra2 - ra1) % 360.) & (dec >= dec1) & (dec <= dec2)
+
+    def sql_query(self, sql, verbose=False):
+        self.sql.append(sql)
+        box = re.search(r'boxSearch\(coord, ([^,]+), ([^,]+), ([^,]+), ([^)]+)\)', sql).groups()
+        box = [float(value) for value in box]
+        assert 0. <= box[0] <= 360. and 0. <= box[1] <= 360.
+        mask = self.in_box(*box)
+
+        tracts = re.search(r'forced.tract (?:= (\d+)|IN \(([^)]*)\))', sql)
+        tracts = [int(t) for t in (tracts.group(1) or tracts.group(2)).split(',')]
+        mask &= np.isin(self.objects['tract'], tracts)
+
+        columns = {}
+        for name in re.findall(r' AS (\w+)', sql):
+            if name in self.objects:
+                columns[name] = self.objects[name][mask]
+            else:
+                columns[name] = self.objects['object_id'][mask] * 0.5 + len(name)
+        return Table(columns)
+
+
+def test_sync_across_ra_zero(tmp_path):
+    archive = FakeArchive((358.5, 361.5), (-1., 1.))
+    store = CatalogStore(str(tmp_path))
+    box = (359.5, 0.5, -0.5, 0.5)
+
+    objects = store.box_search(archive, *box, verbose=False)
+    assert len(archive.sql) == 1
+    assert sorted(objects['object_id']) == sorted(
+        archive.objects['object_id'][archive.in_box(*box)])
+
+    # Same region, and a smaller one inside it, come from the store
+    assert len(store.box_search(archive, -0.5, 0.5, -0.5, 0.5, verbose=False)) == len(objects)
+    store.box_search(archive, 359.8, 0.2, -0.2, 0.2, verbose=False)
+    assert len(archive.sql) == 1
+
+
+def test_sync_new_columns(tmp_path):
+    archive = FakeArchive((149.5, 150.5), (1.5, 2.5))
+    store = CatalogStore(str(tmp_path))
+    box = (149.8, 150.2, 1.8, 2.2)
+
+    objects = store.box_search(archive, *box, verbose=False)
+    n_objects = len(objects)
+
+    # An object that only the query of the new columns returns
+    for name, value in [('object_id', 1), ('ra', 150.), ('dec', 2.)]:
+        archive.objects[name] = np.append(archive.objects[name], value)
+    archive.objects['tract'] = np.append(archive.objects['tract'], objects['tract'][0])
+
+    objects = store.box_search(archive, *box, aper=True, verbose=False)
+    assert len(archive.sql) == 2
+    assert ' AS ra' in archive.sql[-1] and ' AS dec' in archive.sql[-1]
+    assert len(objects) == n_objects
+    assert 1 not in objects['object_id']
+
+    new = [name for name in objects.colnames if 'aper' in name]
+    assert new and not any(np.ma.is_masked(objects[name]) for name in new)
+    assert not np.ma.is_masked(objects['ra'])
+
+    store.box_search(archive, *box, aper=True, verbose=False)
+    assert len(archive.sql) == 2
+
+
+def test_selection():
+    assert CatalogStore.selection() == 'primary'
+    assert CatalogStore.selection(primary=False, clean=True) == 'all_clean'
+    assert CatalogStore.selection(where_list=['i_cmodel_mag < 25']) == CatalogStore.selection(
+        where_list=['I_CMODEL_MAG<25'])
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import (division, print_function, absolute_import,
+                        unicode_literals)
+
+import json
+
+import numpy as np
+import pytest
+
+from astropy.table import Table
+
+from unagi import export
+
+
+def _catalog(n_rows=10, seed=1):
+    """Small catalog with the columns of a SQL result of the archive."""
+    rng = np.random.default_rng(seed)
+    catalog = Table()
+    catalog['object_id'] = np.arange(n_rows, dtype='int64') + 1000
+    catalog['ra'] = rng.uniform(149., 151., n_rows)
+    catalog['dec'] = rng.uniform(1., 3., n_rows)
+    catalog['i_cmodel_mag'] = rng.uniform(20., 25., n_rows)
+    catalog['i_cmodel_magsigma'] = rng.uniform(0., 0.1, n_rows)
+    catalog['i_cmodel_mag_isnull'] = np.arange(n_rows) % 3 == 0
+    catalog['i_cmodel_flag'] = np.arange(n_rows) % 2 == 0
+    catalog['i_pixelflags_edge'] = np.arange(n_rows) % 5 == 0
+    return catalog
+
+
+def test_pack_flags_round_trip():
+    rng = np.random.default_rng(2)
+    names = ['flag_{}'.format(ii) for ii in range(64)]
+    arrays = {name: rng.uniform(size=100) < 0.5 for name in names}
+
+    packed = export.pack_flags(arrays, names)
+    assert packed.dtype == np.uint64
+
+    unpacked = export.unpack_flags(packed, names)
+    assert list(unpacked) == names
+    for name in names:
+        assert np.all(unpacked[name] == arrays[name])
+
+
+def test_compact_table():
+    catalog = _catalog()
+    compact = export.compact_table(catalog, downcast=True, pack_flags=True, mask_null=True)
+
+    # Coordinates stay in double precision
+    assert compact['ra'].dtype == np.float64 and compact['dec'].dtype == np.float64
+    assert np.all(compact['ra'] == catalog['ra'])
+    assert compact['i_cmodel_mag'].dtype == np.float32
+    assert compact['object_id'].dtype == np.int64
+
+    # The _isnull companion becomes a mask
+    assert 'i_cmodel_mag_isnull' not in compact.colnames
+    assert np.all(compact['i_cmodel_mag'].mask == catalog['i_cmodel_mag_isnull'])
+
+    flags = json.loads(compact.meta['unagi_flags'])
+    assert flags == {'flags': ['i_cmodel_flag', 'i_pixelflags_edge']}
+    unpacked = export.unpack_flags(compact['flags'], flags['flags'])
+    assert np.all(unpacked['i_pixelflags_edge'] == catalog['i_pixelflags_edge'])
+
+    errors = export.compact_table(catalog, downcast='errors')
+    assert errors['i_cmodel_magsigma'].dtype == np.float32
+    assert errors['i_cmodel_mag'].dtype == np.float64
+
+
+def test_compact_plan_many_flags():
+    names = ['f{}_flag'.format(ii) for ii in range(70)]
+    plan = export.CompactPlan(names, [bool] * 70, pack_flags=True)
+    assert list(plan.flags) == ['flags', 'flags_1']
+    assert len(plan.flags['flags']) == 64 and len(plan.flags['flags_1']) == 6
+    assert plan.columns == ['flags', 'flags_1']
+
+
+def test_column_projection():
+    catalog = _catalog()
+    compact = export.compact_table(catalog, columns=['object_id', 'i_cmodel_*'])
+    assert compact.colnames == ['object_id', 'i_cmodel_mag', 'i_cmodel_magsigma',
+                                'i_cmodel_flag']
+
+    with pytest.raises(KeyError):
+        export.compact_table(catalog, columns=['object_id', 'g_cmodel_mag'])
+
+
+def test_export_format():
+    assert export.export_format('catalog.PQ') == 'parquet'
+    assert export.export_format('catalog.fits', format='hdf5') == 'hdf5'
+    with pytest.raises(ValueError):
+        export.export_format('catalog.fits')
+
+
+@pytest.mark.parametrize('output', ['catalog.h5', 'catalog.parquet'])
+def test_export_fits_table(tmp_path, output):
+    if output.endswith('.parquet'):
+        pytest.importorskip('pyarrow')
+    catalog = _catalog(n_rows=25)
+    fits_file = str(tmp_path / 'catalog.fits')
+    catalog.write(fits_file)
+    output = str(tmp_path / output)
+
+    assert export.export_fits_table(fits_file, output, downcast=True, pack_flags=True,
+                                    chunk_rows=10) == 25
+    with pytest.raises(IOError):
+        export.export_fits_table(fits_file, output)
+
+    if output.endswith('.h5'):
+        result = Table.read(output, path='catalog')
+        assert json.loads(result.meta['unagi_flags'])['flags'] == [
+            'i_cmodel_flag', 'i_pixelflags_edge']
+    else:
+        import pyarrow.parquet
+        arrow = pyarrow.parquet.read_table(output)
+        assert json.loads(arrow.schema.metadata[b'unagi_flags'])['flags'] == [
+            'i_cmodel_flag', 'i_pixelflags_edge']
+        result = {name: np.ma.masked_array(
+            arrow[name].to_numpy(zero_copy_only=False),
+            mask=arrow[name].is_null().to_numpy(zero_copy_only=False))
+            for name in arrow.column_names}
+    assert len(result['object_id']) == 25
+    assert np.all(result['object_id'] == catalog['object_id'])
+    assert result['ra'].dtype == np.float64 and np.all(result['ra'] == catalog['ra'])
+    assert result['i_cmodel_magsigma'].dtype == np.float32
+
+    # NULL values are NaN in HDF5 and masked in Parquet
+    null = np.asarray(catalog['i_cmodel_mag_isnull'])
+    mag = np.ma.filled(np.ma.asarray(result['i_cmodel_mag'], dtype=float), np.nan)
+    assert np.all(np.isnan(mag) == null)
+    assert np.all(np.asarray(result['flags']) & 1 == np.asarray(catalog['i_cmodel_flag']))
+
+
+def test_export_integer_null_to_hdf5(tmp_path):
+    catalog = _catalog(n_rows=6)
+    catalog['i_nchild'] = np.arange(6, dtype='int32')
+    catalog['i_nchild_isnull'] = np.arange(6) < 2
+    fits_file = str(tmp_path / 'catalog.fits')
+    catalog.write(fits_file)
+
+    output = str(tmp_path / 'catalog.h5')
+    export.export_fits_table(fits_file, output)
+    result = Table.read(output, path='catalog')
+
+    assert np.all(result['i_nchild_isnull'] == catalog['i_nchild_isnull'])
+    assert 'i_cmodel_mag_isnull' not in result.colnames
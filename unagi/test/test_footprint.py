@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import (division, print_function, absolute_import,
+                        unicode_literals)
+
+import numpy as np
+import pytest
+
+from astropy.table import Table
+
+from unagi.footprint import CORNERS, FootprintIndex
+
+
+def _footprint():
+    """Synthetic mosaic table: a square, a patch across RA=0 and a diamond."""
+    rows = [
+        # Square patch in two filters
+        (1, '0,0', 'HSC-I', [(10., 0.), (10.2, 0.), (10.2, 0.2), (10., 0.2)]),
+        (1, '0,0', 'HSC-R', [(10., 0.), (10.2, 0.), (10.2, 0.2), (10., 0.2)]),
+        # Across RA=0, the first corner is on the positive side
+        (2, '1,1', 'HSC-I', [(0.1, -0.1), (359.9, -0.1), (359.9, 0.1), (0.1, 0.1)]),
+        # Diamond, most of its bounding box is outside
+        (3, '2,2', 'HSC-I', [(20., 0.), (20.2, 0.2), (20., 0.4), (19.8, 0.2)]),
+    ]
+    table = Table(names=['tract', 'patch', 'filter01'], dtype=['int64', 'U8', 'U8'],
+                  rows=[row[:3] for row in rows])
+    for ii, (ra, dec) in enumerate(CORNERS):
+        table[ra] = [row[3][ii][0] for row in rows]
+        table[dec] = [row[3][ii][1] for row in rows]
+    return table
+
+
+@pytest.mark.parametrize('cell_size', [0.25, 0.05])
+def test_lookup(cell_size):
+    index = FootprintIndex(_footprint(), cell_size=cell_size)
+    assert index.filters == ['HSC-I', 'HSC-R']
+
+    ra = np.array([10.1, 10.3, 10.1, 10., 359.95, 0.05, -0.05, 0.15, 20., 19.85, 20.15])
+    dec = np.array([0.1, 0.1, 0., 0.2, 0., 0.05, -0.05, 0., 0.2, 0.05, 0.35])
+    tract, patch, covered = index.lookup(ra, dec)
+
+    # Inside, outside, on an edge and on a corner of the square
+    assert tract[:4].tolist() == [1, -1, 1, 1]
+    assert covered[:4].tolist() == [[True, True], [False, False], [True, True], [True, True]]
+    # Around RA=0, including a negative RA
+    assert tract[4:8].tolist() == [2, 2, 2, -1]
+    assert patch[4] == '1,1'
+    # Inside the diamond, and in its bounding box but outside
+    assert tract[8:].tolist() == [3, -1, -1]
+
+    assert index.contains(ra, dec).tolist() == (tract >= 0).tolist()
+    assert index.contains(ra, dec, filters=['HSC-I', 'HSC-R']).tolist() == [
+        True, False, True, True] + [False] * 7
+    assert not index.contains(ra, dec, filters='HSC-Z').any()
+
+
+def test_lookup_in_chunks():
+    index = FootprintIndex(_footprint())
+    rng = np.random.default_rng(3)
+    ra, dec = rng.uniform(9.9, 10.3, 1000), rng.uniform(-0.1, 0.3, 1000)
+
+    tract, _, covered = index.lookup(ra, dec)
+    tract_2, _, covered_2 = index.lookup(ra, dec, chunk_size=77)
+    assert np.all(tract == tract_2) and np.all(covered == covered_2)
+
+    inside = (ra >= 10.) & (ra <= 10.2) & (dec >= 0.) & (dec <= 0.2)
+    assert np.all((tract == 1) == inside)
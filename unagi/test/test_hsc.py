@@ -0,0 +1,20 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import (division, print_function, absolute_import,
+                        unicode_literals)
+
+import requests
+
+from unagi.test.test_journal import FakeArchive
+
+
+def test_mount_pool():
+    archive = FakeArchive()
+    archive.pool_maxsize, archive.pool_block, archive.max_retries = 10, False, 0
+    archive.session = requests.Session()
+    url = 'http://archive/das_quarry/cgi-bin/quarryImage?'
+
+    archive.mount_pool(url, 32)
+    assert archive.session.get_adapter(url)._pool_maxsize == 32
+    assert archive.session.get_adapter('http://archive/datasearch/')._pool_maxsize == 10
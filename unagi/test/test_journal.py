@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import (division, print_function, absolute_import,
+                        unicode_literals)
+
+import io
+import types
+
+import pytest
+
+import requests
+from astropy.table import Table
+
+from unagi.hsc import Hsc, QueryError
+from unagi.journal import JobJournal
+from unagi.poller import QueryPoller
+
+
+class _Response():
+    """Minimal response of the fake archive."""
+    def __init__(self, data=None, content=b''):
+        self.data = data
+        self.content = content
+
+    def json(self):
+        return self.data
+
+    def iter_content(self, chunk_size=1):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+
+class FakeArchive(Hsc):
+    """Hsc object that talks to an in-memory SQL server instead of the archive."""
+    def __init__(self, journal=None, submit_error=None, query_cache=None):
+        self.dr, self.rerun = 'pdr2', 'pdr2_wide'
+        self.archive = types.SimpleNamespace(cat_url='http://archive/', _username='user',
+                                             _password='pass')
+        self.sql_version = 1
+        self.cache, self.query_cache = None, query_cache
+        self.journal = journal
+        self.poller = QueryPoller(self.check_query, min_interval=0.01, max_interval=0.02)
+        self.jobs, self.n_submits = {}, 0
+        self.submit_error = submit_error
+
+    def _http_post_json(self, url, data, stream=False):
+        endpoint = url.rstrip('/').split('/')[-1]
+        if endpoint == 'submit':
+            if self.submit_error is not None:
+                raise self.submit_error
+            self.n_submits += 1
+            job_id = 100 + self.n_submits
+            self.jobs[job_id] = data['catalog_job']['sql']
+            return _Response({'id': job_id})
+
+        if data['id'] not in self.jobs:
+            error = requests.exceptions.HTTPError('404')
+            error.response = types.SimpleNamespace(status_code=404, text='')
+            raise error
+        if endpoint == 'status':
+            return _Response({'status': 'done'})
+        if endpoint == 'download':
+            if self.jobs[data['id']] == 'BROKEN':
+                return _Response(content=b'not a FITS file')
+            output = io.BytesIO()
+            Table({'sql': [self.jobs[data['id']]]}).write(output, format='fits')
+            return _Response(content=output.getvalue())
+        self.jobs.pop(data['id'])
+        return _Response({})
+
+
+def test_sql_key():
+    assert JobJournal.sql_key('SELECT ra, dec  FROM pdr2_wide.forced') == JobJournal.sql_key(
+        'select ra,dec from pdr2_wide.forced -- comment')
+    assert JobJournal.sql_key("SELECT 'A'") != JobJournal.sql_key("SELECT 'a'")
+
+
+def test_journal(tmp_path):
+    journal = JobJournal(str(tmp_path / 'jobs.db'))
+    journal.add(1, 'pdr2', 'pdr2_wide', 'SELECT 1')
+    journal.update(1, JobJournal.ERROR, error='syntax')
+    journal.update(1, JobJournal.DELETED)
+
+    assert journal.get(1)['status'] == JobJournal.DELETED
+    assert journal.get(1)['error'] == 'syntax'
+    assert journal.find('pdr2', 'pdr2_wide', 'SELECT 1') is None
+    assert journal.summary() == {JobJournal.DELETED: 1}
+
+
+def test_reattach(tmp_path):
+    journal_file = str(tmp_path / 'jobs.db')
+
+    # The first process submits the job and dies
+    archive = FakeArchive(journal=JobJournal(journal_file))
+    job = archive.submit_query('SELECT 1')
+
+    # The second one re-attaches to it
+    archive_2 = FakeArchive(journal=JobJournal(journal_file))
+    archive_2.jobs = archive.jobs
+    result = archive_2.sql_query('select  1', verbose=False)
+
+    assert result['sql'][0] == 'SELECT 1'
+    assert archive_2.n_submits == 0
+    assert archive_2.journal.get(job['id'])['status'] == JobJournal.DELETED
+
+
+def test_lost_job_is_submitted_again(tmp_path):
+    archive = FakeArchive(journal=JobJournal(str(tmp_path / 'jobs.db')))
+    job = archive.submit_query('SELECT 1')
+    archive.jobs.pop(job['id'])
+
+    assert archive.sql_query('SELECT 1', verbose=False)['sql'][0] == 'SELECT 1'
+    assert archive.n_submits == 2
+    assert archive.journal.get(job['id'])['status'] == JobJournal.LOST
+
+
+@pytest.mark.parametrize('error', [KeyboardInterrupt(), QueryError('rejected')])
+def test_error_during_submit(tmp_path, error):
+    archive = FakeArchive(journal=JobJournal(str(tmp_path / 'jobs.db')), submit_error=error)
+
+    if isinstance(error, KeyboardInterrupt):
+        with pytest.raises(KeyboardInterrupt):
+            archive.sql_query('SELECT 1', verbose=False)
+    else:
+        assert archive.sql_query('SELECT 1', verbose=False) is None
+    assert archive.journal.summary() == {}
+
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import (division, print_function, absolute_import,
+                        unicode_literals)
+
+import threading
+import types
+
+import pytest
+
+from unagi.poller import QueryPoller
+
+
+def _http_error(code):
+    """Exception that looks like a requests.exceptions.HTTPError."""
+    error = IOError('HTTP {}'.format(code))
+    error.response = types.SimpleNamespace(status_code=code)
+    return error
+
+
+def _poller(check, **kwargs):
+    return QueryPoller(check, min_interval=0.01, max_interval=0.02, jitter=0., **kwargs)
+
+
+def test_done_after_a_few_checks():
+    calls = []
+
+    def check(job_id):
+        calls.append(job_id)
+        return {'status': 'done' if len(calls) >= 3 else 'running'}
+
+    finished = []
+    poller = _poller(check)
+    future = poller.watch(1, callback=lambda job_id, status: finished.append(job_id))
+
+    assert future.result(timeout=5)['status'] == 'done'
+    assert calls == [1, 1, 1]
+    assert finished == [1]
+    assert 1 not in poller
+
+
+def test_failing_check_gives_up():
+    def check(job_id):
+        raise IOError('network is down')
+
+    finished = []
+    poller = _poller(check, max_failures=3)
+    future = poller.watch(1, callback=lambda job_id, status: finished.append(status))
+
+    with pytest.raises(IOError):
+        future.result(timeout=5)
+    assert finished[0]['status'] == 'error'
+    assert 1 not in poller
+
+
+def test_client_error_is_not_retried():
+    calls = []
+
+    def check(job_id):
+        calls.append(job_id)
+        raise _http_error(401)
+
+    poller = _poller(check, max_failures=10)
+    with pytest.raises(IOError):
+        poller.wait(1, timeout=5)
+    assert len(calls) == 1
+
+
+def test_transient_errors_are_retried():
+    calls = []
+
+    def check(job_id):
+        calls.append(job_id)
+        if len(calls) % 2 == 1:
+            raise _http_error(503)
+        return {'status': 'done' if len(calls) >= 6 else 'running'}
+
+    # Never more than 2 errors in a row
+    poller = _poller(check, max_failures=2)
+    assert poller.wait(1, timeout=5)['status'] == 'done'
+
+
+def test_cancelled_job_is_terminal():
+    poller = _poller(lambda job_id: {'status': 'cancelled'})
+    assert poller.wait(1, timeout=5)['status'] == 'cancelled'
+    assert len(poller) == 0
+
+
+def test_unwatch():
+    poller = QueryPoller(lambda job_id: {'status': 'running'}, min_interval=10.)
+    future = poller.watch(1)
+    poller.unwatch(1)
+
+    assert future.cancelled()
+    assert 1 not in poller
+
+
+def test_hanging_check_does_not_delay_other_jobs():
+    release = threading.Event()
+
+    def check(job_id):
+        if job_id == 1:
+            release.wait(10)
+        return {'status': 'done'}
+
+    poller = _poller(check, max_workers=2)
+    hanging = poller.watch(1)
+    assert poller.wait(2, timeout=5)['status'] == 'done'
+    assert not hanging.done()
+
+    release.set()
+    assert hanging.result(timeout=5)['status'] == 'done'
+    assert len(poller) == 0
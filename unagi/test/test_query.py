@@ -4,3 +4,58 @@
 from __future__ import (division, print_function, absolute_import,
                         unicode_literals)
 
+import numpy as np
+
+from unagi import query
+
+
+def test_wrap_ra_range():
+    assert query.wrap_ra_range(10., 20.) == (10., 20.)
+    assert query.wrap_ra_range(350., 10.) == (350., 10.)
+    assert query.wrap_ra_range(-10., 10.) == (350., 10.)
+    assert query.wrap_ra_range(350., 370.) == (350., 10.)
+    assert query.wrap_ra_range(350., 360.) == (350., 360.)
+
+
+def test_split_box():
+    tiles = query.split_box(10., 12., -1., 1., tile_size=1.)
+    assert len(tiles) == 4
+    assert tiles[0] == (10., 11., -1., 0.)
+
+
+def test_split_box_across_ra_zero():
+    box = (350., 10., 0., 0.5)
+    tiles = query.split_box(*box, tile_size=5.)
+
+    assert len(tiles) == 4
+    for tile in tiles:
+        assert 0. <= tile[0] < 360. and 0. <= tile[1] <= 360.
+    assert [tile[:2] for tile in tiles] == [(350., 355.), (355., 360.), (0., 5.), (5., 10.)]
+
+    # Every object belongs to exactly one tile, including the ones on the edges
+    ra = np.concatenate([np.linspace(350., 370., 401) % 360., [355., 0., 5.]])
+    dec = np.full(len(ra), 0.25)
+    counts = sum(query.in_tile(ra, dec, tile, box).astype(int) for tile in tiles)
+    assert (counts == 1).all()
+
+    # Objects outside the box
+    assert not query.in_tile([340., 20.], [0.25, 0.25], tiles[0], box).any()
+
+
+def test_in_tile_single_tile():
+    box = (-10., 10., 0., 1.)
+    tile = query.wrap_ra_range(box[0], box[1]) + box[2:]
+    assert query.in_tile([350., 10., 0., 11.], [0., 1., 0.5, 0.5], tile, box).tolist() == [
+        True, True, True, False]
+
+
+def test_normalize_sql():
+    sql = "SELECT object_id, ra FROM pdr2_wide.forced WHERE i_cmodel_mag < 25;"
+    for other in ["select object_id,ra\n  from PDR2_WIDE.forced where i_cmodel_mag<25",
+                  "SELECT object_id, ra -- the coordinates\nFROM pdr2_wide.forced "
+                  "/* a\n block */ WHERE i_cmodel_mag < 25"]:
+        assert query.normalize_sql(other) == query.normalize_sql(sql)
+
+    # Literals and quoted identifiers are case-sensitive
+    assert query.normalize_sql("SELECT 'A--b'") == "select 'A--b'"
+    assert query.normalize_sql('SELECT "Ra"') != query.normalize_sql('SELECT "ra"')
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import (division, print_function, absolute_import,
+                        unicode_literals)
+
+import threading
+import time
+
+import pytest
+
+from unagi.journal import JobJournal
+from unagi.scheduler import QueryScheduler
+from unagi.test.test_journal import FakeArchive
+
+
+class SlowArchive(FakeArchive):
+    """The jobs keep running until `release` is set."""
+    def __init__(self, **kwargs):
+        super(SlowArchive, self).__init__(**kwargs)
+        self.release = threading.Event()
+
+    def check_query(self, job_id):
+        if not self.release.is_set():
+            return {'status': 'running'}
+        return super(SlowArchive, self).check_query(job_id)
+
+
+def test_map_updates_the_journal(tmp_path):
+    archive = FakeArchive(journal=JobJournal(str(tmp_path / 'jobs.db')))
+    sql_list = ['SELECT {}'.format(ii) for ii in range(5)]
+
+    with QueryScheduler(archive, max_jobs=2, delete_after=False) as scheduler:
+        results = dict(scheduler.map(sql_list, ordered=False))
+
+    assert [results[ii]['sql'][0] for ii in range(5)] == sql_list
+    assert archive.journal.summary() == {JobJournal.FETCHED: 5}
+
+
+def test_job_done_after_shutdown():
+    archive = SlowArchive()
+    scheduler = QueryScheduler(archive, max_jobs=2)
+    future = scheduler.submit('SELECT 1')
+    while not scheduler.n_running:
+        time.sleep(0.01)
+
+    scheduler.shutdown(wait=False)
+    archive.release.set()
+
+    with pytest.raises(RuntimeError):
+        future.result(timeout=5)
+    assert len(archive.poller) == 0
+
+
+def test_same_sql_twice(tmp_path):
+    archive = SlowArchive(journal=JobJournal(str(tmp_path / 'jobs.db')))
+
+    with QueryScheduler(archive, max_jobs=2) as scheduler:
+        futures = [scheduler.submit('SELECT 1'), scheduler.submit('select  1')]
+        # Both futures wait for the same job
+        while sum(len(waiting) for _, waiting in scheduler._running.values()) < 2:
+            time.sleep(0.01)
+        assert scheduler.n_running == 1
+        archive.release.set()
+
+        assert [future.result(timeout=5)['sql'][0] for future in futures] == ['SELECT 1'] * 2
+    assert archive.n_submits == 1
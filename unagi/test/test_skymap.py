@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import (division, print_function, absolute_import,
+                        unicode_literals)
+
+import numpy as np
+
+from unagi.skymap import RingsSkyMap, parse_patch, patch_name
+
+
+def test_geometry():
+    skymap = RingsSkyMap()
+    assert skymap.n_tracts == 18938
+    assert skymap.n_patches == 9 and skymap.tract_dim == 36000
+
+
+def test_find_patch():
+    skymap = RingsSkyMap()
+    tract, patch, x, y = skymap.find_patch([150.1, 34.5, 0., 359.99], [2.2, -5., 0., 0.])
+
+    assert tract.tolist() == [9813, 8523, 9469, 9469]
+    assert patch.tolist() == ['5,4', '2,5', '4,0', '4,0']
+    assert np.allclose(x[:2], [21166.68, 11912.36], atol=0.01)
+    assert np.allclose(y[:2], [17326.19, 22425.09], atol=0.01)
+
+    # Poles
+    assert skymap.find_tract([10., 10.], [-90., 90.]).tolist() == [0, skymap.n_tracts - 1]
+
+
+def test_pixel_round_trip():
+    skymap = RingsSkyMap()
+    ra, dec = np.array([150.1, 150.3, 149.9]), np.array([2.2, 2.4, 2.0])
+    x, y = skymap.sky_to_pixel(9813, ra, dec)
+
+    ra_2, dec_2 = skymap.pixel_to_sky(9813, x, y)
+    assert np.allclose(ra_2, ra) and np.allclose(dec_2, dec)
+
+    # Same as the WCS of the tract, which is 1-based
+    assert np.allclose(skymap.tract_wcs(9813).wcs_world2pix(ra, dec, 0), [x, y])
+
+
+def test_patches():
+    skymap = RingsSkyMap()
+    patch_x, patch_y = skymap.patch_index([0., 3999.9, 4000., 1e6], [-5., 4000., 8000., 0.])
+    assert patch_x.tolist() == [0, 0, 1, 8] and patch_y.tolist() == [0, 1, 2, 0]
+
+    assert [int(v) for v in skymap.patch_bbox(0, 0)] == [0, 0, 4100, 4100]
+    assert [int(v) for v in skymap.patch_bbox(5, 4)] == [19900, 15900, 24100, 20100]
+    assert [int(v) for v in skymap.patch_bbox(8, 8)] == [31900, 31900, 36000, 36000]
+
+    assert patch_name([5, 10], [4, 0]).tolist() == ['5,4', '10,0']
+    assert parse_patch('5,4') == (5, 4) and parse_patch(504) == (5, 4)
+
+
+def test_box_tracts_across_ra_zero():
+    skymap = RingsSkyMap()
+    tracts = skymap.box_tracts(359.5, 0.5, -0.5, 0.5)
+
+    assert tracts.tolist() == [9226, 9469]
+    assert set(tracts) == set(skymap.box_tracts(359.5, 360., -0.5, 0.5)) | set(
+        skymap.box_tracts(0., 0.5, -0.5, 0.5))
+    assert 9813 in skymap.box_tracts(149.9, 150.3, 2.0, 2.4)
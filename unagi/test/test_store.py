@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import (division, print_function, absolute_import,
+                        unicode_literals)
+
+import io
+import warnings
+
+import numpy as np
+import pytest
+
+from astropy import wcs
+from astropy.io import fits
+from astropy.coordinates import SkyCoord
+
+from unagi.skymap import RingsSkyMap
+from unagi.store import PatchStore
+
+TRACT = 9813
+
+
+def _pixel_value(x, y):
+    """Value of a pixel of the tract, so that the stitching can be checked."""
+    return y * 100000. + x
+
+
+def _write_patch(store, patch_x, patch_y):
+    """Synthetic calexp image, the border pixels are -1."""
+    skymap = store.skymap
+    x0, y0, x1, y1 = [int(v) for v in skymap.patch_bbox(patch_x, patch_y)]
+    y, x = np.mgrid[y0:y1, x0:x1]
+    inner = ((x >= patch_x * skymap.patch_inner) & (x < (patch_x + 1) * skymap.patch_inner) &
+             (y >= patch_y * skymap.patch_inner) & (y < (patch_y + 1) * skymap.patch_inner))
+
+    header = skymap.tract_wcs(TRACT).to_header()
+    header['CRPIX1'] -= x0
+    header['CRPIX2'] -= y0
+    header['LTV1'], header['LTV2'] = -x0, -y0
+    hdu_list = fits.HDUList([
+        fits.PrimaryHDU(),
+        fits.ImageHDU(np.where(inner, _pixel_value(x, y), -1.), header=header, name='IMAGE'),
+        fits.ImageHDU(np.where(inner, 1, -1).astype('int32'), header=header, name='MASK'),
+        fits.ImageHDU(np.ones(x.shape, dtype='float32'), header=header, name='VARIANCE')])
+
+    buffer = io.BytesIO()
+    hdu_list.writeto(buffer)
+    store.write(TRACT, '{},{}'.format(patch_x, patch_y), 'HSC-I', [buffer.getvalue()])
+
+
+def _store(tmp_path, patches):
+    # Small patches, so that a cutout covers a few of them
+    skymap = RingsSkyMap(patch_inner=40, patch_border=5)
+    store = PatchStore(str(tmp_path), skymap=skymap)
+    for patch_x, patch_y in patches:
+        _write_patch(store, patch_x, patch_y)
+    return store
+
+
+def test_stitched_cutout(tmp_path):
+    store = _store(tmp_path, [(499, 499), (500, 499), (499, 500)])
+    ra, dec = store.skymap.pixel_to_sky(TRACT, 20000., 20000.)
+    coord = SkyCoord(ra[0], dec[0], unit='deg')
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        cutout = store.get_cutout_image(coord, w_half=5., h_half=3., mask=True)
+
+    image, mask = cutout['IMAGE'].data, cutout['MASK'].data
+    assert image.shape == (37, 61) and 'VARIANCE' not in cutout
+    x0, y0 = -cutout['IMAGE'].header['LTV1'], -cutout['IMAGE'].header['LTV2']
+    assert (x0, y0) == (20000 - 30, 20000 - 18)
+
+    # Only the inner regions are used, and the missing patch (500, 500) is NaN
+    y, x = np.mgrid[y0:y0 + 37, x0:x0 + 61]
+    missing = (x >= 20000) & (y >= 20000)
+    assert np.all(np.isnan(image[missing])) and np.all(mask[missing] == 0)
+    assert np.all(image[~missing] == _pixel_value(x, y)[~missing])
+    assert np.all(mask[~missing] == 1)
+
+    # The WCS of the cutout is the one of the tract, shifted
+    cutout_wcs = wcs.WCS(cutout['IMAGE'].header)
+    ra_c, dec_c = cutout_wcs.wcs_pix2world([[30., 18.]], 0)[0]
+    assert np.isclose(ra_c, ra[0]) and np.isclose(dec_c, dec[0])
+
+
+def test_cutout_across_tracts(tmp_path):
+    store = _store(tmp_path, [(9, 450)])
+    # The center is in the tract, the left edge of the cutout is in the next one
+    ra, dec = store.skymap.pixel_to_sky(TRACT, 380., 18020.)
+    coord = SkyCoord(ra[0], dec[0], unit='deg')
+    assert store.skymap.find_tract(ra, dec)[0] == TRACT
+
+    with pytest.warns(UserWarning, match='boundary of tract'):
+        cutout = store.get_cutout_image(coord, w_half=5., h_half=3.)
+    image = cutout['IMAGE'].data
+    assert np.isnan(image[:, 0]).all()
+    assert not np.isnan(image[:, 10:50]).any()
+
+    with pytest.warns(UserWarning), pytest.raises(IOError):
+        store.get_cutout_image(coord, filt='HSC-R')